@@ -0,0 +1,75 @@
+"""Benchmark the import time of rptar, which dominates startup time of the command-line program.
+
+Runs `python -X importtime -c "import rptar"` in fresh interpreters and reports the best and
+median cumulative import time. Bytecode is written on a warm-up run so that compilation is not
+measured. With --budget-ms, exits with a non-zero code if the best time exceeds the budget. As
+with timeit, the best time is used because higher times are mostly caused by other processes
+competing for the CPU. Import time depends on the machine, so the test suite only checks which
+modules are imported.
+
+Usage:
+    python benchmarks/import_time.py [--module rptar] [--runs N] [--budget-ms MS]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+
+def import_time_ms(module, env=None):
+    """Returns the cumulative import time in milliseconds of module in a fresh interpreter, and
+    the names of all modules imported as a side effect."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    cumulative_us = None
+    imported = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip() == "cumulative":
+            continue
+        imported.append(name.strip())
+        if name.strip() == module:
+            cumulative_us = int(cumulative)
+    if cumulative_us is None:
+        raise RuntimeError(f"No import time reported for {module}:\n{result.stderr}")
+    return cumulative_us / 1000, imported
+
+
+def measure(module, runs):
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    # Warm up so bytecode is cached and the filesystem is hot
+    _, imported = import_time_ms(module, env=env)
+    times = [import_time_ms(module, env=env)[0] for _ in range(runs)]
+    return min(times), statistics.median(times), imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="rptar")
+    parser.add_argument("--runs", type=int, default=9)
+    parser.add_argument("--budget-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    best_ms, median_ms, imported = measure(args.module, args.runs)
+    print(f"{args.module}: {best_ms:.1f} ms best, {median_ms:.1f} ms median of {args.runs} runs")
+    print(f"modules imported: {len(imported)}")
+    for heavy in ("typer", "click", "importlib.metadata", "json"):
+        if heavy in imported:
+            print(f"warning: {heavy} imported at startup")
+    if args.budget_ms is not None and best_ms > args.budget_ms:
+        print(f"over budget of {args.budget_ms:.1f} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
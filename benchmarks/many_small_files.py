@@ -0,0 +1,86 @@
+"""Benchmark writing archives of many small files with and without coalesced write buffering.
+
+Reports throughput and the number of write system calls made on the output file, and checks that
+the archive bytes are identical for every buffer size.
+
+Usage:
+    python benchmarks/many_small_files.py [--files N] [--size BYTES] [--mode w:gz]
+"""
+
+import argparse
+import hashlib
+import io
+import os
+from pathlib import Path
+import tempfile
+import time
+
+import repro_tarfile
+
+
+class CountingFileIO(io.FileIO):
+    """Unbuffered file where every write call is one write system call."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_count = 0
+
+    def write(self, data):
+        self.write_count += 1
+        return super().write(data)
+
+
+def make_tree(root, n_files, size):
+    paths = []
+    for i in range(n_files):
+        subdir = root / f"{i // 1000:04d}"
+        subdir.mkdir(exist_ok=True)
+        path = subdir / f"{i:08d}.txt"
+        path.write_bytes(os.urandom(size // 2).hex().encode()[:size])
+        paths.append(path)
+    return paths
+
+
+def run(paths, root, out, mode, write_buffer_size):
+    start = time.perf_counter()
+    with CountingFileIO(out, "w") as fileobj:
+        with repro_tarfile.open(
+            fileobj=fileobj, mode=mode, write_buffer_size=write_buffer_size
+        ) as tar:
+            for path in paths:
+                tar.add(path, arcname=str(path.relative_to(root)), recursive=False)
+        write_count = fileobj.write_count
+    elapsed = time.perf_counter() - start
+    digest = hashlib.sha256(out.read_bytes()).hexdigest()
+    return elapsed, write_count, digest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=20_000)
+    parser.add_argument("--size", type=int, default=300)
+    parser.add_argument("--mode", default="w")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir) / "tree"
+        root.mkdir()
+        paths = make_tree(root, args.files, args.size)
+        out = Path(tmpdir) / "archive"
+
+        print(f"{args.files} files of {args.size} bytes, mode {args.mode!r}")
+        print(f"{'buffer size':>12}{'seconds':>10}{'files/s':>12}{'writes':>10}")
+        digests = set()
+        for write_buffer_size in (0, 64 * 1024, repro_tarfile.DEFAULT_WRITE_BUFFER_SIZE):
+            elapsed, write_count, digest = run(paths, root, out, args.mode, write_buffer_size)
+            digests.add(digest)
+            print(
+                f"{write_buffer_size:>12}{elapsed:>10.3f}"
+                f"{args.files / elapsed:>12.0f}{write_count:>10}"
+            )
+        assert len(digests) == 1, "archive bytes differ between buffer sizes"
+        print("archives identical:", digests.pop())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Benchmark the page cache footprint of writing archives with and without the "stream" I/O policy.
+
+Reports throughput and how much of the input files and the output archive is left in the page
+cache after writing, measured with mincore, and checks that the archive bytes are identical for
+both policies. Linux only. Use a directory on a disk-backed file system, since tmpfs ignores
+page cache advice.
+
+Usage:
+    python benchmarks/page_cache.py [--dir DIR] [--files N] [--size BYTES] [--mode w:gz]
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import hashlib
+import mmap
+import os
+from pathlib import Path
+import tempfile
+import time
+
+import repro_tarfile
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+
+PAGE_SIZE = mmap.PAGESIZE
+
+
+def resident_bytes(path):
+    """Returns the number of bytes of a file that are in the page cache."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+    with open(path, "rb") as fp, mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_COPY) as mm:
+        pages = -(-size // PAGE_SIZE)
+        vec = (ctypes.c_ubyte * pages)()
+        buffer = ctypes.c_char.from_buffer(mm)
+        try:
+            if libc.mincore(ctypes.addressof(buffer), size, vec) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed")
+        finally:
+            del buffer
+    return sum(page & 1 for page in vec) * PAGE_SIZE
+
+
+def drop_from_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def make_tree(root, n_files, size):
+    paths = []
+    for i in range(n_files):
+        path = root / f"{i:06d}.bin"
+        path.write_bytes(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def run(paths, out, mode, io_policy):
+    for path in paths:
+        drop_from_cache(path)
+    start = time.perf_counter()
+    with repro_tarfile.open(out, mode, io_policy=io_policy) as tar:
+        for path in paths:
+            tar.add(path, arcname=path.name, recursive=False)
+    elapsed = time.perf_counter() - start
+    inputs_resident = sum(resident_bytes(path) for path in paths)
+    output_resident = resident_bytes(out)
+    digest = hashlib.sha256(out.read_bytes()).hexdigest()
+    return elapsed, inputs_resident, output_resident, digest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", default=None, help="Directory for the input files and archive.")
+    parser.add_argument("--files", type=int, default=64)
+    parser.add_argument("--size", type=int, default=16 * 1024 * 1024)
+    parser.add_argument("--mode", default="w")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        root = Path(tmpdir) / "tree"
+        root.mkdir()
+        paths = make_tree(root, args.files, args.size)
+        out = Path(tmpdir) / "archive"
+        total = args.files * args.size
+
+        print(f"{args.files} files of {args.size} bytes, mode {args.mode!r}")
+        print(
+            f"{'io_policy':>10}{'seconds':>10}{'MiB/s':>10}"
+            f"{'inputs cached':>16}{'output cached':>16}"
+        )
+        digests = set()
+        for io_policy in repro_tarfile.IO_POLICIES:
+            elapsed, inputs_resident, output_resident, digest = run(
+                paths, out, args.mode, io_policy
+            )
+            digests.add(digest)
+            print(
+                f"{str(io_policy):>10}{elapsed:>10.3f}{total / elapsed / 2**20:>10.1f}"
+                f"{inputs_resident / total:>16.1%}"
+                f"{output_resident / os.path.getsize(out):>16.1%}"
+            )
+        assert len(digests) == 1, "archive bytes differ between I/O policies"
+        print("archives identical:", digests.pop())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Benchmark listing and extracting compressed archives with and without read-ahead.
+
+Builds an archive of random-sized files with compressible contents, then times listing the
+members and extracting them with `readahead=False` and `readahead=True`, and checks that the
+extracted files are identical.
+
+Usage:
+    python benchmarks/readahead.py [--dir DIR] [--files N] [--size BYTES] [--mode r:gz]
+"""
+
+import argparse
+import hashlib
+import os
+from pathlib import Path
+import random
+import shutil
+import tempfile
+import time
+
+import repro_tarfile
+
+
+def make_tree(root, n_files, size):
+    rng = random.Random(0)
+    for i in range(n_files):
+        words = os.urandom(256).hex().encode()
+        n_bytes = rng.randrange(size // 2, size * 3 // 2)
+        (root / f"{i:06d}.txt").write_bytes((words * (n_bytes // len(words) + 1))[:n_bytes])
+
+
+def tree_digest(root):
+    digest = hashlib.sha256()
+    for path in sorted(root.rglob("*")):
+        if path.is_file():
+            digest.update(path.relative_to(root).as_posix().encode())
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def run(archive, mode, out, readahead):
+    start = time.perf_counter()
+    with repro_tarfile.open(archive, mode, readahead=readahead) as tar:
+        tar.getnames()
+    list_elapsed = time.perf_counter() - start
+    shutil.rmtree(out, ignore_errors=True)
+    start = time.perf_counter()
+    with repro_tarfile.open(archive, mode, readahead=readahead) as tar:
+        tar.extractall(out)
+    extract_elapsed = time.perf_counter() - start
+    return list_elapsed, extract_elapsed, tree_digest(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--dir", default=None, help="Directory for the archive and extracted files."
+    )
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--mode", default="r:gz")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        root = Path(tmpdir) / "tree"
+        root.mkdir()
+        make_tree(root, args.files, args.size)
+        archive = Path(tmpdir) / "archive"
+        with repro_tarfile.open(archive, args.mode.replace("r", "w", 1)) as tar:
+            tar.add(root, arcname="tree")
+        out = Path(tmpdir) / "out"
+
+        print(f"{args.files} files of about {args.size} bytes, mode {args.mode!r}")
+        print(f"{'readahead':>10}{'list s':>10}{'extract s':>12}")
+        digests = set()
+        for readahead in (False, True):
+            list_elapsed, extract_elapsed, digest = run(archive, args.mode, out, readahead)
+            digests.add(digest)
+            print(f"{str(readahead):>10}{list_elapsed:>10.3f}{extract_elapsed:>12.3f}")
+        assert len(digests) == 1, "extracted files differ with read-ahead"
+        print("extracted files identical:", digests.pop())
+
+
+if __name__ == "__main__":
+    main()
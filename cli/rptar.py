@@ -1,84 +1,415 @@
-from importlib.metadata import version
+import contextlib
 from io import BytesIO
 import itertools
 import logging
+import os
 from pathlib import Path
 import sys
-from typing import List, Literal, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Literal, Optional, Tuple
 
-if sys.version_info >= (3, 9):
-    from typing import Annotated
-else:
-    from typing_extensions import Annotated
+import repro_tarfile
 
-import typer
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
 
-import repro_tarfile
 
-__version__ = version("rptar")
+def __getattr__(name: str):
+    # Resolve the version and build the typer app only when needed, since importing
+    # importlib.metadata and typer dominates startup time
+    if name == "__version__":
+        from importlib.metadata import version
 
-app = typer.Typer()
+        globals()[name] = version("rptar")
+        return globals()[name]
+    if name == "app":
+        globals()[name] = _make_app()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-logger = logging.getLogger(__name__)
-logger.addHandler(logging.NullHandler())
+def _make_app():
+    import typer
 
+    if sys.version_info >= (3, 9):
+        from typing import Annotated
+    else:
+        from typing_extensions import Annotated
 
-def version_callback(value: bool):
-    if value:
-        print(f"repro-tarfile v{version('repro-tarfile')}")
-        print(f"rptar v{__version__}")
-        raise typer.Exit()
-
-
-@app.command(context_settings={"obj": {}})
-def rptar(
-    in_list: Annotated[List[str], typer.Argument(help="Files to add to the archive.")],
-    create: Annotated[bool, typer.Option("--create", "-c", help="Create a new archive.")],
-    file: Annotated[
-        Optional[str],
-        typer.Option(
-            "--file",
-            "-f",
-            help="Path of output archive file.",
-        ),
-    ] = None,
-    gzip: Annotated[bool, typer.Option("--gzip", "-z", help="Use gzip compression.")] = False,
-    bzip2: Annotated[bool, typer.Option("--bzip2", "-j", help="Use bzip2 compression.")] = False,
-    xz: Annotated[
-        bool, typer.Option("--xz", "-J", help="Use xz format with LZMA2 compression.")
-    ] = False,
-    recursion: Annotated[bool, typer.Option(help="Recurse into directories.")] = True,
-    verbose: Annotated[
-        int,
-        typer.Option(
-            "--verbose",
-            "-v",
-            count=True,
-            show_default=False,
-            help="Use to increase log verbosity.",
-        ),
-    ] = 0,
-    version: Annotated[
-        Optional[bool],
-        typer.Option(
-            "--version",
-            help="Print version number and exit.",
-            callback=version_callback,
-        ),
-    ] = None,
-):
-    """A lightweight replacement for `tar -c` for creating tar archives, but reproducibly/
-    deterministicly. It supports a subset of common options matching tar.
-
-    Example commands:
-
-    \b
-      rptar -czvf archive.tar.gz some_file.txt        # Archive one file
-      rptar -czvf archive.tar.gz file1.txt file2.txt  # Archive two files
-      rptar -czvf archive.tar.gz some_dir/*.txt       # Archive many files with glob
-      rptar -czvf archive.tar.gz some_dir/            # Archive directory recursively
-    """
+    app = typer.Typer()
+
+    def version_callback(value: bool):
+        if value:
+            print(f"repro-tarfile v{repro_tarfile.__version__}")  # type: ignore[attr-defined]
+            print(f"rptar v{__getattr__('__version__')}")
+            raise typer.Exit()
+
+    @app.command(context_settings={"obj": {}})
+    def rptar(
+        create: Annotated[
+            bool, typer.Option("--create", "-c", help="Create a new archive.")
+        ] = False,
+        in_list: Annotated[
+            Optional[List[str]], typer.Argument(help="Files to add to the archive.")
+        ] = None,
+        file: Annotated[
+            Optional[List[str]],
+            typer.Option(
+                "--file",
+                "-f",
+                help=(
+                    "Path of output archive file. Can be repeated to write several archives from "
+                    "one read of the inputs, with compression chosen by each file's suffix."
+                ),
+            ),
+        ] = None,
+        gzip: Annotated[bool, typer.Option("--gzip", "-z", help="Use gzip compression.")] = False,
+        bzip2: Annotated[
+            bool, typer.Option("--bzip2", "-j", help="Use bzip2 compression.")
+        ] = False,
+        xz: Annotated[
+            bool, typer.Option("--xz", "-J", help="Use xz format with LZMA2 compression.")
+        ] = False,
+        level: Annotated[
+            Optional[int],
+            typer.Option(
+                "--level",
+                help=(
+                    "Compression level, 0-9 for gzip (default 9), 1-9 for bzip2 (default 9), and "
+                    "0-9 for xz (default 6). Lower levels are faster and give larger archives, "
+                    "and gzip level 0 stores the data without compressing it."
+                ),
+            ),
+        ] = None,
+        auto_level: Annotated[
+            Optional[str],
+            typer.Option(
+                "--auto-level",
+                help=(
+                    "Choose the compression level by compressing a sample of the inputs, either "
+                    "'size:PERCENT' for the fastest level within PERCENT of the smallest output, "
+                    "or 'time:FACTOR' for the smallest output from levels at most FACTOR times "
+                    "slower than the fastest. The choice only depends on the inputs."
+                ),
+            ),
+        ] = None,
+        segment_incompressible: Annotated[
+            bool,
+            typer.Option(
+                "--segment-incompressible",
+                help=(
+                    "With gzip or xz compression, store the data of files that are already "
+                    "compressed, judged from their suffix and a sample of their contents, in "
+                    "separate compressed segments instead of compressing it again."
+                ),
+            ),
+        ] = False,
+        rsyncable: Annotated[
+            bool,
+            typer.Option(
+                "--rsyncable",
+                help=(
+                    "Make gzip output friendlier to rsync and deduplication by resetting "
+                    "compression at content-defined boundaries."
+                ),
+            ),
+        ] = False,
+        recursion: Annotated[bool, typer.Option(help="Recurse into directories.")] = True,
+        files_from: Annotated[
+            Optional[List[str]],
+            typer.Option(
+                "--files-from",
+                "-T",
+                help="Read names of files to add from a file, or '-' for stdin. Can be repeated.",
+            ),
+        ] = None,
+        null: Annotated[
+            bool,
+            typer.Option(
+                "--null", help="Names read with --files-from are separated by NUL characters."
+            ),
+        ] = False,
+        exclude: Annotated[
+            Optional[List[str]],
+            typer.Option(
+                "--exclude",
+                help="Exclude paths matching a gitignore-style pattern. Can be repeated.",
+            ),
+        ] = None,
+        exclude_from: Annotated[
+            Optional[List[str]],
+            typer.Option(
+                "--exclude-from",
+                help="Exclude paths matching gitignore-style patterns read from a file.",
+            ),
+        ] = None,
+        include: Annotated[
+            Optional[List[str]],
+            typer.Option(
+                "--include",
+                help="Only add paths matching a gitignore-style pattern. Can be repeated.",
+            ),
+        ] = None,
+        jobs: Annotated[
+            int,
+            typer.Option(
+                "--jobs",
+                min=1,
+                help="Number of worker processes used to read and encode members.",
+            ),
+        ] = 1,
+        upload: Annotated[
+            Optional[str],
+            typer.Option(
+                "--upload",
+                help="Stream the archive to this URL with the S3 multipart upload API.",
+            ),
+        ] = None,
+        part_size: Annotated[
+            int,
+            typer.Option(
+                "--part-size", min=1, help="Size in bytes of each part uploaded with --upload."
+            ),
+        ] = repro_tarfile.DEFAULT_PART_SIZE,
+        upload_jobs: Annotated[
+            int,
+            typer.Option("--upload-jobs", min=1, help="Number of parts to upload in parallel."),
+        ] = 4,
+        volume_size: Annotated[
+            Optional[int],
+            typer.Option(
+                "--volume-size",
+                min=1,
+                help=(
+                    "Split output files into numbered volumes of at most this many bytes, "
+                    "e.g., FILE.000, FILE.001, and so on."
+                ),
+            ),
+        ] = None,
+        verify: Annotated[
+            Optional[str],
+            typer.Option(
+                "--verify",
+                help=(
+                    "Check that an existing archive is identical to the archive that would be "
+                    "created, without writing it. Compression is taken from its suffix unless a "
+                    "compression option is given."
+                ),
+            ),
+        ] = None,
+        estimate: Annotated[
+            bool,
+            typer.Option(
+                "--estimate",
+                help=(
+                    "Print the exact size in bytes of the uncompressed archive that would be "
+                    "created, from file metadata only, without creating it."
+                ),
+            ),
+        ] = False,
+        preallocate: Annotated[
+            bool,
+            typer.Option(
+                "--preallocate",
+                help=(
+                    "Reserve disk space for the whole uncompressed archive before writing it, "
+                    "which reduces fragmentation and fails early if the disk is too full."
+                ),
+            ),
+        ] = False,
+        cache_dir: Annotated[
+            Optional[str],
+            typer.Option(
+                "--cache-dir",
+                help=(
+                    "Directory of a cache of archives. An archive with the same contents and "
+                    "settings as one in the cache is copied from it instead of compressed again."
+                ),
+            ),
+        ] = None,
+        cache_size: Annotated[
+            Optional[int],
+            typer.Option(
+                "--cache-size",
+                min=0,
+                help=(
+                    "Maximum total size in bytes of the archives in --cache-dir. The least "
+                    "recently used archives are removed when it's exceeded."
+                ),
+            ),
+        ] = None,
+        batch: Annotated[
+            Optional[str],
+            typer.Option(
+                "--batch",
+                help=(
+                    "Build many archives from a JSON file with a list of archive specs, sharing "
+                    "the work of reading inputs used by several archives. Prints the SHA-256 "
+                    "digest of each archive."
+                ),
+            ),
+        ] = None,
+        stats: Annotated[
+            bool,
+            typer.Option(
+                "--stats", help="Print a summary table of timings and byte counts to stderr."
+            ),
+        ] = False,
+        stats_json: Annotated[
+            Optional[str],
+            typer.Option(
+                "--stats-json",
+                help="Write per-member and aggregate timings and byte counts as JSON to a path.",
+            ),
+        ] = None,
+        verbose: Annotated[
+            int,
+            typer.Option(
+                "--verbose",
+                "-v",
+                count=True,
+                show_default=False,
+                help="Use to increase log verbosity.",
+            ),
+        ] = 0,
+        version: Annotated[
+            Optional[bool],
+            typer.Option(
+                "--version",
+                help="Print version number and exit.",
+                callback=version_callback,
+            ),
+        ] = None,
+    ):
+        """A lightweight replacement for `tar -c` for creating tar archives, but reproducibly/
+        deterministicly. It supports a subset of common options matching tar.
+
+        Example commands:
+
+        \b
+          rptar -czvf archive.tar.gz some_file.txt        # Archive one file
+          rptar -czvf archive.tar.gz file1.txt file2.txt  # Archive two files
+          rptar -czvf archive.tar.gz some_dir/*.txt       # Archive many files with glob
+          rptar -czvf archive.tar.gz some_dir/            # Archive directory recursively
+          rptar -czf archive.tar.gz -T files.txt          # Archive paths listed in a file
+          rptar --verify archive.tar.gz some_dir/         # Check an archive is up to date
+          rptar --batch jobs.json --jobs 8                # Build archives listed in a file
+        """
+        exit_code = _run(
+            in_list=in_list,
+            create=create,
+            file=file,
+            gzip=gzip,
+            bzip2=bzip2,
+            xz=xz,
+            level=level,
+            auto_level=auto_level,
+            segment_incompressible=segment_incompressible,
+            rsyncable=rsyncable,
+            recursion=recursion,
+            files_from=files_from,
+            null=null,
+            exclude=exclude,
+            exclude_from=exclude_from,
+            include=include,
+            jobs=jobs,
+            upload=upload,
+            part_size=part_size,
+            upload_jobs=upload_jobs,
+            volume_size=volume_size,
+            verify=verify,
+            estimate=estimate,
+            preallocate=preallocate,
+            cache_dir=cache_dir,
+            cache_size=cache_size,
+            batch=batch,
+            stats=stats,
+            stats_json=stats_json,
+            verbose=verbose,
+        )
+        if exit_code:
+            raise typer.Exit(code=exit_code)
+
+    return app
+
+
+_FAST_PATH_FLAGS = {"c": "create", "z": "gzip", "j": "bzip2", "J": "xz"}
+
+
+def _parse_fast_path(args: List[str]) -> Optional[Dict[str, Any]]:
+    """Parse the common `rptar -c[zjJ][v]f FILE PATH...` form of arguments without importing
+    typer. Returns keyword arguments for _run, or None if the arguments need the full parser."""
+    kwargs: Dict[str, Any] = {"in_list": [], "verbose": 0}
+    args_iter = iter(args)
+    for arg in args_iter:
+        if not arg.startswith("-"):
+            kwargs["in_list"].append(arg)
+            continue
+        if arg.startswith("--") or arg == "-":
+            return None
+        flags = arg[1:]
+        for i, flag in enumerate(flags):
+            if flag == "f":
+                value = flags[i + 1 :] or next(args_iter, None)
+                if "file" in kwargs or value is None or value.startswith("-"):
+                    return None
+                kwargs["file"] = [value]
+                break
+            elif flag == "v":
+                kwargs["verbose"] += 1
+            elif flag in _FAST_PATH_FLAGS:
+                kwargs[_FAST_PATH_FLAGS[flag]] = True
+            else:
+                return None
+    if not kwargs["in_list"] or not kwargs.get("create"):
+        # Let typer report usage errors
+        return None
+    return kwargs
+
+
+def main(args: Optional[List[str]] = None, prog_name: Optional[str] = None) -> None:
+    """Entry point for the rptar command-line program."""
+    if args is None:
+        args = sys.argv[1:]
+    kwargs = _parse_fast_path(args)
+    if kwargs is None:
+        __getattr__("app")(args=args, prog_name=prog_name)
+    else:
+        sys.exit(_run(**kwargs))
+
+
+def _run(
+    in_list: Optional[List[str]] = None,
+    create: bool = False,
+    file: Optional[List[str]] = None,
+    gzip: bool = False,
+    bzip2: bool = False,
+    xz: bool = False,
+    level: Optional[int] = None,
+    auto_level: Optional[str] = None,
+    segment_incompressible: bool = False,
+    rsyncable: bool = False,
+    recursion: bool = True,
+    files_from: Optional[List[str]] = None,
+    null: bool = False,
+    exclude: Optional[List[str]] = None,
+    exclude_from: Optional[List[str]] = None,
+    include: Optional[List[str]] = None,
+    jobs: int = 1,
+    upload: Optional[str] = None,
+    part_size: int = repro_tarfile.DEFAULT_PART_SIZE,
+    upload_jobs: int = 4,
+    volume_size: Optional[int] = None,
+    verify: Optional[str] = None,
+    estimate: bool = False,
+    preallocate: bool = False,
+    cache_dir: Optional[str] = None,
+    cache_size: Optional[int] = None,
+    batch: Optional[str] = None,
+    stats: bool = False,
+    stats_json: Optional[str] = None,
+    verbose: int = 0,
+) -> int:
+    """Create an archive according to the command-line options. Returns the exit code."""
     # Set up logger
     log_level = logging.WARNING - 10 * verbose
     logger.setLevel(log_level)
@@ -94,17 +425,79 @@ def rptar(
     logger.debug("gzip: %s", gzip)
     logger.debug("bzip2: %s", bzip2)
     logger.debug("xz: %s", xz)
+    logger.debug("level: %s", level)
+    logger.debug("auto_level: %s", auto_level)
+    logger.debug("segment_incompressible: %s", segment_incompressible)
+    logger.debug("rsyncable: %s", rsyncable)
     logger.debug("recursion: %s", recursion)
+    logger.debug("files_from: %s", files_from)
+    logger.debug("null: %s", null)
+    logger.debug("exclude: %s", exclude)
+    logger.debug("exclude_from: %s", exclude_from)
+    logger.debug("include: %s", include)
+    logger.debug("jobs: %s", jobs)
+    logger.debug("upload: %s", upload)
+    logger.debug("part_size: %s", part_size)
+    logger.debug("upload_jobs: %s", upload_jobs)
+    logger.debug("volume_size: %s", volume_size)
+    logger.debug("verify: %s", verify)
+    logger.debug("estimate: %s", estimate)
+    logger.debug("preallocate: %s", preallocate)
+    logger.debug("cache_dir: %s", cache_dir)
+    logger.debug("cache_size: %s", cache_size)
+    logger.debug("batch: %s", batch)
+    logger.debug("stats: %s", stats)
+    logger.debug("stats_json: %s", stats_json)
+
+    if batch:
+        outputs = (file, upload, verify, volume_size, cache_dir, segment_incompressible)
+        if in_list or files_from or any(outputs):
+            logger.error("--batch can't be used with paths or other output options.")
+            return 1
+        if gzip or bzip2 or xz or level is not None or auto_level:
+            logger.error("Compression options for --batch go in the archive specs.")
+            return 1
+        if rsyncable or exclude or exclude_from or include:
+            logger.error("Compression and pattern options for --batch go in the archive specs.")
+            return 1
+        return _run_batch(batch, jobs=jobs, stats=stats, stats_json=stats_json)
 
     # Check create option
-    if not create:
+    if not create and not verify and not estimate:
         logger.error("Only create option is supported. Use `tar` for other operations.")
-        raise typer.Exit(code=1)
+        return 1
+
+    if upload and file:
+        logger.error("Only one of --file and --upload can be used at a time.")
+        return 1
+
+    if verify and (file or upload or volume_size):
+        logger.error("--verify can't be used with --file, --upload, or --volume-size.")
+        return 1
+
+    if volume_size and not file:
+        logger.error("--volume-size can only be used with --file.")
+        return 1
+
+    if estimate and (file or upload or verify or volume_size):
+        logger.error("--estimate can't be used with --file, --upload, --verify, or --volume-size.")
+        return 1
+
+    if cache_size is not None and not cache_dir:
+        logger.error("--cache-size can only be used with --cache-dir.")
+        return 1
+
+    if cache_dir and (upload or verify or volume_size or estimate or preallocate):
+        logger.error(
+            "--cache-dir can't be used with --upload, --verify, --volume-size, --estimate, "
+            "or --preallocate."
+        )
+        return 1
 
     # Compression
     if sum((gzip, bzip2, xz)) > 1:
         logger.error("Only one compression option can be used at a time.")
-        raise typer.Exit(code=1)
+        return 1
     write_mode: Literal["w", "w:gz", "w:bz2", "w:xz"]
     try:
         compression = next(itertools.compress(("gz", "bz2", "xz"), (gzip, bzip2, xz)))
@@ -113,28 +506,413 @@ def rptar(
     except StopIteration:
         write_mode = "w"
 
-    # Process inputs, manually recurse for logging
-    in_paths = set(Path(p) for p in in_list)
-    if recursion:
-        for path in frozenset(in_paths):
-            if path.is_dir():
-                in_paths.update(path.glob("**/*"))
+    # Several output files are written in one pass, each with compression from its suffix
+    tee_targets: List[Tuple[Path, str]] = []
+    if file and len(file) > 1:
+        if write_mode != "w":
+            logger.error("Compression options can't be used with more than one --file.")
+            return 1
+        for name in file:
+            suffix_mode = _mode_from_suffix(name)
+            if suffix_mode is None:
+                logger.error("Can't tell compression of %s from its suffix.", name)
+                return 1
+            tee_targets.append((Path(name).resolve(), suffix_mode))
+        if cache_dir:
+            logger.error("--cache-dir can't be used with more than one --file.")
+            return 1
 
-    if file:
-        out = Path(file).resolve()
-        logger.debug("writing to: %s", out)
-        with repro_tarfile.open(out, write_mode) as tar:
-            for path in sorted(in_paths):
+    # Archives are verified with compression from the existing file's suffix by default
+    verify_mode: Any = write_mode
+    if verify and write_mode == "w":
+        verify_mode = _mode_from_suffix(verify) or "w"
+
+    # Compression level, chosen from a sample of the inputs once they're known for --auto-level
+    level_kwargs: Dict[str, Any] = {}
+    if level is not None or auto_level:
+        if write_mode == "w":
+            logger.error("--level and --auto-level can only be used with -z, -j, or -J.")
+            return 1
+        if level is not None and auto_level:
+            logger.error("Only one of --level and --auto-level can be used at a time.")
+            return 1
+        min_level = 1 if write_mode == "w:bz2" else 0
+        if level is not None and not min_level <= level <= 9:
+            logger.error("--level must be from %d to 9 for this compression.", min_level)
+            return 1
+        if auto_level:
+            parsed = _parse_auto_level(auto_level)
+            if parsed is None:
+                logger.error("--auto-level must be 'size:PERCENT' or 'time:FACTOR'.")
+                return 1
+            level_kwargs = parsed
+
+    if segment_incompressible:
+        if write_mode not in ("w:gz", "w:xz"):
+            logger.error("--segment-incompressible can only be used with -z or -J.")
+            return 1
+        if rsyncable or cache_dir:
+            logger.error("--segment-incompressible can't be used with --rsyncable or --cache-dir.")
+            return 1
+
+    if estimate and write_mode != "w":
+        logger.error("--estimate only works for uncompressed archives.")
+        return 1
+
+    if preallocate and (write_mode != "w" or not file or len(file) > 1 or volume_size):
+        logger.error("--preallocate can only be used with one uncompressed --file.")
+        return 1
+
+    out_modes = [write_mode, verify_mode] + [mode for _, mode in tee_targets]
+    if rsyncable and "w:gz" not in out_modes:
+        logger.error("--rsyncable can only be used with gzip compression.")
+        return 1
+
+    # Exclude and include patterns, with patterns from files before command-line patterns so
+    # that the command line takes precedence
+    exclude_patterns: List[str] = []
+    for exclude_file in exclude_from or []:
+        exclude_patterns.extend(Path(exclude_file).read_text().splitlines())
+    exclude_patterns.extend(exclude or [])
+
+    # Process inputs
+    if not in_list and not files_from:
+        logger.error("No files to add. Pass paths as arguments or use --files-from.")
+        return 1
+    # Use the same walk with and without patterns, so patterns that match nothing change nothing
+    matcher = repro_tarfile.PathMatcher(exclude=exclude_patterns, include=include or [])
+    delimiter = b"\0" if null else b"\n"
+
+    def iter_names() -> Iterator[str]:
+        yield from in_list or []
+        for name_file in files_from or []:
+            if name_file == "-":
+                yield from _read_delimited(sys.stdin.buffer, delimiter)
+            else:
+                with Path(name_file).open("rb") as fp:
+                    yield from _read_delimited(fp, delimiter)
+
+    def iter_paths() -> Iterator[Path]:
+        # Manually recurse for logging. Walk with the matcher so excluded directories are pruned
+        # without being read, and symbolic links to directories are added as links, not walked.
+        for name in iter_names():
+            yield from (Path(p) for p in matcher.walk(name, recursive=recursion))
+
+    # Additional ReproducibleTarFile options
+    archive_stats = repro_tarfile.ArchiveStats() if stats or stats_json else None
+    # rptar doesn't use the member list, so only keep a compact index to keep memory use flat
+    tar_kwargs: Dict[str, Any] = {
+        "stats": archive_stats,
+        "keep_members": False,
+        "write_buffer_size": repro_tarfile.DEFAULT_WRITE_BUFFER_SIZE,
+    }
+    if rsyncable:
+        tar_kwargs["rsyncable"] = True
+    if segment_incompressible:
+        tar_kwargs["segment_incompressible"] = True
+    archive_cache = None
+    if cache_dir:
+        archive_cache = repro_tarfile.ArchiveCache(cache_dir, max_size=cache_size)
+        tar_kwargs["archive_cache"] = archive_cache
+
+    # The paths are needed before opening the archive to choose the level
+    chosen_paths: Optional[List[Path]] = None
+    if level_kwargs:
+        chosen_paths = list(_sorted_unique(iter_paths()))
+        level = repro_tarfile.choose_compression_level(
+            write_mode[2:],  # type: ignore[arg-type]
+            chosen_paths,
+            **level_kwargs,
+        )
+        logger.info("chose compression level %d", level)
+    if level is not None:
+        tar_kwargs["preset" if write_mode == "w:xz" else "compresslevel"] = level
+    if archive_stats is not None and write_mode != "w":
+        archive_stats.settings["level"] = (
+            level if level is not None else _DEFAULT_LEVELS[write_mode]
+        )
+
+    def add_paths(tar: repro_tarfile.ReproducibleTarFile) -> None:
+        sorted_paths: Iterable[Path]
+        sorted_paths = _sorted_unique(iter_paths()) if chosen_paths is None else chosen_paths
+        if jobs > 1 or preallocate:
+            sorted_paths = list(sorted_paths)
+        if preallocate:
+            size = tar.estimate_size(sorted_paths)
+            if tar.preallocate(size):
+                logger.debug("preallocated %d bytes", size)
+        if jobs > 1:
+            for path in sorted_paths:
                 logger.info("adding: %s", path)
-                tar.add(path, recursive=False)
+            tar.add_paths(sorted_paths, jobs=jobs)
+            return
+        for path in sorted_paths:
+            logger.info("adding: %s", path)
+            tar.add(path, recursive=False)
+
+    if estimate:
+        with repro_tarfile.open(fileobj=BytesIO(), mode="w", **tar_kwargs) as tar:
+            print(tar.estimate_size(_sorted_unique(iter_paths())))
+        return 0
+
+    if upload:
+        logger.debug("uploading to: %s", upload)
+        sink = repro_tarfile.HTTPMultipartSink(
+            upload, part_size=part_size, max_workers=upload_jobs
+        )
+        # Not a typeshed file object, but implements everything TarFile needs for writing
+        sink_fileobj: Any = sink
+        try:
+            with sink:
+                with repro_tarfile.open(
+                    fileobj=sink_fileobj, mode=write_mode, **tar_kwargs
+                ) as tar:
+                    add_paths(tar)
+        except OSError as e:
+            logger.error("Upload failed: %s", e)
+            return 1
+        logger.info("uploaded %d parts", len(sink.parts))
+    elif verify:
+        logger.debug("verifying: %s (%s)", verify, verify_mode)
+        try:
+            with repro_tarfile.VerifySink(verify) as verify_sink:
+                # Not a typeshed file object, but implements everything TarFile needs for writing
+                verify_fileobj: Any = verify_sink
+                # Without a write buffer, mismatches are reported at the member being written
+                verify_kwargs = dict(tar_kwargs, write_buffer_size=0)
+                with repro_tarfile.open(
+                    fileobj=verify_fileobj, mode=verify_mode, **verify_kwargs
+                ) as tar:
+                    add_paths(tar)
+        except repro_tarfile.ArchiveMismatchError as e:
+            logger.error("%s", e)
+            return 1
+        logger.info("verified %d bytes: %s", verify_sink.tell(), verify)
+    elif volume_size and file:
+        targets = tee_targets or [(Path(file[0]).resolve(), write_mode)]
+        with contextlib.ExitStack() as stack:
+            # Not typeshed file objects, but implement everything TarFile needs for writing
+            volume_targets: List[Tuple[Any, str]] = []
+            for out, mode in targets:
+                logger.debug("writing volumes of: %s (%s)", out, mode)
+                sink = stack.enter_context(
+                    repro_tarfile.VolumeSink(out, volume_size, on_volume=_log_volume)
+                )
+                volume_targets.append((sink, mode))
+            if len(volume_targets) > 1:
+                tar = repro_tarfile.ReproducibleTarFile.teeopen(volume_targets, **tar_kwargs)
+            else:
+                tar = repro_tarfile.open(
+                    fileobj=volume_targets[0][0], mode=write_mode, **tar_kwargs
+                )
+            with tar:
+                add_paths(tar)
+    elif tee_targets:
+        for out, mode in tee_targets:
+            logger.debug("writing to: %s (%s)", out, mode)
+        from tarfile import CompressionError
+
+        try:
+            with repro_tarfile.ReproducibleTarFile.teeopen(tee_targets, **tar_kwargs) as tar:
+                add_paths(tar)
+        except CompressionError as e:
+            logger.error("%s", e)
+            return 1
+    elif file:
+        out = Path(file[0]).resolve()
+        logger.debug("writing to: %s", out)
+        try:
+            with repro_tarfile.open(out, write_mode, **tar_kwargs) as tar:
+                add_paths(tar)
+        except OSError as e:
+            logger.error("%s", e)
+            return 1
     else:
         with BytesIO() as stream:
-            with repro_tarfile.open(fileobj=stream, mode=write_mode) as tar:
-                for path in sorted(in_paths):
-                    logger.info("adding: %s", path)
-                    tar.add(path, recursive=False)
+            with repro_tarfile.open(fileobj=stream, mode=write_mode, **tar_kwargs) as tar:
+                add_paths(tar)
             sys.stdout.buffer.write(stream.getvalue())
 
+    if archive_cache is not None:
+        logger.info("archive cache %s: %s", "hit" if archive_cache.hits else "miss", cache_dir)
+
+    if archive_stats is not None:
+        if stats:
+            print(archive_stats.format_table(), file=sys.stderr)
+        if stats_json:
+            with Path(stats_json).open("w") as fp:
+                import json
+
+                json.dump(archive_stats.to_dict(), fp, indent=2)
+
+    return 0
+
+
+def _run_batch(batch: str, jobs: int, stats: bool, stats_json: Optional[str]) -> int:
+    """Build the archives in a JSON batch file. Returns the exit code."""
+    import json
+
+    with Path(batch).open() as fp:
+        specs = json.load(fp)
+    if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+        logger.error("Batch file must contain a list of archive specs.")
+        return 1
+    for spec in specs:
+        # Compression is taken from the output file's suffix by default
+        if "compression" not in spec and "output" in spec:
+            suffix_mode = _mode_from_suffix(spec["output"])
+            if suffix_mode is None:
+                logger.error("Can't tell compression of %s from its suffix.", spec["output"])
+                return 1
+            spec["compression"] = suffix_mode.partition(":")[2] or None
+
+    from tarfile import TarError
+
+    try:
+        summaries = repro_tarfile.build_archives(specs, jobs=jobs)
+    except (OSError, TypeError, ValueError, TarError) as e:
+        logger.error("%s", e)
+        return 1
+
+    # Digests in the format of sha256sum, so they can be checked with `sha256sum -c`
+    for summary in summaries:
+        print(f"{summary['sha256']}  {summary['output']}")
+        logger.info(
+            "wrote: %s (%d members, %d bytes, %.3f s)",
+            summary["output"],
+            summary["members"],
+            summary["size"],
+            summary["seconds"],
+        )
+    if stats:
+        print(_format_batch_table(summaries), file=sys.stderr)
+    if stats_json:
+        with Path(stats_json).open("w") as fp:
+            json.dump(summaries, fp, indent=2)
+    return 0
+
+
+_DEFAULT_LEVELS = {"w:gz": 9, "w:bz2": 9, "w:xz": 6}
+
+
+def _parse_auto_level(value: str) -> Optional[Dict[str, float]]:
+    """Parses an --auto-level target into arguments for choose_compression_level."""
+    kind, _, number = value.partition(":")
+    try:
+        amount = float(number)
+    except ValueError:
+        return None
+    if amount < 0:
+        return None
+    if kind == "size":
+        return {"size_tolerance": amount / 100}
+    elif kind == "time":
+        return {"max_cost": amount}
+    return None
+
+
+def _format_batch_table(summaries: List[Dict[str, Any]]) -> str:
+    lines = [f"{'archive':<40} {'members':>9} {'bytes':>14} {'seconds':>9}"]
+    for summary in summaries:
+        lines.append(
+            f"{summary['output']:<40} {summary['members']:>9} {summary['size']:>14} "
+            f"{summary['seconds']:>9.3f}"
+        )
+    return "\n".join(lines)
+
+
+def _log_volume(path: str) -> None:
+    logger.info("wrote volume: %s", path)
+
+
+_SUFFIX_MODES = {
+    ".tar": "w",
+    ".tar.gz": "w:gz",
+    ".tgz": "w:gz",
+    ".tar.bz2": "w:bz2",
+    ".tbz2": "w:bz2",
+    ".tar.xz": "w:xz",
+    ".txz": "w:xz",
+    ".tar.zst": "w:zst",
+    ".tzst": "w:zst",
+}
+
+
+def _mode_from_suffix(name: str) -> Optional[str]:
+    """Returns the write mode for an archive file name from its suffix, or None if the suffix is
+    not recognized."""
+    lower = name.lower()
+    for suffix, mode in _SUFFIX_MODES.items():
+        if lower.endswith(suffix):
+            return mode
+    return None
+
+
+_SORT_RUN_SIZE = 1_000_000
+"""Maximum number of paths that rptar sorts in memory. Longer input lists are sorted in runs of
+this size that are written to temporary files and merged."""
+
+_READ_CHUNK_SIZE = 1024 * 1024
+
+
+def _read_delimited(fp, delimiter: bytes) -> Iterator[str]:
+    """Read names separated by `delimiter` from a binary file object as a stream. Empty names are
+    skipped."""
+    remainder = b""
+    while True:
+        chunk = fp.read(_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        entries = (remainder + chunk).split(delimiter)
+        remainder = entries.pop()
+        for entry in entries:
+            if entry:
+                yield os.fsdecode(entry)
+    if remainder:
+        yield os.fsdecode(remainder)
+
+
+def _sorted_unique(paths: Iterable[Path], run_size: int = _SORT_RUN_SIZE) -> Iterator[Path]:
+    """Sort and deduplicate paths in the same order as sorted(set(paths)), with bounded memory.
+    Sorted runs of up to `run_size` paths are spilled to temporary files and merged, so at most
+    `run_size` paths are held in memory at a time. Paths are compared as Path objects, since their
+    ordering differs from string ordering and between Python versions.
+    """
+    import heapq
+
+    with contextlib.ExitStack() as stack:
+        run_files: List[Path] = []
+        run: List[Path] = []
+        tmpdir = None
+        for path in paths:
+            run.append(path)
+            if len(run) >= run_size:
+                if tmpdir is None:
+                    import tempfile
+
+                    tmpdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="rptar-"))
+                run_file = Path(tmpdir) / f"run{len(run_files):06d}"
+                with run_file.open("wb") as fp:
+                    for p in _unique(sorted(run)):
+                        fp.write(os.fsencode(p) + b"\0")
+                run_files.append(run_file)
+                run = []
+        run.sort()
+        runs: List[Iterable[Path]] = [run]
+        for run_file in run_files:
+            run_fp = stack.enter_context(run_file.open("rb"))
+            runs.append(Path(name) for name in _read_delimited(run_fp, b"\0"))
+        yield from _unique(heapq.merge(*runs))
+
+
+def _unique(sorted_paths: Iterable[Path]) -> Iterator[Path]:
+    """Skip consecutive duplicates of sorted paths."""
+    previous = None
+    for path in sorted_paths:
+        if path != previous:
+            yield path
+            previous = path
+
 
 if __name__ == "__main__":
-    app(prog_name="python -m rptar")
+    main(prog_name="python -m rptar")
@@ -15,3 +15,5 @@ with ReproducibleTarFile.open(example_dir / "archive.tar.gz", "w:gz") as tar:
     tarinfo = TarInfo(name="lore.txt")
     tarinfo.size = stream.getbuffer().nbytes
     tar.addfile(tarinfo, fileobj=stream)
+    # Or add_bytes to add in-memory data directly
+    tar.add_bytes("motto.txt", "so long".encode("utf-8"))
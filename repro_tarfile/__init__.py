@@ -1,17 +1,81 @@
+from array import array
 import builtins
+from collections import namedtuple
 import contextlib
-import copy
-import datetime
-from importlib.metadata import version
 import os
-from tarfile import CompressionError, ReadError, TarFile, TarInfo
+import re
+import stat
+import sys
+from tarfile import (  # type: ignore[attr-defined]
+    BLKTYPE,
+    BLOCKSIZE,
+    CHRTYPE,
+    DIRTYPE,
+    FIFOTYPE,
+    LNKTYPE,
+    NUL,
+    PAX_FORMAT,
+    RECORDSIZE,
+    REGTYPE,
+    SYMTYPE,
+    CompressionError,
+    ReadError,
+    TarError,
+    TarFile,
+    TarInfo,
+    copyfileobj,
+)
+from time import perf_counter
 
-__version__ = version("repro-tarfile")
+
+def __getattr__(name: str) -> str:
+    # Resolve the version lazily, since importing importlib.metadata is slow relative to the rest
+    # of this module and would dominate the startup time of command-line programs
+    if name == "__version__":
+        from importlib.metadata import version
+
+        globals()[name] = version("repro-tarfile")
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+DEFAULT_WRITE_BUFFER_SIZE = 1024 * 1024
+"""Recommended size in bytes of the buffer that ReproducibleTarFile can use to coalesce small
+writes. Buffering is off unless `write_buffer_size` is given."""
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+"""Default size in bytes of the parts that PartUploadSink splits archives into."""
+
+DEFAULT_SPOOL_SIZE = 8 * 1024 * 1024
+"""Default size in bytes above which ReproducibleTarFile.add_many_bytes spools data of unknown
+size to a temporary file instead of memory."""
+
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+"""Default number of bytes of member data that ConcurrentWriter holds while waiting for earlier
+members."""
+
+DEFAULT_SAMPLE_SIZE = 1024 * 1024
+"""Default number of bytes of input that choose_compression_level compresses at each level."""
 
 __all__ = [
     "open",
+    "ArchiveCache",
+    "ArchiveMismatchError",
+    "ArchiveStats",
+    "ConcurrentWriter",
+    "FragmentCache",
+    "HTTPMultipartSink",
+    "IndexEntry",
+    "MemberIndex",
+    "MemberStats",
+    "PartUploadSink",
+    "PathMatcher",
     "ReproducibleTarFile",
     "TarInfo",
+    "VerifySink",
+    "VolumeSink",
+    "build_archives",
+    "choose_compression_level",
 ]
 
 
@@ -23,7 +87,7 @@ def mtime() -> int:
     source_date_epoch = os.environ.get("SOURCE_DATE_EPOCH", None)
     if source_date_epoch is not None:
         return int(source_date_epoch)
-    return int(datetime.datetime(1980, 1, 1, 0, 0, 0, tzinfo=datetime.timezone.utc).timestamp())
+    return 315532800  # 1980-01-01T00:00:00+00:00
 
 
 def file_mode() -> int:
@@ -127,85 +191,4017 @@ def _temporarily_delete_tarfile_attr(tarinfo: TarInfo):
             tarinfo._tarfile = under_tarfile_attr  # type: ignore[attr-defined]
 
 
-class ReproducibleTarFile(TarFile):
-    # Following method modified from Python 3.12
-    # https://github.com/python/cpython/blob/09b8b14e05557304ab12870137181685c2dcbe25/Lib/tarfile.py#L1856-L1887
-    # Copyright Python Software Foundation, licensed under PSF License Version 2
-    # See LICENSE file for full license agreement and notice of copyright
-    @classmethod
-    def gzopen(cls, name, mode="r", fileobj=None, compresslevel=9, **kwargs):
-        """Open gzip compressed tar archive name for reading or writing.
-        Appending is not allowed.
-        """
-        if mode not in ("r", "w", "x"):
-            raise ValueError("mode must be 'r', 'w' or 'x'")
+STATS_PHASES = ("stat", "header", "read", "compress", "write")
+"""Phases of archive writing that are tracked by ArchiveStats:
+
+- stat: getting file-system metadata for a path (TarFile.gettarinfo)
+- header: encoding tar header blocks (TarInfo.tobuf)
+- read: reading member data from the source file object
+- compress: passing the uncompressed tar stream through the compressor, excluding output writes
+- write: writing bytes to the output file
+"""
+
+
+class MemberStats:
+    """Timings (in seconds) and byte counts for each phase of writing a single archive member.
+    Both `seconds` and `nbytes` are dictionaries keyed by the phase names in STATS_PHASES.
+    """
+
+    __slots__ = ("name", "seconds", "nbytes")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.seconds = dict.fromkeys(STATS_PHASES, 0.0)
+        self.nbytes = dict.fromkeys(STATS_PHASES, 0)
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "seconds": dict(self.seconds), "bytes": dict(self.nbytes)}
+
+
+class ArchiveStats:
+    """Collects per-member and aggregate timings and byte counts while writing an archive. Pass
+    an instance as the `stats` argument of ReproducibleTarFile or repro_tarfile.open to enable
+    instrumentation. When no stats object is given, nothing is measured.
+
+    Aggregate values include work that is not attributable to a single member, such as the
+    end-of-archive blocks and flushing the compressor on close. Bytes written while opening the
+    archive, such as the gzip header, are not counted. For stream modes (e.g., 'w|gz'),
+    compression happens inside the stream and is counted as part of 'write'.
+
+    With ReproducibleTarFile.add_paths and more than one job, the stat, header, and read phases
+    are measured in worker processes, and their aggregates are summed over the workers.
+
+    Settings of the archive that are useful to report alongside the statistics, such as the
+    compression level, can be added to the `settings` dictionary, and are included in to_dict
+    and format_table.
+
+    Args:
+        callback: Optional function called with the MemberStats of each member when it has
+            been written.
+        keep_members: Whether to keep the MemberStats of every member in `members`. Set to False
+            for very large archives if you only need aggregates or use a callback.
+    """
+
+    def __init__(self, callback=None, keep_members: bool = True) -> None:
+        self.callback = callback
+        self.keep_members = keep_members
+        self.members: list = []
+        self.member_count = 0
+        self.seconds = dict.fromkeys(STATS_PHASES, 0.0)
+        self.nbytes = dict.fromkeys(STATS_PHASES, 0)
+        self.elapsed = 0.0
+        self.settings: dict = {}
+        self._started: "float | None" = None
+        self._current: "MemberStats | None" = None
+        self._pending_stat = 0.0
+
+    def _record(self, phase: str, seconds: float, nbytes: int, nested_in=None) -> None:
+        """Add a measurement to the aggregates and to the member currently being written. If
+        `nested_in` is given, the time is also subtracted from that phase, because it was
+        measured within it."""
+        self.seconds[phase] += seconds
+        self.nbytes[phase] += nbytes
+        if nested_in is not None:
+            self.seconds[nested_in] -= seconds
+        member = self._current
+        if member is not None:
+            member.seconds[phase] += seconds
+            member.nbytes[phase] += nbytes
+            if nested_in is not None:
+                member.seconds[nested_in] -= seconds
+
+    def _record_stat(self, seconds: float) -> None:
+        # gettarinfo runs before addfile, so hold it for the next member
+        self.seconds["stat"] += seconds
+        self._pending_stat += seconds
+
+    def _start_member(self, name: str) -> None:
+        member = MemberStats(name)
+        member.seconds["stat"] = self._pending_stat
+        self._pending_stat = 0.0
+        self._current = member
+
+    def _resume_member(self, member: MemberStats) -> None:
+        # Members built in worker processes are finished when they are written to the archive
+        self._current = member
+
+    def _merge_shard(self, other: "ArchiveStats") -> None:
+        """Add the stat, header, and read measurements of a shard built by a worker process."""
+        for phase in ("stat", "header", "read"):
+            self.seconds[phase] += other.seconds[phase]
+            self.nbytes[phase] += other.nbytes[phase]
+        for member in other.members:
+            member.seconds["compress"] = member.seconds["write"] = 0.0
+            member.nbytes["compress"] = member.nbytes["write"] = 0
+
+    def _finish_member(self) -> None:
+        member = self._current
+        self._current = None
+        if member is None:
+            return
+        self.member_count += 1
+        if self.keep_members:
+            self.members.append(member)
+        if self.callback is not None:
+            self.callback(member)
+
+    def _instrument(self, tar: "ReproducibleTarFile") -> None:
+        """Wrap the archive's output file objects with timing proxies."""
+        self._started = perf_counter()
+        fileobj = tar.fileobj
+        if getattr(fileobj, "comptype", None) is not None:
+            # tarfile._Stream, used by stream modes like 'w|gz', compresses internally
+            fileobj.fileobj = _TimedWriter(fileobj.fileobj, self, "write")  # type: ignore[attr-defined]
+            return
+        # GzipFile keeps the underlying output file as 'fileobj', BZ2File and LZMAFile as '_fp'
+        compressor = getattr(fileobj, "_gzipfile", fileobj)
+        for attr in ("fileobj", "_fp"):
+            raw = getattr(compressor, attr, None)
+            if raw is not None:
+                setattr(compressor, attr, _TimedWriter(raw, self, "write", nested_in="compress"))
+                tar.fileobj = _TimedWriter(fileobj, self, "compress")
+                return
+        tar.fileobj = _TimedWriter(fileobj, self, "write")
+
+    def _close(self) -> None:
+        if self._started is not None:
+            self.elapsed = perf_counter() - self._started
+
+    def to_dict(self) -> dict:
+        """Returns the collected statistics as a JSON-serializable dictionary."""
+        return {
+            "members": self.member_count,
+            "elapsed": self.elapsed,
+            "phases": {
+                phase: {"seconds": self.seconds[phase], "bytes": self.nbytes[phase]}
+                for phase in STATS_PHASES
+            },
+            "per_member": [member.to_dict() for member in self.members],
+            "settings": self.settings,
+        }
+
+    def format_table(self) -> str:
+        """Returns a plain-text summary table of the aggregate statistics."""
+        lines = [f"{'phase':<10}{'seconds':>12}{'bytes':>16}"]
+        for phase in STATS_PHASES:
+            lines.append(f"{phase:<10}{self.seconds[phase]:>12.6f}{self.nbytes[phase]:>16}")
+        lines.append(f"{'members':<10}{self.member_count:>12}")
+        lines.append(f"{'elapsed':<10}{self.elapsed:>12.6f}")
+        for key, value in self.settings.items():
+            lines.append(f"{key:<10}{value!s:>12}")
+        return "\n".join(lines)
+
+
+class _TimedWriter:
+    """Proxy for a writable file object that records time spent in write, flush, and close
+    calls, and the number of bytes written, to an ArchiveStats object.
+    """
+
+    def __init__(self, fileobj, stats: ArchiveStats, phase: str, nested_in=None) -> None:
+        self._fileobj = fileobj
+        self._stats = stats
+        self._phase = phase
+        self._nested_in = nested_in
+
+    def write(self, data):
+        start = perf_counter()
+        result = self._fileobj.write(data)
+        self._stats._record(self._phase, perf_counter() - start, len(data), self._nested_in)
+        return result
+
+    def flush(self):
+        start = perf_counter()
+        self._fileobj.flush()
+        self._stats._record(self._phase, perf_counter() - start, 0, self._nested_in)
+
+    def close(self):
+        start = perf_counter()
+        self._fileobj.close()
+        self._stats._record(self._phase, perf_counter() - start, 0, self._nested_in)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+class _TimedReader:
+    """Proxy for a readable file object that records time spent in read calls, and the number of
+    bytes read, to an ArchiveStats object.
+    """
+
+    def __init__(self, fileobj, stats: ArchiveStats) -> None:
+        self._fileobj = fileobj
+        self._stats = stats
+
+    def read(self, size=-1):
+        start = perf_counter()
+        data = self._fileobj.read(size)
+        self._stats._record("read", perf_counter() - start, len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+class _WriteBuffer:
+    """Proxy for a writable file object that gathers small writes into a reusable buffer and
+    passes them on in large writes. Writes at least as large as the buffer are passed through
+    directly after flushing what is buffered, so the bytes written are unchanged.
+    """
+
+    def __init__(self, fileobj, size: int) -> None:
+        self._fileobj = fileobj
+        self._buffer = bytearray(size)
+        self._size = size
+        self._pos = 0
+
+    def write(self, data):
+        n = len(data)
+        pos = self._pos
+        if pos + n > self._size:
+            self.flush_buffer()
+            pos = 0
+            if n >= self._size:
+                self._fileobj.write(data)
+                return n
+        self._buffer[pos : pos + n] = data
+        self._pos = pos + n
+        return n
+
+    def flush_buffer(self) -> None:
+        """Write out buffered data to the underlying file object without flushing it."""
+        if self._pos:
+            with memoryview(self._buffer) as view:
+                self._fileobj.write(view[: self._pos])
+            self._pos = 0
+
+    def flush(self):
+        self.flush_buffer()
+        self._fileobj.flush()
+
+    def tell(self):
+        return self._fileobj.tell() + self._pos
 
+    def close(self):
         try:
-            from gzip import GzipFile
-        except ImportError:
-            raise CompressionError("gzip module is not available") from None
+            self.flush_buffer()
+        finally:
+            self._fileobj.close()
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+IO_POLICIES = (None, "stream")
+
+_READAHEAD_SIZE = 8 * 1024 * 1024
+"""Number of bytes ahead of reads of input files that the "stream" I/O policy asks the kernel to
+read, and how often it drops the pages that were read."""
+
+_SYNC_SIZE = 64 * 1024 * 1024
+"""Number of bytes written to the output file between syncs with the "stream" I/O policy."""
 
+
+class _StreamIOPolicy:
+    """Implements the "stream" I/O policy of ReproducibleTarFile, which keeps archiving from
+    filling the page cache with data that won't be used again. Input files are read with
+    sequential readahead and dropped from the page cache when their member is written, and the
+    written part of the output file is periodically synced and dropped. Uses os.posix_fadvise,
+    so it only has an effect on platforms that have it.
+    """
+
+    def __init__(self, output) -> None:
+        # Output can be a compressor or a file object that isn't a regular file
+        self._fd = None
         try:
-            ## repro-tarfile MODIFIED ##
-            # Overwrite filename and mtime when initializing GzipFile
-            if fileobj is None:
-                fileobj = builtins.open(name, mode + "b")
-            fileobj = GzipFile("", mode + "b", compresslevel, fileobj, mtime=mtime())
-            #########################
-        except OSError as e:
-            if fileobj is not None and mode == "r":
-                raise ReadError("not a gzip file") from e
-            raise
+            fd = output.fileno()
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                self._synced = os.lseek(fd, 0, os.SEEK_CUR)
+                self._fd = fd
+        except (AttributeError, OSError):
+            pass
 
+    def open_input(self, fileobj):
+        """Returns a proxy for reading a member's data from `fileobj` with readahead."""
         try:
-            t = cls.taropen(name, mode, fileobj, **kwargs)
-        except OSError as e:
-            fileobj.close()
-            if mode == "r":
-                raise ReadError("not a gzip file") from e
-            raise
-        except:
-            fileobj.close()
-            raise
-        t._extfileobj = False
-        return t
+            fd = fileobj.fileno()
+            start = fileobj.tell()
+        except (AttributeError, OSError):
+            return fileobj
+        return _AdvisedReader(fileobj, fd, start, self)
 
-    def addfile(self, tarinfo: TarInfo, fileobj=None) -> None:
-        """Add the TarInfo object `tarinfo' to the archive. If `fileobj' is
-        given, it should be a binary file, and tarinfo.size bytes are read
-        from it and added to the archive. You can create TarInfo objects
-        directly, or by using gettarinfo().
+    def member_end(self, fileobj) -> None:
+        """Drop the data of the member that was just written, and sync the output file."""
+        if isinstance(fileobj, _AdvisedReader):
+            fileobj.drop()
+        self.sync_output()
+
+    def sync_output(self) -> None:
+        """Sync and drop the written part of the output file if enough was written since the last
+        sync."""
+        fd = self._fd
+        if fd is None:
+            return
+        position = os.lseek(fd, 0, os.SEEK_CUR)
+        if position - self._synced >= _SYNC_SIZE:
+            # Pages must be written back before they can be dropped
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, self._synced, position - self._synced, os.POSIX_FADV_DONTNEED)
+            self._synced = position
+
+
+class _AdvisedReader:
+    """Proxy for a readable file object for the "stream" I/O policy. Asks the kernel to read ahead
+    of the reads, and drops pages that were read from the page cache as reading goes on, so that
+    large files don't fill it.
+    """
+
+    def __init__(self, fileobj, fd: int, start: int, policy: _StreamIOPolicy) -> None:
+        self._fileobj = fileobj
+        self._fd = fd
+        self._policy = policy
+        self._position = start
+        self._advised = start
+        self._dropped = start
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self._read_ahead()
+
+    def _read_ahead(self) -> None:
+        while self._advised < self._position + _READAHEAD_SIZE:
+            os.posix_fadvise(self._fd, self._advised, _READAHEAD_SIZE, os.POSIX_FADV_WILLNEED)
+            self._advised += _READAHEAD_SIZE
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._position += len(data)
+        self._read_ahead()
+        if self._position - self._dropped >= _READAHEAD_SIZE:
+            length = self._position - self._dropped
+            os.posix_fadvise(self._fd, self._dropped, length, os.POSIX_FADV_DONTNEED)
+            self._dropped = self._position
+            # Large members are written while they are read, so sync the output as they go
+            self._policy.sync_output()
+        return data
+
+    def drop(self) -> None:
+        """Drop all pages of the file from the page cache."""
+        os.posix_fadvise(self._fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+class _HeaderEncoder:
+    """Encodes headers of members from a precomputed template of the fields that are the same for
+    all members written by ReproducibleTarFile, patching only the name, size, type, and link name
+    and adding their bytes to the precomputed partial checksum. The result is byte-for-byte
+    identical to TarInfo.tobuf, which is used instead for members that need an extended header,
+    such as long or non-ASCII names in pax format, and for anything else unusual.
+
+    Templates are created by encoding a prototype member with TarInfo.tobuf, so they follow the
+    tarfile version in use, and are cached by format and values of the constant fields.
+    """
+
+    _TYPES = frozenset((REGTYPE, DIRTYPE, SYMTYPE, LNKTYPE))
+    _MAX_SIZE = 8**11
+
+    def __init__(self) -> None:
+        self._templates: dict = {}
+
+    def _template(self, key):
+        format, encoding, errors, mode, mtime, uid, gid, uname, gname = key
+        prototype = TarInfo()
+        prototype.mode = mode
+        prototype.mtime = mtime
+        prototype.uid = uid
+        prototype.gid = gid
+        prototype.uname = uname
+        prototype.gname = gname
+        try:
+            buf = prototype.tobuf(format, encoding, errors)
+        except (ValueError, UnicodeError):
+            buf = b""
+        if len(buf) != BLOCKSIZE:
+            # The constant fields need an extended header, so use tobuf for every member
+            return None
+        # Checksum of the constant fields, with the checksum field counted as spaces
+        constant = bytearray(buf)
+        constant[0:100] = bytes(100)
+        constant[124:136] = bytes(12)
+        constant[148:156] = b" " * 8
+        constant[156:257] = bytes(101)
+        return buf[100:124], buf[136:148], buf[257:], sum(constant)
+
+    def encode(self, tarinfo: TarInfo, format, encoding: str, errors: str) -> bytes:
+        """Returns the header of tarinfo, like tarinfo.tobuf(format, encoding, errors)."""
+        try:
+            size = tarinfo.size
+            mtime = tarinfo.mtime
+            uid = tarinfo.uid
+            gid = tarinfo.gid
+            # Floats and other types can need pax headers or encode differently
+            if (
+                tarinfo.__class__ is TarInfo
+                and tarinfo.type in self._TYPES
+                and not tarinfo.pax_headers
+                and not tarinfo.devmajor
+                and not tarinfo.devminor
+                and size.__class__ is int
+                and 0 <= size < self._MAX_SIZE
+                and mtime.__class__ is int
+                and uid.__class__ is int
+                and gid.__class__ is int
+            ):
+                key = (
+                    format,
+                    encoding,
+                    errors,
+                    tarinfo.mode & 0o7777,
+                    mtime,
+                    uid,
+                    gid,
+                    tarinfo.uname,
+                    tarinfo.gname,
+                )
+                templates = self._templates
+                if key in templates:
+                    template = templates[key]
+                else:
+                    template = templates[key] = self._template(key)
+                if template is not None:
+                    name = tarinfo.name
+                    if tarinfo.type == DIRTYPE and not name.endswith("/"):
+                        name += "/"
+                    if format == PAX_FORMAT:
+                        # Names that aren't ASCII go in a pax header
+                        name_bytes = name.encode("ascii")
+                        linkname_bytes = tarinfo.linkname.encode("ascii")
+                    else:
+                        name_bytes = name.encode(encoding, errors)
+                        linkname_bytes = tarinfo.linkname.encode(encoding, errors)
+                    if len(name_bytes) <= 100 and len(linkname_bytes) <= 100:
+                        ids, mtime_field, tail, checksum = template
+                        size_field = b"%011o\0" % size
+                        checksum += (
+                            sum(name_bytes)
+                            + sum(size_field)
+                            + tarinfo.type[0]
+                            + sum(linkname_bytes)
+                        )
+                        return b"".join(
+                            (
+                                name_bytes,
+                                bytes(100 - len(name_bytes)),
+                                ids,
+                                size_field,
+                                mtime_field,
+                                b"%06o\0 " % checksum,
+                                tarinfo.type,
+                                linkname_bytes,
+                                bytes(100 - len(linkname_bytes)),
+                                tail,
+                            )
+                        )
+        except (AttributeError, TypeError, UnicodeError):
+            pass
+        return tarinfo.tobuf(format, encoding, errors)
+
+
+class PathMatcher:
+    """Selects paths using gitignore-style patterns. Patterns are compiled once when the matcher is
+    created, so matching is cheap. Pass a PathMatcher as the `matcher` argument of
+    ReproducibleTarFile.add, or use its walk method, to prune excluded directories while walking
+    a directory tree so that their contents are never read.
+
+    Paths are matched relative to the top of the walk, using '/' as the separator, and the top
+    itself is matched by its base name. The pattern syntax follows gitignore:
+
+    - Blank lines and lines starting with '#' are ignored.
+    - '*' matches anything except '/', '?' matches any one character except '/', and '[...]'
+      matches one character in a range.
+    - A leading '**/' matches in all directories, a trailing '/**' matches everything inside,
+      and '/**/' matches zero or more directories.
+    - A pattern with a '/' at the start or in the middle is matched relative to the top of the
+      walk. Otherwise, it matches at any depth.
+    - A pattern ending with '/' only matches directories.
+    - A pattern starting with '!' re-includes paths excluded by earlier patterns. The last
+      matching pattern wins. Paths inside an excluded directory can't be re-included.
+
+    Args:
+        exclude: Patterns of paths to leave out. Everything inside an excluded directory is also
+            left out.
+        include: Patterns of paths to keep. If given, only matching paths are selected.
+            Directories are still walked when they don't match, so matching paths inside them
+            are found.
+    """
+
+    def __init__(self, exclude=(), include=()) -> None:
+        self.exclude = [pattern for pattern in exclude if _is_pattern(pattern)]
+        self.include = [pattern for pattern in include if _is_pattern(pattern)]
+        self._exclude_groups = _compile_patterns(self.exclude)
+        self._include_groups = _compile_patterns(self.include) if self.include else None
+
+    def __repr__(self) -> str:
+        return f"PathMatcher(exclude={self.exclude!r}, include={self.include!r})"
+
+    def _excluded(self, path: str, is_dir: bool) -> bool:
+        return _match_groups(self._exclude_groups, path, is_dir)
+
+    def _included(self, path: str, is_dir: bool) -> bool:
+        groups = self._include_groups
+        return groups is None or _match_groups(groups, path, is_dir)
+
+    def match(self, path: str, is_dir: bool = False) -> bool:
+        """Returns whether the relative path is selected: it is not excluded, is not inside an
+        excluded directory, and matches the include patterns if there are any.
         """
-        if tarinfo.isdir():
-            mode = 0o40000 | dir_mode()
+        parts = path.replace(os.sep, "/").strip("/").split("/")
+        for i in range(1, len(parts)):
+            if self._excluded("/".join(parts[:i]), True):
+                return False
+        path = "/".join(parts)
+        return not self._excluded(path, is_dir) and self._included(path, is_dir)
+
+    def walk(self, top, recursive: bool = True, follow_symlinks: bool = False):
+        """Yields `top` and, if it is a directory, the paths inside it that are selected, in the
+        same order as TarFile.add adds them. Excluded directories are not read.
+
+        Args:
+            top: Path to start walking from.
+            recursive: Whether to walk into directories.
+            follow_symlinks: Whether to walk into symbolic links to directories.
+        """
+        top = os.fspath(top)
+        if follow_symlinks:
+            is_dir = os.path.isdir(top)
         else:
-            mode = 0o100000 | file_mode()
-        # See docstring for _temporarily_delete_tarfile_attr for why we need to do this.
-        with _temporarily_delete_tarfile_attr(tarinfo):
+            is_dir = os.path.isdir(top) and not os.path.islink(top)
+        name = os.path.basename(os.path.normpath(top))
+        if self._excluded(name, is_dir):
+            return
+        if self._included(name, is_dir):
+            yield top
+        if is_dir and recursive:
+            yield from self._walk_dir(top, "", follow_symlinks)
+
+    def _walk_dir(self, path, prefix: str, follow_symlinks: bool):
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            relpath = prefix + entry.name
+            is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+            if self._excluded(relpath, is_dir):
+                continue
+            if self._included(relpath, is_dir):
+                yield entry.path
+            if is_dir:
+                yield from self._walk_dir(entry.path, relpath + "/", follow_symlinks)
+
+
+def _is_pattern(line: str) -> bool:
+    return bool(line.strip()) and not line.startswith("#")
+
+
+def _compile_patterns(patterns) -> list:
+    """Compile gitignore-style patterns into groups of consecutive patterns with the same
+    negation. Each group is a tuple of (negate, regex for any path, regex for directories only),
+    so that matching takes one regex search per group rather than one per pattern.
+    """
+    groups: list = []
+    for pattern in patterns:
+        negate, regex, dir_only = _translate_pattern(pattern)
+        if not groups or groups[-1][0] != negate:
+            groups.append((negate, [], []))
+        groups[-1][2 if dir_only else 1].append(regex)
+    return [
+        (
+            negate,
+            re.compile("|".join(any_regexes)) if any_regexes else None,
+            re.compile("|".join(dir_regexes)) if dir_regexes else None,
+        )
+        for negate, any_regexes, dir_regexes in groups
+    ]
+
+
+def _match_groups(groups, path: str, is_dir: bool) -> bool:
+    # Last matching pattern wins
+    for negate, any_regex, dir_regex in reversed(groups):
+        if (any_regex is not None and any_regex.fullmatch(path)) or (
+            is_dir and dir_regex is not None and dir_regex.fullmatch(path)
+        ):
+            return not negate
+    return False
+
+
+def _translate_pattern(pattern: str):
+    """Translate a gitignore-style pattern to a regular expression. Returns a tuple of whether
+    the pattern is negated, the regular expression, and whether it only matches directories.
+    """
+    # Trailing spaces are ignored unless escaped
+    pattern = pattern.rstrip("\r\n")
+    while pattern.endswith(" ") and not pattern.endswith("\\ "):
+        pattern = pattern[:-1]
+    negate = pattern.startswith("!")
+    if negate:
+        pattern = pattern[1:]
+    elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+
+    parts = [] if anchored else ["(?:.*/)?"]
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/"):
+                if i + 2 == n:
+                    parts.append(".*")
+                    i += 2
+                    continue
+                if pattern[i + 2] == "/":
+                    parts.append("(?:.*/)?")
+                    i += 3
+                    continue
+            while i < n and pattern[i] == "*":
+                i += 1
+            parts.append("[^/]*")
+            continue
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                parts.append("\\[")
+            else:
+                chars = pattern[i + 1 : j].replace("\\", "\\\\")
+                if chars[0] in "!^":
+                    chars = "^/" + chars[1:]
+                parts.append(f"[{chars}]")
+                i = j
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return negate, "(?:" + "".join(parts) + ")", dir_only
+
+
+IndexEntry = namedtuple("IndexEntry", ["name", "offset", "offset_data", "size"])
+IndexEntry.__doc__ = """Entry of a MemberIndex: the name of a member, the offsets of its header
+and data in the uncompressed tar stream, and its data size."""
+
+
+class MemberIndex:
+    """Compact index of the members written to an archive, used in place of a list of TarInfo
+    objects by ReproducibleTarFile with keep_members=False. Names and offsets are packed into
+    arrays, which take around 30 bytes per member plus the encoded name, rather than the few
+    hundred bytes of a TarInfo object with its attributes. Indexing and iterating give
+    IndexEntry tuples.
+    """
+
+    def __init__(self) -> None:
+        self._names = bytearray()
+        self._name_ends = array("q")
+        self._offsets = array("q")
+        self._offsets_data = array("q")
+        self._sizes = array("q")
+
+    def _append(self, name: str, offset: int, offset_data: int, size: int) -> None:
+        self._names += name.encode("utf-8", "surrogateescape")
+        self._name_ends.append(len(self._names))
+        self._offsets.append(offset)
+        self._offsets_data.append(offset_data)
+        self._sizes.append(size)
+
+    def _extend(self, other: "MemberIndex", shift: int) -> None:
+        """Append the entries of another index, with offsets shifted by `shift` bytes."""
+        name_shift = len(self._names)
+        self._names += other._names
+        self._name_ends.extend(end + name_shift for end in other._name_ends)
+        self._offsets.extend(offset + shift for offset in other._offsets)
+        self._offsets_data.extend(offset + shift for offset in other._offsets_data)
+        self._sizes.extend(other._sizes)
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def __getitem__(self, index: int) -> IndexEntry:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("MemberIndex index out of range")
+        start = self._name_ends[index - 1] if index else 0
+        name = self._names[start : self._name_ends[index]].decode("utf-8", "surrogateescape")
+        return IndexEntry(
+            name, self._offsets[index], self._offsets_data[index], self._sizes[index]
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def names(self):
+        """Returns a list of the member names."""
+        return [entry.name for entry in self]
+
+
+class _RsyncableGzipWriter:
+    """File object that passes the tar stream on to a GzipFile and ends the compressed block at
+    content-defined boundaries, like `gzip --rsyncable`. Deflate only refers back 32 KiB, so
+    compressed bytes after a boundary only depend on the data since 32 KiB before it, and
+    unchanged regions of the tar stream give unchanged compressed bytes. Used by
+    ReproducibleTarFile.gzopen.
+
+    To find boundaries with C-speed bytes methods, each byte of the stream is mapped to a bit by
+    a fixed table, and every occurrence of a fixed bit pattern is a candidate. A candidate is a
+    boundary if the CRC-32 of the 64 bytes that end at it has its low 5 bits clear, which is
+    about every 8 KiB. The pattern has no overlap with itself, so boundaries don't depend on how
+    the stream is split into writes. The table, pattern, and boundary test must never change,
+    since they determine the archive bytes.
+    """
+
+    _PATTERN = b"10110100"
+    _WINDOW = 64
+    _MASK = 0x1F
+
+    def __init__(self, gzipfile) -> None:
+        import zlib
+
+        self._gzipfile = gzipfile
+        self._crc32 = zlib.crc32
+        self._sync_flush = zlib.Z_SYNC_FLUSH
+        self._table = bytes(0x31 if zlib.crc32(bytes([i])) & 1 else 0x30 for i in range(256))
+        # End of the stream, for candidates and windows that span writes
+        self._tail = b""
+
+    @property
+    def closed(self) -> bool:
+        return self._gzipfile.closed
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        size = len(data)
+        pattern = self._PATTERN
+        window = self._WINDOW
+        buffer = self._tail + data
+        bits = buffer.translate(self._table)
+        # Offset of data in buffer, which is also where candidates that weren't checked yet end
+        shift = len(self._tail)
+        gzipfile = self._gzipfile
+        view = memoryview(buffer)
+        start = shift
+        i = bits.find(pattern, max(0, shift - len(pattern) + 1))
+        while i >= 0:
+            end = i + len(pattern)
+            if end >= window and self._crc32(view[end - window : end]) & self._MASK == 0:
+                gzipfile.write(view[start:end])
+                gzipfile.flush(self._sync_flush)
+                start = end
+            i = bits.find(pattern, end)
+        if start < len(buffer):
+            gzipfile.write(view[start:])
+        self._tail = buffer[-(window - 1) :]
+        return size
+
+    def flush(self) -> None:
+        self._gzipfile.flush()
+
+    def tell(self) -> int:
+        return self._gzipfile.tell()
+
+    def close(self) -> None:
+        self._gzipfile.close()
+
+
+class _TeeWriter:
+    """File object that passes everything written to it to several outputs, each compressed and
+    written by its own worker thread. Used by ReproducibleTarFile.teeopen.
+    """
+
+    def __init__(self, outputs) -> None:
+        self._outputs = outputs
+        self._offset = 0
+        self.closed = False
+
+    def write(self, data):
+        # Copy once, since callers may reuse the buffer, and share the copy between outputs
+        chunk = bytes(data)
+        for output in self._outputs:
+            output.put(chunk)
+        self._offset += len(chunk)
+        return len(chunk)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self._offset
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        error = None
+        for output in self._outputs:
             try:
-                tarinfo_copy = tarinfo.replace(
-                    mtime=mtime(),
-                    mode=mode,
-                    uid=uid(),
-                    gid=gid(),
-                    uname=uname(),
-                    gname=gname(),
-                    deep=True,
+                output.close()
+            except BaseException as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+
+class _TeeOutput:
+    """One output of a _TeeWriter: a compressor and file written by a worker thread that takes
+    chunks from a bounded queue."""
+
+    _QUEUE_SIZE = 16
+
+    def __init__(self, compressor, raw, close_raw: bool) -> None:
+        import queue
+        import threading
+
+        self._compressor = compressor
+        self._raw = raw
+        self._close_raw = close_raw
+        self._queue: "queue.Queue[bytes | None]" = queue.Queue(self._QUEUE_SIZE)
+        self._error: "BaseException | None" = None
+        self._thread = threading.Thread(target=self._run, name="repro-tarfile-tee", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        write = self._compressor.write
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            if self._error is None:
+                try:
+                    write(chunk)
+                except BaseException as e:
+                    # Keep draining the queue so the writer doesn't block
+                    self._error = e
+
+    def put(self, chunk: bytes) -> None:
+        if self._error is not None:
+            raise self._error
+        self._queue.put(chunk)
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            if self._error is not None:
+                raise self._error
+            if self._compressor is not self._raw:
+                self._compressor.close()
+        finally:
+            if self._close_raw:
+                self._raw.close()
+
+
+class _FragmentBoundaries:
+    """Chooses the member ends where fragments end in gzip fragment mode. A member ends a fragment
+    with probability proportional to its size, decided by the CRC-32 of its header, so that
+    fragments average `fragment_size` bytes and the choice for each member doesn't depend on the
+    members before it. Changing a member only changes the fragments around it."""
+
+    def __init__(self, fragment_size: int) -> None:
+        from collections import deque
+
+        self.fragment_size = fragment_size
+        self.ends: deque = deque()
+
+    def member_end(self, header: bytes, start: int, end: int) -> None:
+        import zlib
+
+        if zlib.crc32(header) * self.fragment_size < (end - start) << 32:
+            self.ends.append(end)
+
+
+class _FragmentGzipWriter:
+    """Writable file object for gzip fragment mode. Compresses runs of members, ending where
+    _FragmentBoundaries chooses, as independent gzip members, which are valid when concatenated.
+    Fragments are looked up in a FragmentCache, if given, by the SHA-256 of their uncompressed
+    bytes and the compression settings, so unchanged fragments are copied from the cache instead
+    of compressed."""
+
+    _SPOOL_SIZE = 16 * 1024 * 1024
+    _COPY_BUFSIZE = 1024 * 1024
+
+    def __init__(
+        self, fileobj, compresslevel: int, fragment_size: int, cache, close_fileobj: bool
+    ) -> None:
+        import zlib
+
+        # Named like GzipFile's attribute for the output, for ArchiveStats instrumentation
+        self.fileobj = fileobj
+        self.boundaries = _FragmentBoundaries(fragment_size)
+        self.closed = False
+        self._compresslevel = compresslevel
+        self._cache = cache
+        self._close_fileobj = close_fileobj
+        self._mtime = mtime()
+        self._settings = b"gzip %d %d %s\n" % (
+            compresslevel,
+            self._mtime,
+            zlib.ZLIB_RUNTIME_VERSION.encode("ascii"),
+        )
+        self._position = 0
+        self._fragment_start = 0
+        self._spool, self._hash = self._new_fragment()
+
+    def _new_fragment(self):
+        import hashlib
+        import tempfile
+
+        return (
+            tempfile.SpooledTemporaryFile(max_size=self._SPOOL_SIZE),
+            hashlib.sha256(self._settings),
+        )
+
+    def _append(self, data) -> None:
+        self._spool.write(data)
+        self._hash.update(data)
+        self._position += len(data)
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        with memoryview(data) as view, view.cast("B") as view:
+            ends = self.boundaries.ends
+            start = 0
+            size = len(view)
+            while ends and ends[0] - self._position <= size - start:
+                cut = start + max(0, ends.popleft() - self._position)
+                if cut > start:
+                    self._append(view[start:cut])
+                start = cut
+                self._finish_fragment()
+            if start < size:
+                self._append(view[start:])
+        return size
+
+    def _finish_fragment(self) -> None:
+        if self._position == self._fragment_start:
+            return
+        spool, hash = self._spool, self._hash
+        self._spool, self._hash = self._new_fragment()
+        self._fragment_start = self._position
+        with spool:
+            spool.seek(0)
+            key = hash.hexdigest()
+            cache = self._cache
+            if cache is None:
+                self._compress(spool, self.fileobj)
+                return
+            cached = cache._open(key)
+            if cached is None:
+                cache.misses += 1
+                with cache._store(key) as out:
+                    self._compress(spool, out)
+                cached = cache._open(key)
+            else:
+                cache.hits += 1
+            with cached:
+                copyfileobj(cached, self.fileobj, bufsize=self._COPY_BUFSIZE)
+
+    def _compress(self, spool, out) -> None:
+        from gzip import GzipFile
+
+        with GzipFile("", "wb", self._compresslevel, out, mtime=self._mtime) as gzipfile:
+            copyfileobj(spool, gzipfile, bufsize=self._COPY_BUFSIZE)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        self.fileobj.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._finish_fragment()
+        finally:
+            self._spool.close()
+            if self._close_fileobj:
+                self.fileobj.close()
+
+
+_INCOMPRESSIBLE_SUFFIXES = frozenset(
+    {
+        ".7z", ".avif", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jar",
+        ".jpeg", ".jpg", ".lz4", ".lzma", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg",
+        ".parquet", ".png", ".pptx", ".rar", ".tgz", ".txz", ".webm", ".webp", ".whl",
+        ".woff2", ".xlsx", ".xz", ".zip", ".zst",
+    }
+)  # fmt: skip
+"""Suffixes of file formats that are already compressed."""
+
+_SEGMENT_MIN_SIZE = 64 * 1024
+"""Members smaller than this many bytes are always compressed normally, since a separate segment
+costs more than it saves."""
+
+_SEGMENT_SAMPLE_SIZE = 64 * 1024
+_INCOMPRESSIBLE_RATIO = 0.95
+"""Members whose sample compresses to more than this fraction of its size with the fastest zlib
+level are incompressible."""
+
+
+def _read_member_sample(data, size: int):
+    """Returns up to _SEGMENT_SAMPLE_SIZE bytes from the middle of the data of a member, from a
+    memoryview or a seekable file object positioned at its start, or None if it can't be read
+    without consuming the data."""
+    start = max(0, (size - _SEGMENT_SAMPLE_SIZE) // 2)
+    if isinstance(data, memoryview):
+        return data[start : start + _SEGMENT_SAMPLE_SIZE].tobytes()
+    seekable = getattr(data, "seekable", None)
+    if seekable is None or not seekable():
+        return None
+    position = data.tell()
+    data.seek(position + start)
+    sample = data.read(_SEGMENT_SAMPLE_SIZE)
+    data.seek(position)
+    return sample
+
+
+class _SegmentRanges:
+    """Records the ranges of the tar stream holding the data of incompressible members, for
+    _SegmentedWriter. Members are incompressible if their name has the suffix of a compressed
+    file format, or if a sample from the middle of their data doesn't shrink with the fastest zlib
+    level, so the ranges only depend on the names and contents of the members."""
+
+    def __init__(self) -> None:
+        from collections import deque
+
+        self.ranges: deque = deque()
+
+    def incompressible(self, name: str, size: int, data) -> bool:
+        import zlib
+
+        if size < _SEGMENT_MIN_SIZE:
+            return False
+        if os.path.splitext(name)[1].lower() in _INCOMPRESSIBLE_SUFFIXES:
+            return True
+        sample = _read_member_sample(data, size)
+        if not sample:
+            return False
+        return len(zlib.compress(sample, 1)) > len(sample) * _INCOMPRESSIBLE_RATIO
+
+    def add(self, start: int, size: int) -> None:
+        """Record the data of a member that starts at offset `start` of the tar stream."""
+        self.ranges.append((start, start + -(-size // BLOCKSIZE) * BLOCKSIZE))
+
+
+class _StoredGzipWriter:
+    """Writes a gzip member of stored deflate blocks of a fixed size. Unlike zlib at level 0, the
+    output doesn't depend on how the data is split into writes."""
+
+    _BLOCK_SIZE = 0xFFFF
+
+    def __init__(self, fileobj) -> None:
+        import struct
+
+        self._fileobj = fileobj
+        self._buffer = bytearray()
+        self._crc = 0
+        self._size = 0
+        # Same header as GzipFile with an empty filename
+        fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<L", mtime()) + b"\x00\xff")
+
+    def _block(self, data, final: bool) -> bytes:
+        import struct
+
+        return struct.pack("<BHH", final, len(data), len(data) ^ 0xFFFF) + data
+
+    def write(self, data) -> int:
+        import zlib
+
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        buffer = self._buffer
+        buffer += data
+        block_size = self._BLOCK_SIZE
+        if len(buffer) >= block_size:
+            end = len(buffer) - len(buffer) % block_size
+            self._fileobj.write(
+                b"".join(
+                    self._block(buffer[i : i + block_size], False)
+                    for i in range(0, end, block_size)
                 )
-            except AttributeError as e:
-                # Some older versions of Python don't have replace method
-                # Added in: 3.8.17, 3.9.17, 3.10.12, 3.11.4, 3.12
-                if "'TarInfo' object has no attribute 'replace'" in str(e):
-                    tarinfo_copy = copy.deepcopy(tarinfo)
-                    tarinfo_copy.mtime = mtime()
-                    tarinfo_copy.mode = mode
-                    tarinfo_copy.uid = uid()
-                    tarinfo_copy.gid = gid()
-                    tarinfo_copy.uname = uname()
-                    tarinfo_copy.gname = gname()
+            )
+            del buffer[:end]
+        return len(data)
+
+    def close(self) -> None:
+        import struct
+
+        self._fileobj.write(
+            self._block(self._buffer, True)
+            + struct.pack("<LL", self._crc, self._size & 0xFFFFFFFF)
+        )
+        self._buffer = bytearray()
+
+
+class _SegmentedWriter:
+    """Writable file object for gzip or xz archives with incompressible members stored as is.
+    The ranges in `ranges` are written as separate gzip members with stored blocks, or xz streams
+    with the fastest preset, and the rest of the tar stream with the given level, which are valid
+    when concatenated."""
+
+    def __init__(self, fileobj, comptype: str, level, close_fileobj: bool) -> None:
+        # Named like GzipFile's attribute for the output, for ArchiveStats instrumentation
+        self.fileobj = fileobj
+        self.ranges = _SegmentRanges()
+        self.closed = False
+        self._comptype = comptype
+        self._level = level
+        self._close_fileobj = close_fileobj
+        self._position = 0
+        self._compressor = None
+        self._incompressible = False
+
+    def _switch(self, incompressible: bool) -> None:
+        if self._compressor is not None:
+            if self._incompressible == incompressible:
+                return
+            self._compressor.close()
+        if self._comptype == "gz" and incompressible:
+            self._compressor = _StoredGzipWriter(self.fileobj)  # type: ignore[assignment]
+        elif self._comptype == "gz":
+            from gzip import GzipFile
+
+            self._compressor = GzipFile(  # type: ignore[assignment]
+                "", "wb", self._level, self.fileobj, mtime=mtime()
+            )
+        else:
+            from lzma import LZMAFile
+
+            preset = 0 if incompressible else self._level
+            self._compressor = LZMAFile(  # type: ignore[assignment]
+                self.fileobj, "w", preset=preset
+            )
+        self._incompressible = incompressible
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        ranges = self.ranges.ranges
+        with memoryview(data) as view, view.cast("B") as view:
+            start = 0
+            size = len(view)
+            while start < size:
+                while ranges and ranges[0][1] <= self._position:
+                    ranges.popleft()
+                if ranges and ranges[0][0] <= self._position:
+                    incompressible, stop = True, ranges[0][1]
+                else:
+                    incompressible, stop = False, ranges[0][0] if ranges else None
+                end = size if stop is None else min(size, start + stop - self._position)
+                self._switch(incompressible)
+                self._compressor.write(view[start:end])  # type: ignore[attr-defined]
+                self._position += end - start
+                start = end
+        return size
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        self.fileobj.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._compressor is None:
+                self._switch(False)
+            self._compressor.close()  # type: ignore[attr-defined]
+        finally:
+            if self._close_fileobj:
+                self.fileobj.close()
+
+
+class FragmentCache:
+    """Content-addressed cache of compressed fragments for gzip fragment mode, stored as files in
+    `directory`. Pass it as the `fragment_cache` argument when opening a gzip archive with a
+    `fragment_size` to compress only the fragments that changed since an earlier build. Fragments
+    are named by the SHA-256 of their uncompressed bytes and the compression settings, and are
+    written to a temporary file that is renamed into place, so concurrent builds can share a
+    cache. Fragments are never removed; delete the directory to clear the cache.
+
+    Attributes:
+        directory: Path of the cache directory.
+        hits: Number of fragments copied from the cache.
+        misses: Number of fragments that were compressed and added to the cache.
+    """
+
+    def __init__(self, directory) -> None:
+        self.directory = os.fspath(directory)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        """Returns the path of the fragment with the given key."""
+        return os.path.join(self.directory, key[:2], key[2:] + ".gz")
+
+    def _open(self, key: str):
+        try:
+            return builtins.open(self.path(key), "rb")
+        except FileNotFoundError:
+            return None
+
+    @contextlib.contextmanager
+    def _store(self, key: str):
+        import tempfile
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with builtins.open(fd, "wb") as fp:
+                yield fp
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+class ArchiveCache:
+    """Cache of compressed archives, stored as files in `directory`. Pass it as the
+    `archive_cache` argument of repro_tarfile.open to copy an archive from the cache instead of
+    compressing it again when an earlier build, possibly by another process, wrote an archive with
+    the same contents and settings.
+
+    Archives are grouped by the SHA-256 of the first megabyte of the uncompressed tar stream
+    together with the compression settings, SOURCE_DATE_EPOCH, the versions of Python and zlib,
+    and a fingerprint of the compression library, and named within their group by the SHA-256 of
+    the whole tar stream, which covers the ordered members, their contents, and the fixed metadata
+    values. Archives are written to a temporary file that is renamed into place, so concurrent
+    builds can share a cache. If `max_size` is given, the least recently used archives are removed
+    after adding an archive until the cache is at most that many bytes.
+
+    Attributes:
+        directory: Path of the cache directory.
+        max_size: Maximum total size in bytes of the cached archives, or None for no limit.
+        hits: Number of archives copied from the cache.
+        misses: Number of archives that were compressed and added to the cache.
+    """
+
+    _STALE_SECONDS = 24 * 60 * 60
+    """Age after which temporary files left by interrupted builds are removed."""
+
+    def __init__(self, directory, max_size=None) -> None:
+        self.directory = os.fspath(directory)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        """Returns the path of the archive with the given key."""
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def _keys(self, group: str) -> list:
+        prefix = group[2:] + "-"
+        try:
+            names = os.listdir(os.path.dirname(self.path(group)))
+        except FileNotFoundError:
+            return []
+        return sorted(group[:2] + name for name in names if name.startswith(prefix))
+
+    def _open(self, key: str):
+        try:
+            return builtins.open(self.path(key), "rb")
+        except FileNotFoundError:
+            return None
+
+    def _touch(self, key: str) -> None:
+        # The modification time records when an archive was last used
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _create(self, group: str):
+        """Returns a new temporary file, and its path, for an archive in the given group."""
+        import tempfile
+
+        directory = os.path.dirname(self.path(group))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+        return builtins.open(fd, "w+b"), tmp_path
+
+    def evict(self) -> None:
+        """Remove the least recently used archives until the cache is at most max_size bytes.
+        Also removes temporary files left by interrupted builds."""
+        import time
+
+        if self.max_size is None:
+            return
+        stale = time.time() - self._STALE_SECONDS
+        entries = []
+        with os.scandir(self.directory) as subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir():
+                    continue
+                with os.scandir(subdir.path) as files:
+                    for entry in files:
+                        try:
+                            statres = entry.stat()
+                            if not entry.name.startswith(".tmp-"):
+                                entries.append((statres.st_mtime, statres.st_size, entry.path))
+                            elif statres.st_mtime < stale:
+                                os.remove(entry.path)
+                        except FileNotFoundError:
+                            # Removed by a concurrent build
+                            pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_ARCHIVE_CACHE_GROUP_SIZE = 1024 * 1024
+"""Size of the start of the tar stream that, with the settings, selects the cached archives that
+an archive is compared with."""
+
+_COMPRESSOR_PROBE = b"".join(b"%d %x %o\n" % (i, i * i, i * 7) for i in range(4096))
+"""Fixed data whose compressed form fingerprints the compression library, since Python doesn't
+expose the versions of the bzip2 and liblzma libraries it's linked with."""
+
+_compression_settings: dict = {}
+
+
+def _archive_cache_settings(compression) -> bytes:
+    """Returns the settings that, besides the tar stream, determine a compressed archive."""
+    import hashlib
+    from io import BytesIO
+    import zlib
+
+    settings = (*compression, mtime(), sys.version, zlib.ZLIB_RUNTIME_VERSION)
+    if settings not in _compression_settings:
+        probe = BytesIO()
+        compressor = _open_compressor(probe, "w", *compression)
+        compressor.write(_COMPRESSOR_PROBE)
+        if compressor is not probe:
+            compressor.close()
+        fingerprint = hashlib.sha256(probe.getvalue()).hexdigest()
+        _compression_settings[settings] = repr((*settings, fingerprint)).encode()
+    return _compression_settings[settings]
+
+
+_FICLONE = 0x40049409
+"""Linux ioctl request that makes a file share the data of another file (a reflink)."""
+
+
+class _ArchiveCacheWriter:
+    """File object for ReproducibleTarFile.open with an ArchiveCache. The start of the tar stream
+    selects cached archives, which are decompressed and compared with the tar stream as it's
+    written, so nothing is spooled while it matches one of them. Once it doesn't, the part that
+    matched is decompressed again into a new archive in the cache, and the rest of the tar stream
+    is compressed after it. When the archive is complete, the cached archive that matched the
+    whole tar stream, or the new one, is copied to the output, which is written to a temporary
+    file that is renamed to `name`, or to `fileobj`. Incomplete archives are discarded when
+    closed, and leave the output unchanged.
+    """
+
+    def __init__(self, cache: ArchiveCache, name, fileobj, compression) -> None:
+        import hashlib
+
+        self._cache = cache
+        self._name = name
+        self._fileobj = fileobj
+        self._compression = compression
+        self._hash = hashlib.sha256()
+        self._head = bytearray()
+        self._group: "str | None" = None
+        self._candidates: list = []
+        self._matched = 0
+        self._entry: "tuple | None" = None
+        self._compressor = None
+        self._offset = 0
+        self._failed = False
+        self.complete = False
+        self.closed = False
+
+    def write(self, data):
+        try:
+            if self._group is None:
+                self._head += data
+                if len(self._head) >= _ARCHIVE_CACHE_GROUP_SIZE:
+                    self._select()
+            else:
+                self._feed(data)
+        except BaseException:
+            self._failed = True
+            raise
+        self._hash.update(data)
+        self._offset += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self._offset
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.complete and not self._failed:
+                self._finish()
+        finally:
+            self._close_candidates(self._candidates)
+            if self._entry is not None:
+                fp, tmp_path = self._entry
+                fp.close()
+                os.remove(tmp_path)
+
+    def _decompressor(self, fp):
+        return _open_compressor(fp, "r", self._compression[0], 9, None, None, False)
+
+    def _select(self) -> None:
+        import hashlib
+
+        # Only the first _ARCHIVE_CACHE_GROUP_SIZE bytes, so the group doesn't depend on the
+        # sizes of the writes
+        head = bytes(self._head[:_ARCHIVE_CACHE_GROUP_SIZE])
+        rest = bytes(self._head[_ARCHIVE_CACHE_GROUP_SIZE:])
+        self._head = bytearray()
+        settings = _archive_cache_settings(self._compression)
+        self._group = hashlib.sha256(settings + b"\0" + head).hexdigest()
+        for key in self._cache._keys(self._group):
+            fp = self._cache._open(key)
+            if fp is not None:
+                self._candidates.append((key, fp, self._decompressor(fp)))
+        self._feed(head)
+        if rest:
+            self._feed(rest)
+
+    def _feed(self, data) -> None:
+        if self._compressor is None:
+            matching = [c for c in self._candidates if c[2].read(len(data)) == data]
+            if matching:
+                self._close_candidates([c for c in self._candidates if c not in matching])
+                self._candidates = matching
+                self._matched += len(data)
+                return
+            self._start_entry()
+        self._compressor.write(data)  # type: ignore[attr-defined]
+
+    def _start_entry(self) -> None:
+        """Start a new archive in the cache with the part of the tar stream that matched."""
+        fp, tmp_path = self._entry = self._cache._create(self._group)  # type: ignore[arg-type]
+        self._compressor = _open_compressor(fp, "w", *self._compression)
+        if self._matched:
+            cached = self._candidates[0][1]
+            cached.seek(0)
+            decompressor = self._decompressor(cached)
+            copyfileobj(decompressor, self._compressor, self._matched, bufsize=_SHARD_COPY_BUFSIZE)
+            decompressor.close()
+        self._close_candidates(self._candidates)
+        self._candidates = []
+
+    @staticmethod
+    def _close_candidates(candidates) -> None:
+        for _, fp, decompressor in candidates:
+            decompressor.close()
+            fp.close()
+
+    def _finish(self) -> None:
+        cache = self._cache
+        if self._group is None:
+            self._select()
+        if self._compressor is None:
+            for key, fp, decompressor in self._candidates:
+                if decompressor.read(1) == b"":
+                    cache.hits += 1
+                    cache._touch(key)
+                    fp.seek(0)
+                    self._output(fp)
+                    return
+            self._start_entry()
+        cache.misses += 1
+        fp, tmp_path = self._entry  # type: ignore[misc]
+        if self._compressor is not fp:
+            self._compressor.close()  # type: ignore[attr-defined]
+        fp.flush()
+        fp.seek(0)
+        self._output(fp)
+        fp.close()
+        os.replace(tmp_path, cache.path(f"{self._group}-{self._hash.hexdigest()}"))
+        self._entry = None
+        cache.evict()
+
+    def _output(self, fp) -> None:
+        """Copy an archive to the output. A path is written as a reflink where the file system
+        supports them."""
+        import shutil
+
+        if self._name is None:
+            shutil.copyfileobj(fp, self._fileobj, _SHARD_COPY_BUFSIZE)
+            return
+        name = os.fsdecode(self._name)
+        tmp_path = f"{name}.tmp-{os.urandom(6).hex()}"
+        try:
+            with builtins.open(tmp_path, "xb") as out:
+                try:
+                    import fcntl
+
+                    fcntl.ioctl(out.fileno(), _FICLONE, fp.fileno())
+                except (ImportError, OSError):
+                    shutil.copyfileobj(fp, out, _SHARD_COPY_BUFSIZE)
+            os.replace(tmp_path, name)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+
+_READAHEAD_CHUNK_SIZE = 1024 * 1024
+_READAHEAD_CHUNKS = 8
+
+
+class _ReadaheadReader:
+    """Readable file object for ReproducibleTarFile.open with `readahead`. Reads `fileobj`,
+    usually a decompressor, in chunks of _READAHEAD_CHUNK_SIZE bytes in a background thread,
+    keeping up to _READAHEAD_CHUNKS chunks ahead of the reader. zlib, bz2, and lzma release the
+    GIL while decompressing, so decompression runs in parallel with parsing headers and copying
+    data out. Seeking forward skips chunks that were read ahead, and seeking back before the
+    previous chunk restarts reading from the new position, which for compressed archives means
+    decompressing from the start again.
+    """
+
+    def __init__(self, fileobj) -> None:
+        self.fileobj = fileobj
+        self.closed = False
+        self._position = fileobj.tell()
+        self._previous = b""
+        self._chunk = b""
+        self._offset = 0
+        self._eof = False
+        self._start()
+
+    def _start(self) -> None:
+        import queue
+        import threading
+
+        self._queue: queue.Queue = queue.Queue(maxsize=_READAHEAD_CHUNKS)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._read_ahead, args=(self._queue, self._stopping), daemon=True
+        )
+        self._thread.start()
+
+    def _read_ahead(self, chunks, stopping) -> None:
+        try:
+            while not stopping.is_set():
+                chunk = self.fileobj.read(_READAHEAD_CHUNK_SIZE)
+                chunks.put(chunk)
+                if not chunk:
+                    return
+        except BaseException as e:
+            chunks.put(e)
+
+    def stop(self) -> None:
+        """Stop the background thread, leaving `fileobj` open."""
+        import queue
+
+        self._stopping.set()
+        while self._thread.is_alive():
+            # Make room for a chunk that the thread is waiting to add
+            try:
+                self._queue.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def release(self) -> None:
+        """Stop the background thread and seek `fileobj` back to the position of the reader, so
+        that a caller's file object is left where the archive was read up to."""
+        self.stop()
+        self.fileobj.seek(self._position)
+
+    def _next_chunk(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self._queue.get()
+        if isinstance(chunk, BaseException):
+            self._eof = True
+            raise chunk
+        if not chunk:
+            self._eof = True
+            return False
+        self._previous = self._chunk
+        self._chunk = chunk
+        self._offset = 0
+        return True
+
+    def read(self, size=-1) -> bytes:
+        if self.closed:
+            raise ValueError("read from closed file")
+        if size is None or size < 0:
+            size = sys.maxsize
+        parts = []
+        while size > 0:
+            if self._offset == len(self._chunk) and not self._next_chunk():
+                break
+            chunk, offset = self._chunk, self._offset
+            if offset == 0 and size >= len(chunk):
+                part = chunk
+            else:
+                part = chunk[offset : offset + size]
+            parts.append(part)
+            self._offset += len(part)
+            self._position += len(part)
+            size -= len(part)
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence != os.SEEK_SET:
+            raise ValueError("seek from end not supported")
+        if offset >= self._position:
+            # Skip forward through the chunks that were read ahead
+            while offset > self._position:
+                if self._offset == len(self._chunk) and not self._next_chunk():
+                    break
+                step = min(offset - self._position, len(self._chunk) - self._offset)
+                self._offset += step
+                self._position += step
+            return self._position
+        back = self._position - offset
+        if back > self._offset and back <= self._offset + len(self._previous):
+            # TarFile seeks back one byte to check for the end of data
+            self._chunk = self._previous + self._chunk
+            self._offset += len(self._previous)
+            self._previous = b""
+        if back <= self._offset:
+            self._offset -= back
+            self._position = offset
+            return offset
+        self.stop()
+        self.fileobj.seek(offset)
+        self._position = offset
+        self._previous = self._chunk = b""
+        self._offset = 0
+        self._eof = False
+        self._start()
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.stop()
+        self.fileobj.close()
+
+
+class _GzipStreamReader:
+    """Reads the decompressed data of a gzip file with one or more members, and records the
+    compressed and decompressed offsets where each member starts in `members`. Used to append to
+    gzip compressed archives.
+    """
+
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, fileobj) -> None:
+        import zlib
+
+        self._zlib = zlib
+        self._fileobj = fileobj
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._in_member = False
+        self._input = b""
+        # Compressed offset of the start of _input, relative to where reading started
+        self._input_offset = 0
+        self._buffer = bytearray()
+        self._pos = 0
+        self._decompressed = 0
+        self.members: list = []
+
+    def _decompress(self) -> bool:
+        """Decompress more data into the buffer. Returns False at the end of the file."""
+        zlib = self._zlib
+        if not self._in_member:
+            if not self._input:
+                self._input = self._fileobj.read(self._CHUNK_SIZE)
+                if not self._input:
+                    return False
+            # Like gzip, ignore NUL padding after members
+            stripped = self._input.lstrip(NUL)
+            self._input_offset += len(self._input) - len(stripped)
+            self._input = stripped
+            if not stripped:
+                return True
+            self.members.append((self._input_offset, self._decompressed))
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._in_member = True
+        decompressor = self._decompressor
+        if not self._input:
+            self._input = self._fileobj.read(self._CHUNK_SIZE)
+        try:
+            data = decompressor.decompress(self._input, self._CHUNK_SIZE)
+        except zlib.error as e:
+            raise ReadError("not a gzip file") from e
+        if decompressor.eof:
+            rest = decompressor.unused_data
+            self._in_member = False
+        else:
+            rest = decompressor.unconsumed_tail
+            if not data and not self._input:
+                raise ReadError("unexpected end of gzip data")
+        self._input_offset += len(self._input) - len(rest)
+        self._input = rest
+        if self._pos:
+            del self._buffer[: self._pos]
+            self._pos = 0
+        self._buffer += data
+        self._decompressed += len(data)
+        return True
+
+    def read(self, size: int) -> bytes:
+        while len(self._buffer) - self._pos < size and self._decompress():
+            pass
+        data = bytes(self._buffer[self._pos : self._pos + size])
+        self._pos += len(data)
+        return data
+
+    def skip(self, size: int) -> None:
+        while size:
+            size -= len(self.read(min(size, self._CHUNK_SIZE)))
+            if len(self._buffer) == self._pos and not self._decompress():
+                if size:
+                    raise ReadError("unexpected end of data")
+                return
+
+
+class ArchiveMismatchError(TarError):
+    """Raised by VerifySink when the archive being written differs from the existing archive.
+
+    Attributes:
+        name: Name of the existing archive.
+        offset: Offset in bytes of the first byte that differs. If the existing archive is shorter
+            or longer, this is where the shorter one ends.
+        member: Name of the member that was being written when the difference was found, or None
+            if it was found while finishing the archive.
+    """
+
+    def __init__(self, name, offset: int, member=None) -> None:
+        super().__init__(name, offset)
+        self.name = name
+        self.offset = offset
+        self.member = member
+
+    def __str__(self) -> str:
+        message = f"{self.name} differs from the archive being written at byte {self.offset}"
+        if self.member is not None:
+            message += f", while writing member {self.member!r}"
+        return message
+
+
+class ReproducibleTarFile(TarFile):
+    """Subclass of tarfile.TarFile that sets archive metadata to fixed values so that archives
+    with identical contents are byte-for-byte identical. Accepts the same arguments as TarFile,
+    plus the following keyword-only arguments.
+
+    Args:
+        stats: Optional ArchiveStats object that will record timings and byte counts of writing
+            the archive. Instrumentation is disabled if not provided.
+        write_buffer_size: Size in bytes of the buffer used to gather headers, data, and padding
+            of small members into large writes to the output file or compressor, such as
+            DEFAULT_WRITE_BUFFER_SIZE. Writes at least this large bypass the buffer. The
+            default, 0, writes through directly, so that the output receives data as members
+            are added. Does not change the bytes written.
+        keep_members: Whether to keep the TarInfo of every member written, like TarFile does.
+            Set to False to record members in a compact MemberIndex in `member_index` instead,
+            so that memory use stays flat for archives with very many members. getmembers and
+            getnames then only return members that were in the archive before it was opened.
+        io_policy: How to use the page cache when writing. The default, None, leaves it to the
+            operating system. With "stream", input files are read with sequential readahead
+            and dropped from the page cache after their member is written, and the output file
+            is synced and dropped from the page cache every 64 MiB, so that archiving very
+            large datasets doesn't evict other cached data. Uses os.posix_fadvise and has no
+            effect on platforms without it. Does not change the bytes written.
+    """
+
+    def __init__(
+        self,
+        *args,
+        stats=None,
+        write_buffer_size=0,
+        keep_members=True,
+        io_policy=None,
+        **kwargs,
+    ) -> None:
+        if io_policy not in IO_POLICIES:
+            raise ValueError(f"io_policy must be one of {IO_POLICIES}")
+        self.stats = stats
+        self.io_policy = io_policy
+        self._io_policy: "_StreamIOPolicy | None" = None
+        self._write_buffer = None
+        self.member_index = None if keep_members else MemberIndex()
+        # Names of the directory members in the archive, so add_many_bytes doesn't repeat them
+        self._dir_names: set = set()
+        self._header_encoder = _HeaderEncoder()
+        self._fragment_boundaries: "_FragmentBoundaries | None" = None
+        self._preallocated = False
+        self._archive_cache_writer: "_ArchiveCacheWriter | None" = None
+        self._segment_ranges: "_SegmentRanges | None" = None
+        super().__init__(*args, **kwargs)
+        # Uncompressed archives written to files can be preallocated
+        import io
+
+        self._raw_fileobj = None
+        if isinstance(self.fileobj, (io.BufferedWriter, io.BufferedRandom, io.FileIO)):
+            self._raw_fileobj = self.fileobj
+        if self.mode == "a":
+            self._dir_names.update(
+                member.name
+                for member in self.members  # type: ignore[attr-defined]
+                if member.isdir()
+            )
+        if self.mode in ("a", "w", "x"):
+            if io_policy == "stream" and hasattr(os, "posix_fadvise"):
+                self._io_policy = _StreamIOPolicy(self.fileobj)
+            if stats is not None:
+                stats._instrument(self)
+            if write_buffer_size:
+                self._write_buffer = _WriteBuffer(self.fileobj, write_buffer_size)
+                self.fileobj = self._write_buffer
+
+    @classmethod
+    def open(cls, name=None, mode="r", fileobj=None, bufsize=RECORDSIZE, **kwargs):
+        """Open a tar archive for reading, appending, or writing. See TarFile.open for details.
+
+        If `archive_cache` is given, an ArchiveCache or the path of its directory, when writing
+        with mode 'w' and optional compression, the uncompressed tar stream is compared with
+        cached archives with the same start and settings as it's written. When the archive is
+        closed, a cached archive with the same contents is copied to the output, or reflinked
+        where the file system supports it, instead of compressing. Otherwise, the archive is
+        compressed into the cache and copied to the output. The output is only written when the
+        archive is closed, to a temporary file that is renamed into place, so an archive that
+        isn't closed normally leaves an existing file unchanged.
+
+        If `readahead` is true, when reading with a mode other than the stream modes like
+        'r|gz', the archive is read, and decompressed, in large chunks in a background thread
+        ahead of where members are read, so that decompression runs in parallel with listing or
+        extracting members. Seeking back, such as extracting a member before the last one read,
+        restarts decompressing from the start of a compressed archive. A `fileobj` that is read
+        directly is seeked back to where the archive was read up to when it's closed.
+        """
+        archive_cache = kwargs.pop("archive_cache", None)
+        if kwargs.pop("readahead", False):
+            if not mode.startswith("r") or "|" in mode:
+                raise ValueError(
+                    "readahead can only be used with mode 'r' and optional compression"
+                )
+            t = super().open(name, mode, fileobj, bufsize, **kwargs)
+            t.fileobj = _ReadaheadReader(t.fileobj)
+            return t
+        if archive_cache is None:
+            return super().open(name, mode, fileobj, bufsize, **kwargs)
+        filemode, _, comptype = mode.partition(":")
+        if filemode != "w" or "|" in mode:
+            raise ValueError(
+                "archive_cache can only be used with mode 'w' and optional compression"
+            )
+        if comptype not in ("", "tar", "gz", "bz2", "xz", "zst"):
+            raise CompressionError(f"unknown compression type {comptype!r}")
+        if not isinstance(archive_cache, ArchiveCache):
+            archive_cache = ArchiveCache(archive_cache)
+        compression = (
+            comptype,
+            kwargs.pop("compresslevel", 9),
+            kwargs.pop("preset", None),
+            kwargs.pop("level", None),
+            kwargs.pop("rsyncable", False),
+        )
+
+        writer = _ArchiveCacheWriter(
+            archive_cache, name if fileobj is None else None, fileobj, compression
+        )
+        try:
+            t = cls(name, "w", writer, **kwargs)
+        except BaseException:
+            writer.close()
+            raise
+        t._extfileobj = False
+        t._archive_cache_writer = writer
+        return t
+
+    # Following method modified from Python 3.12
+    # https://github.com/python/cpython/blob/v3.12.1/Lib/tarfile.py#L1847-L1853
+    # Copyright Python Software Foundation, licensed under PSF License Version 2
+    # See LICENSE file for full license agreement and notice of copyright
+    @classmethod
+    def taropen(cls, name, mode="r", fileobj=None, **kwargs):
+        """Open uncompressed tar archive name for reading or writing.
+        When appending with `fast_append', the end of the archive is found
+        by reading only the headers of existing members, which are not
+        loaded.
+        """
+        if mode not in ("r", "a", "w", "x"):
+            raise ValueError("mode must be 'r', 'a', 'w' or 'x'")
+        ## repro-tarfile MODIFIED ##
+        if kwargs.pop("fast_append", False) and mode == "a":
+            return cls._append(name, fileobj, **kwargs)
+        #########################
+        return cls(name, mode, fileobj, **kwargs)
+
+    @classmethod
+    def _append(cls, name, fileobj, **kwargs):
+        """Open an uncompressed archive for appending. Members are written over the
+        end-of-archive marker, so the result is identical to writing all members at once."""
+        extfileobj = fileobj is not None
+        if fileobj is None:
+            if not os.path.exists(name):
+                return cls(name, "w", **kwargs)
+            fileobj = builtins.open(name, "r+b")
+        try:
+            start = fileobj.tell()
+            end = _find_archive_end(fileobj.read, lambda size: fileobj.seek(size, os.SEEK_CUR))
+            fileobj.seek(start + end)
+            fileobj.truncate()
+            t = cls(name, "w", fileobj, **kwargs)
+        except BaseException:
+            if not extfileobj:
+                fileobj.close()
+            raise
+        t.mode = "a"
+        t._extfileobj = extfileobj
+        return t
+
+    # Following method modified from Python 3.12
+    # https://github.com/python/cpython/blob/09b8b14e05557304ab12870137181685c2dcbe25/Lib/tarfile.py#L1856-L1887
+    # Copyright Python Software Foundation, licensed under PSF License Version 2
+    # See LICENSE file for full license agreement and notice of copyright
+    @classmethod
+    def gzopen(
+        cls,
+        name,
+        mode="r",
+        fileobj=None,
+        compresslevel=9,
+        rsyncable=False,
+        fragment_size=None,
+        fragment_cache=None,
+        segment_incompressible=False,
+        fast_append=False,
+        **kwargs,
+    ):
+        """Open gzip compressed tar archive name for reading, writing, or
+        appending with `fast_append'. Appended members are written in a
+        new gzip member. If
+        `rsyncable' is true, the compressor is reset at content-defined
+        boundaries when writing, like `gzip --rsyncable'. If `fragment_size'
+        is given, runs of members averaging that size are compressed as
+        separate gzip members, which are reused from `fragment_cache' if
+        it is given. If `segment_incompressible' is true, the data of
+        members that are already compressed is stored in separate gzip
+        members instead of compressed again.
+        """
+        ## repro-tarfile MODIFIED ##
+        if segment_incompressible:
+            if mode not in ("w", "x"):
+                raise ValueError("segment_incompressible can only be used for writing")
+            if rsyncable or fragment_size is not None:
+                raise ValueError(
+                    "segment_incompressible can't be used with rsyncable or fragment_size"
+                )
+        if fragment_size is not None:
+            if mode not in ("w", "x"):
+                raise ValueError("fragment_size can only be used for writing")
+            if rsyncable:
+                raise ValueError("fragment_size can't be used with rsyncable")
+            if fragment_size < 1:
+                raise ValueError("fragment_size must be positive")
+            if fragment_cache is not None and not isinstance(fragment_cache, FragmentCache):
+                fragment_cache = FragmentCache(fragment_cache)
+        if mode == "a":
+            if not fast_append:
+                raise ValueError("appending to gzip archives requires fast_append=True")
+            return cls._gzappend(name, fileobj, compresslevel, rsyncable, **kwargs)
+        #########################
+        if mode not in ("r", "w", "x"):
+            raise ValueError("mode must be 'r', 'w' or 'x'")
+
+        try:
+            from gzip import GzipFile
+        except ImportError:
+            raise CompressionError("gzip module is not available") from None
+
+        try:
+            ## repro-tarfile MODIFIED ##
+            # Overwrite filename and mtime when initializing GzipFile
+            opened = fileobj is None
+            if fileobj is None:
+                fileobj = builtins.open(name, mode + "b")
+            if fragment_size is not None:
+                fileobj = _FragmentGzipWriter(
+                    fileobj, compresslevel, fragment_size, fragment_cache, opened
+                )
+            elif segment_incompressible:
+                fileobj = _SegmentedWriter(fileobj, "gz", compresslevel, opened)
+            else:
+                fileobj = GzipFile("", mode + "b", compresslevel, fileobj, mtime=mtime())
+            if rsyncable and mode != "r":
+                fileobj = _RsyncableGzipWriter(fileobj)
+            #########################
+        except OSError as e:
+            if fileobj is not None and mode == "r":
+                raise ReadError("not a gzip file") from e
+            raise
+
+        try:
+            t = cls.taropen(name, mode, fileobj, **kwargs)
+        except OSError as e:
+            fileobj.close()
+            if mode == "r":
+                raise ReadError("not a gzip file") from e
+            raise
+        except:
+            fileobj.close()
+            raise
+        t._extfileobj = False
+        ## repro-tarfile MODIFIED ##
+        if fragment_size is not None:
+            t._fragment_boundaries = fileobj.boundaries
+        if segment_incompressible:
+            t._segment_ranges = fileobj.ranges
+        #########################
+        return t
+
+    @classmethod
+    def xzopen(
+        cls, name, mode="r", fileobj=None, preset=None, segment_incompressible=False, **kwargs
+    ):
+        """Open lzma compressed tar archive name for reading or writing. If
+        `segment_incompressible` is true, the data of members that are already compressed is
+        written in separate xz streams with the fastest preset instead of compressed again.
+        """
+        if not segment_incompressible:
+            return super().xzopen(name, mode, fileobj, preset, **kwargs)
+        if mode not in ("w", "x"):
+            raise ValueError("segment_incompressible can only be used for writing")
+        opened = fileobj is None
+        if fileobj is None:
+            fileobj = builtins.open(name, mode + "b")
+        writer = _SegmentedWriter(fileobj, "xz", preset, opened)
+        try:
+            t = cls.taropen(name, mode, writer, **kwargs)
+        except BaseException:
+            if opened:
+                fileobj.close()
+            raise
+        t._extfileobj = False
+        t._segment_ranges = writer.ranges
+        return t
+
+    @classmethod
+    def _gzappend(cls, name, fileobj, compresslevel, rsyncable, **kwargs):
+        """Open a gzip compressed archive for appending. The gzip member that contains the
+        end-of-archive marker is recompressed without it, and appended members are written in a
+        new gzip member, so the decompressed tar stream is identical to writing all members at
+        once. Earlier gzip members are left as they are."""
+        from gzip import GzipFile
+        import tempfile
+
+        extfileobj = fileobj is not None
+        if fileobj is None:
+            if not os.path.exists(name):
+                return cls.gzopen(name, "w", None, compresslevel, rsyncable, **kwargs)
+            fileobj = builtins.open(name, "r+b")
+
+        def open_member(raw):
+            gzipfile = GzipFile("", "wb", compresslevel, raw, mtime=mtime())
+            return _RsyncableGzipWriter(gzipfile) if rsyncable else gzipfile
+
+        try:
+            start = fileobj.tell()
+            reader = _GzipStreamReader(fileobj)
+            end = _find_archive_end(reader.read, reader.skip)
+            member_offset, member_start = 0, 0
+            for offset, decompressed in reader.members:
+                if decompressed <= end:
+                    member_offset, member_start = offset, decompressed
+            with tempfile.TemporaryFile() as tmp:
+                if end > member_start:
+                    # Recompress the data of the last member without the end-of-archive marker
+                    fileobj.seek(start + member_offset)
+                    reader = _GzipStreamReader(fileobj)
+                    with open_member(tmp) as member:
+                        remaining = end - member_start
+                        while remaining:
+                            data = reader.read(min(remaining, reader._CHUNK_SIZE))
+                            if not data:
+                                raise ReadError("unexpected end of data")
+                            member.write(data)
+                            remaining -= len(data)
+                    tmp.seek(0)
+                fileobj.seek(start + member_offset)
+                fileobj.truncate()
+                copyfileobj(tmp, fileobj)
+            gzipfile = open_member(fileobj)
+        except BaseException:
+            if not extfileobj:
+                fileobj.close()
+            raise
+
+        try:
+            t = cls.taropen(name, "w", gzipfile, **kwargs)
+        except:
+            gzipfile.close()
+            if not extfileobj:
+                fileobj.close()
+            raise
+        # Offsets continue from the end of the existing archive
+        t.offset += end
+        t.mode = "a"
+        t._extfileobj = False
+        return t
+
+    @classmethod
+    def teeopen(cls, targets, compresslevel=9, preset=None, level=None, rsyncable=False, **kwargs):
+        """Open several archives for writing that get the same contents, each with its own
+        compression. The uncompressed tar stream is produced once, so input files are read only
+        once, and each output is compressed and written in its own worker thread. Each output is
+        byte-for-byte identical to the archive that open would write with its mode.
+
+        Args:
+            targets: Sequence of (name or file object, mode) pairs, where mode is one of 'w',
+                'w:gz', 'w:bz2', 'w:xz', and 'w:zst' (Python 3.14+), or the same with 'x'.
+            compresslevel: Compression level for gzip and bzip2 outputs.
+            preset: Compression preset for xz outputs.
+            level: Compression level for zstd outputs.
+            rsyncable: Whether to reset gzip compressors at content-defined boundaries, as with
+                gzopen.
+            **kwargs: Other arguments for ReproducibleTarFile.
+        """
+        outputs = []
+        try:
+            for target, mode in targets:
+                filemode, _, comptype = mode.partition(":")
+                if filemode not in ("w", "x"):
+                    raise ValueError("mode must be 'w' or 'x' with optional compression")
+                outputs.append(
+                    _open_tee_output(
+                        target, filemode, comptype, compresslevel, preset, level, rsyncable
+                    )
+                )
+            if not outputs:
+                raise ValueError("no targets given")
+            tee = _TeeWriter(outputs)
+            t = cls(None, "w", tee, **kwargs)
+        except BaseException:
+            for output in outputs:
+                try:
+                    output.close()
+                except Exception:
+                    pass
+            raise
+        t._extfileobj = False
+        return t
+
+    def gettarinfo(self, name=None, arcname=None, fileobj=None):
+        """Create a TarInfo object from the result of os.stat or equivalent on an existing file.
+        See TarFile.gettarinfo for details. Unlike TarFile.gettarinfo, the owner fields are set to
+        the fixed values that will be written to the archive instead of being looked up from the
+        system user and group databases, which can be slow with network name services.
+        """
+        stats = self.stats
+        if stats is None:
+            return self._gettarinfo(name, arcname, fileobj)
+        start = perf_counter()
+        tarinfo = self._gettarinfo(name, arcname, fileobj)
+        stats._record_stat(perf_counter() - start)
+        return tarinfo
+
+    # Following method modified from Python 3.12
+    # https://github.com/python/cpython/blob/v3.12.1/Lib/tarfile.py#L2003-L2101
+    # Copyright Python Software Foundation, licensed under PSF License Version 2
+    # See LICENSE file for full license agreement and notice of copyright
+    def _gettarinfo(self, name, arcname, fileobj):
+        self._check("awx")  # type: ignore[attr-defined]
+
+        # When fileobj is given, replace name by
+        # fileobj's real name.
+        if fileobj is not None:
+            name = fileobj.name
+
+        # Building the name of the member in the archive.
+        # Backward slashes are converted to forward slashes,
+        # Absolute paths are turned to relative paths.
+        if arcname is None:
+            arcname = name
+        drv, arcname = os.path.splitdrive(arcname)
+        arcname = arcname.replace(os.sep, "/")
+        arcname = arcname.lstrip("/")
+
+        # Now, fill the TarInfo object with
+        # information specific for the file.
+        tarinfo = self.tarinfo()
+        ## repro-tarfile MODIFIED ##
+        # TarInfo.tarfile is deprecated in Python 3.13+, which sets _tarfile instead
+        if sys.version_info >= (3, 13):
+            tarinfo._tarfile = self  # type: ignore[attr-defined]
+        else:
+            tarinfo.tarfile = self  # type: ignore[attr-defined]
+        #########################
+
+        # Use os.stat or os.lstat, depending on if symlinks shall be resolved.
+        if fileobj is None:
+            if not self.dereference:
+                statres = os.lstat(name)
+            else:
+                statres = os.stat(name)
+        else:
+            statres = os.fstat(fileobj.fileno())
+        linkname = ""
+
+        stmd = statres.st_mode
+        if stat.S_ISREG(stmd):
+            inode = (statres.st_ino, statres.st_dev)
+            if (
+                not self.dereference
+                and statres.st_nlink > 1
+                and inode in self.inodes  # type: ignore[attr-defined]
+                and arcname != self.inodes[inode]  # type: ignore[attr-defined]
+            ):
+                # Is it a hardlink to an already
+                # archived file?
+                type = LNKTYPE
+                linkname = self.inodes[inode]  # type: ignore[attr-defined]
+            else:
+                # The inode is added only if its valid.
+                # For win32 it is always 0.
+                type = REGTYPE
+                if inode[0]:
+                    self.inodes[inode] = arcname  # type: ignore[attr-defined]
+        elif stat.S_ISDIR(stmd):
+            type = DIRTYPE
+        elif stat.S_ISFIFO(stmd):
+            type = FIFOTYPE
+        elif stat.S_ISLNK(stmd):
+            type = SYMTYPE
+            linkname = os.readlink(name)
+        elif stat.S_ISCHR(stmd):
+            type = CHRTYPE
+        elif stat.S_ISBLK(stmd):
+            type = BLKTYPE
+        else:
+            return None
+
+        # Fill the TarInfo object with all
+        # information we can get.
+        tarinfo.name = arcname
+        tarinfo.mode = stmd
+        if type == REGTYPE:
+            tarinfo.size = statres.st_size
+        else:
+            tarinfo.size = 0
+        tarinfo.mtime = statres.st_mtime
+        tarinfo.type = type
+        tarinfo.linkname = linkname
+        ## repro-tarfile MODIFIED ##
+        # Use the fixed owner values instead of looking up names with pwd and grp
+        tarinfo.uid = uid()
+        tarinfo.gid = gid()
+        tarinfo.uname = uname()
+        tarinfo.gname = gname()
+        #########################
+
+        if type in (CHRTYPE, BLKTYPE):
+            if hasattr(os, "major") and hasattr(os, "minor"):
+                tarinfo.devmajor = os.major(statres.st_rdev)
+                tarinfo.devminor = os.minor(statres.st_rdev)
+        return tarinfo
+
+    # Following method modified from Python 3.12
+    # https://github.com/python/cpython/blob/09b8b14e05557304ab12870137181685c2dcbe25/Lib/tarfile.py#L2165-L2189
+    # Copyright Python Software Foundation, licensed under PSF License Version 2
+    # See LICENSE file for full license agreement and notice of copyright
+    def addfile(self, tarinfo: TarInfo, fileobj=None) -> None:
+        """Add the TarInfo object `tarinfo' to the archive. If `fileobj' is
+        given, it should be a binary file, and tarinfo.size bytes are read
+        from it and added to the archive. You can create TarInfo objects
+        directly, or by using gettarinfo().
+        """
+        self._check("awx")  # type: ignore[attr-defined]
+
+        if sys.version_info >= (3, 13):
+            if fileobj is None and tarinfo.isreg() and tarinfo.size != 0:
+                raise ValueError("fileobj not provided for non zero-size regular file")
+
+        ## repro-tarfile MODIFIED ##
+        # Write a copy of tarinfo with metadata overwritten by fixed values
+        if tarinfo.isdir():
+            mode = 0o40000 | dir_mode()
+        else:
+            mode = 0o100000 | file_mode()
+        # See docstring for _temporarily_delete_tarfile_attr for why we need to do this.
+        with _temporarily_delete_tarfile_attr(tarinfo):
+            try:
+                tarinfo = tarinfo.replace(
+                    mtime=mtime(),
+                    mode=mode,
+                    uid=uid(),
+                    gid=gid(),
+                    uname=uname(),
+                    gname=gname(),
+                    deep=True,
+                )
+            except AttributeError as e:
+                # Some older versions of Python don't have replace method
+                # Added in: 3.8.17, 3.9.17, 3.10.12, 3.11.4, 3.12
+                if "'TarInfo' object has no attribute 'replace'" in str(e):
+                    import copy
+
+                    tarinfo_copy = copy.deepcopy(tarinfo)
+                    tarinfo_copy.mtime = mtime()
+                    tarinfo_copy.mode = mode
+                    tarinfo_copy.uid = uid()
+                    tarinfo_copy.gid = gid()
+                    tarinfo_copy.uname = uname()
+                    tarinfo_copy.gname = gname()
+                    tarinfo = tarinfo_copy
+                else:
+                    raise
+
+        self._write_member(tarinfo, fileobj, advise=True)
+        #########################
+
+    def add_bytes(self, name: str, data) -> None:
+        """Add a regular file named `name` with `data` as its contents, without creating a TarInfo
+        and file object. Same as add_many_bytes([(name, data)]).
+        """
+        self.add_many_bytes([(name, data)])
+
+    def add_many_bytes(self, members, *, dirs=False, spool_size=DEFAULT_SPOOL_SIZE) -> None:
+        """Add regular files with in-memory or generated contents, in the given order. The result
+        is the same as calling addfile with a TarInfo and a BytesIO for each member, but the
+        fixed metadata values are looked up once and bytes-like data is passed to the output
+        from a memoryview, without copying it unless it is gathered in the write buffer.
+
+        Args:
+            members: Mapping of names to data, or iterable of (name, data) pairs. Data can be a
+                bytes-like object, a readable binary file object, or an iterable of bytes-like
+                chunks. File objects and iterables are read to the end and spooled first, since
+                the size goes in the header before the data.
+            dirs: Whether to add a directory member for each parent directory in the names,
+                right before the first member inside it. Directories that are already in the
+                archive, whether added by an earlier call, add, or addfile, are not added again.
+            spool_size: Size in bytes above which data of unknown size is spooled to a
+                temporary file instead of memory. Does not change the bytes written.
+        """
+        self._check("awx")  # type: ignore[attr-defined]
+        if hasattr(members, "items"):
+            members = members.items()
+        # Look up the fixed metadata values once instead of for every member
+        fixed_mtime, fixed_uid, fixed_gid = mtime(), uid(), gid()
+        fixed_uname, fixed_gname = uname(), gname()
+        reg_mode = 0o100000 | file_mode()
+        directory_mode = 0o40000 | dir_mode()
+        tarinfo_cls = self.tarinfo
+
+        def new_tarinfo(name, mode):
+            tarinfo = tarinfo_cls(name)
+            tarinfo.mtime = fixed_mtime
+            tarinfo.mode = mode
+            tarinfo.uid = fixed_uid
+            tarinfo.gid = fixed_gid
+            tarinfo.uname = fixed_uname
+            tarinfo.gname = fixed_gname
+            return tarinfo
+
+        dir_names = self._dir_names
+        for name, data in members:
+            if dirs:
+                parts = name.split("/")[:-1]
+                for i in range(1, len(parts) + 1):
+                    dirname = "/".join(parts[:i])
+                    if parts[i - 1] and dirname not in dir_names:
+                        tarinfo = new_tarinfo(dirname, directory_mode)
+                        tarinfo.type = DIRTYPE
+                        self._write_member(tarinfo, None)
+            tarinfo = new_tarinfo(name, reg_mode)
+            try:
+                view = memoryview(data).cast("B")
+            except TypeError:
+                import tempfile
+
+                # Size is unknown, so read everything first
+                with tempfile.SpooledTemporaryFile(max_size=spool_size) as spool:
+                    if hasattr(data, "read"):
+                        copyfileobj(data, spool)
+                    else:
+                        for chunk in data:
+                            spool.write(chunk)
+                    tarinfo.size = spool.tell()
+                    spool.seek(0)
+                    self._write_member(tarinfo, spool)
+            else:
+                with view:
+                    tarinfo.size = view.nbytes
+                    self._write_member(tarinfo, view)
+
+    def _write_member(self, tarinfo: TarInfo, data, *, advise: bool = False) -> None:
+        """Write a member whose TarInfo already has the fixed metadata values, followed by its
+        data from a memoryview or a file object positioned at the start of tarinfo.size bytes, and
+        record it. With `advise`, a file object is read through the I/O policy. Used by addfile
+        and add_many_bytes.
+        """
+        segments = self._segment_ranges
+        incompressible = (
+            segments is not None
+            and data is not None
+            and segments.incompressible(tarinfo.name, tarinfo.size, data)
+        )
+
+        io_policy = self._io_policy
+        if advise and io_policy is not None and data is not None:
+            data = io_policy.open_input(data)
+        source = data
+
+        # Record timings and byte counts if instrumentation is enabled
+        stats = self.stats
+        if stats is not None:
+            stats._start_member(tarinfo.name)
+            if data is not None and not isinstance(data, memoryview):
+                data = _TimedReader(data, stats)
+            start = perf_counter()
+        buf = self._header_encoder.encode(tarinfo, self.format, self.encoding, self.errors)
+        if stats is not None:
+            stats._record("header", perf_counter() - start, len(buf))
+        if incompressible and segments is not None:
+            # Segments must be known before the data is written
+            segments.add(self.offset + len(buf), tarinfo.size)
+
+        # Same as TarFile.addfile, but writes memoryviews directly
+        offset = self.offset
+        fileobj = self.fileobj
+        try:
+            fileobj.write(buf)
+            self.offset += len(buf)
+            # If there's data to follow, append it.
+            if data is not None:
+                if isinstance(data, memoryview):
+                    fileobj.write(data)  # type: ignore[arg-type]
+                else:
+                    copyfileobj(data, fileobj, tarinfo.size, bufsize=self.copybufsize)  # type: ignore[attr-defined]
+                blocks, remainder = divmod(tarinfo.size, BLOCKSIZE)
+                if remainder > 0:
+                    fileobj.write(NUL * (BLOCKSIZE - remainder))
+                    blocks += 1
+                self.offset += blocks * BLOCKSIZE
+        except ArchiveMismatchError as e:
+            if e.member is None:
+                e.member = tarinfo.name
+            raise
+
+        member_index = self.member_index
+        if member_index is None:
+            self.members.append(tarinfo)  # type: ignore[attr-defined]
+        else:
+            member_index._append(tarinfo.name, offset, offset + len(buf), tarinfo.size)
+        if tarinfo.type == DIRTYPE:
+            self._dir_names.add(tarinfo.name.rstrip("/"))
+        if self._fragment_boundaries is not None:
+            self._fragment_boundaries.member_end(buf, offset, self.offset)
+        if io_policy is not None:
+            io_policy.member_end(source)
+        if stats is not None:
+            stats._finish_member()
+
+    def _add_encoded(self, fileobj, length: int, entry: IndexEntry) -> None:
+        """Write a member that another ReproducibleTarFile with the same settings already encoded,
+        reading `length` bytes of headers, data, and padding from `fileobj`. `entry` is its
+        MemberIndex entry in the other archive.
+        """
+        # Check before writing, so that misuse doesn't leave a partial member behind
+        if self.member_index is None:
+            raise ValueError("encoded members can only be added with keep_members=False")
+        header = fileobj.read(entry.offset_data - entry.offset)
+        offset = self.offset
+        self.fileobj.write(header)
+        copyfileobj(
+            fileobj,
+            self.fileobj,
+            length - len(header),
+            bufsize=self.copybufsize,  # type: ignore[attr-defined]
+        )
+        self.offset += length
+        self.member_index._append(entry.name, offset, offset + len(header), entry.size)
+        if self._fragment_boundaries is not None:
+            self._fragment_boundaries.member_end(header, offset, self.offset)
+        if self._io_policy is not None:
+            self._io_policy.member_end(None)
+
+    def close(self) -> None:
+        """Close the TarFile. In write-mode, two finishing zero blocks are appended to the
+        archive.
+        """
+        if self.closed:  # type: ignore[attr-defined]
+            return
+        extfileobj = self._extfileobj  # type: ignore[has-type]
+        if extfileobj and isinstance(self.fileobj, _ReadaheadReader):  # type: ignore[has-type]
+            # The caller still owns the file object, so only stop reading ahead, and leave it
+            # where it would be without reading ahead
+            self.fileobj.release()
+        if self._archive_cache_writer is not None:
+            # Only archives that are closed normally are cached
+            self._archive_cache_writer.complete = True
+        try:
+            if self._preallocated:
+                # Keep the file open to cut off preallocated space that wasn't written
+                self._extfileobj = True
+            try:
+                super().close()
+                # TarFile only closes file objects it opened, so flush for external ones
+                if self._write_buffer is not None and self._extfileobj:  # type: ignore[attr-defined]
+                    self._write_buffer.flush_buffer()
+            finally:
+                # Also if closing failed, so that no preallocated space is left after the data
+                if self._preallocated:
+                    try:
+                        self._raw_fileobj.truncate()  # type: ignore[union-attr]
+                    finally:
+                        if not extfileobj:
+                            self.fileobj.close()  # type: ignore[attr-defined]
+        finally:
+            if self.stats is not None:
+                self.stats._close()
+
+    # Following method modified from Python 3.12
+    # https://github.com/python/cpython/blob/v3.12.1/Lib/tarfile.py#L2140-L2189
+    # Copyright Python Software Foundation, licensed under PSF License Version 2
+    # See LICENSE file for full license agreement and notice of copyright
+    def add(self, name, arcname=None, recursive=True, *, filter=None, matcher=None) -> None:
+        """Add the file `name' to the archive. `name' may be any type of file
+        (directory, fifo, symbolic link, etc.). If given, `arcname'
+        specifies an alternative name for the file in the archive.
+        Directories are added recursively by default. This can be avoided by
+        setting `recursive' to False. `filter' is a function
+        that expects a TarInfo object argument and returns the changed
+        TarInfo object, if it returns None the TarInfo object will be
+        excluded from the archive. `matcher' is a PathMatcher that selects
+        paths by gitignore-style patterns relative to `name'. Directories
+        that it excludes are not read.
+        """
+        ## repro-tarfile MODIFIED ##
+        if matcher is None:
+            super().add(name, arcname, recursive, filter=filter)
+            return
+        #########################
+        self._check("awx")  # type: ignore[attr-defined]
+
+        if arcname is None:
+            arcname = name
+
+        ## repro-tarfile MODIFIED ##
+        name = os.fspath(name)
+        if self.dereference:
+            is_dir = os.path.isdir(name)
+        else:
+            is_dir = os.path.isdir(name) and not os.path.islink(name)
+        relpath = os.path.basename(os.path.normpath(name))
+        self._add_matched(name, arcname, recursive, filter, matcher, relpath, is_dir, "")
+        #########################
+
+    def _add_matched(self, name, arcname, recursive, filter, matcher, relpath, is_dir, prefix):
+        """Add a path for ReproducibleTarFile.add with a PathMatcher. `relpath` is the path to
+        match, `is_dir` whether it is a directory, and `prefix` the relative path of its contents.
+        """
+        # Skip if somebody tries to archive the archive...
+        if self.name is not None and os.path.abspath(name) == self.name:
+            return
+
+        ## repro-tarfile MODIFIED ##
+        # Match before getting file metadata, so excluded paths cost nothing
+        if matcher._excluded(relpath, is_dir):
+            return
+        selected = matcher._included(relpath, is_dir)
+        if not selected and not is_dir:
+            return
+        #########################
+
+        # Create a TarInfo object from the file.
+        tarinfo = self.gettarinfo(name, arcname)
+
+        if tarinfo is None:
+            return
+
+        # Change or exclude the TarInfo object.
+        if filter is not None and selected:
+            tarinfo = filter(tarinfo)
+            if tarinfo is None:
+                return
+
+        # Append the tar header and data to the archive.
+        if tarinfo.isreg():
+            with builtins.open(name, "rb") as f:
+                self.addfile(tarinfo, f)
+
+        elif tarinfo.isdir():
+            ## repro-tarfile MODIFIED ##
+            # Directories that aren't selected are still walked for selected paths inside them
+            if selected:
+                self.addfile(tarinfo)
+            if recursive:
+                with os.scandir(name) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+                for entry in entries:
+                    child_relpath = prefix + entry.name
+                    self._add_matched(
+                        entry.path,
+                        os.path.join(arcname, entry.name),
+                        recursive,
+                        filter,
+                        matcher,
+                        child_relpath,
+                        entry.is_dir(follow_symlinks=self.dereference),
+                        child_relpath + "/",
+                    )
+            #########################
+
+        else:
+            self.addfile(tarinfo)
+
+    def add_paths(self, names, arcnames=None, *, filter=None, jobs: int = 1) -> None:
+        """Add files to the archive in the given order, without recursing into directories. This
+        is equivalent to calling add(name, arcname, recursive=False, filter=filter) for each
+        name, but with `jobs` greater than 1, the list is split into contiguous shards that are
+        built in parallel by worker processes. Each worker does the stat, read, and header
+        encoding for its shard and writes an uncompressed partial tar stream; the shards are then
+        written to this archive in order. Compression still happens in this process, so the
+        archive is byte-for-byte identical to adding the files one at a time.
+
+        With workers, the stat, header, and read timings of ArchiveStats are measured in the
+        workers, and shards go through temporary files, so uncompressed archives gain less from
+        them than compressed ones. Members are still recorded one by one, in stats and in
+        ArchiveMismatchError.
+
+        Args:
+            names: Sequence of paths of files to add.
+            arcnames: Optional sequence of alternative names in the archive, one per name.
+            filter: Optional function that takes a TarInfo and returns a changed TarInfo, or None
+                to exclude it. Must be picklable when jobs is greater than 1.
+            jobs: Number of worker processes.
+        """
+        self._check("awx")  # type: ignore[attr-defined]
+        names = list(names)
+        arcnames = names if arcnames is None else list(arcnames)
+        if len(arcnames) != len(names):
+            raise ValueError("names and arcnames must have the same length")
+        if jobs <= 1 or len(names) < 2:
+            for name, arcname in zip(names, arcnames):
+                self.add(name, arcname, recursive=False, filter=filter)
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+        import tempfile
+
+        # Skip if somebody tries to archive the archive, like TarFile.add does
+        members = [
+            (name, arcname)
+            for name, arcname in zip(names, arcnames)
+            if self.name is None or os.path.abspath(name) != self.name
+        ]
+        shard_size = -(-len(members) // (jobs * _SHARDS_PER_JOB))
+        shards = [members[i : i + shard_size] for i in range(0, len(members), shard_size)]
+
+        # Workers can't see hard links to files in earlier shards, so work out from a quick
+        # lstat pass which inodes earlier shards will have recorded
+        inodes = dict(self.inodes)  # type: ignore[attr-defined]
+        shard_inodes = []
+        for shard in shards:
+            shard_inodes.append(dict(inodes))
+            if self.dereference:
+                continue
+            for name, arcname in shard:
+                statres = os.lstat(name)
+                if not stat.S_ISREG(statres.st_mode) or not statres.st_ino:
+                    continue
+                inode = (statres.st_ino, statres.st_dev)
+                arcname = _tar_arcname(arcname)
+                if statres.st_nlink > 1 and inode in inodes and arcname != inodes[inode]:
+                    continue  # Will be added as a hard link
+                inodes[inode] = arcname
+
+        boundaries = self._fragment_boundaries
+        fragment_size = None if boundaries is None else boundaries.fragment_size
+        segments = self._segment_ranges
+        stats = self.stats
+        options = {
+            "format": self.format,
+            "tarinfo": self.tarinfo,
+            "dereference": self.dereference,
+            "encoding": self.encoding,
+            "errors": self.errors,
+            "copybufsize": self.copybufsize,  # type: ignore[attr-defined]
+            "keep_members": self.member_index is None,
+            "io_policy": self.io_policy,
+        }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [
+                    executor.submit(
+                        _build_shard,
+                        shard,
+                        filter,
+                        shard_inodes[i],
+                        options,
+                        tmpdir,
+                        fragment_size,
+                        segments is not None,
+                        stats is not None,
+                    )
+                    for i, shard in enumerate(shards)
+                ]
+                for future in futures:
+                    (
+                        shard_path,
+                        size,
+                        shard_members,
+                        spans,
+                        new_inodes,
+                        fragment_ends,
+                        segment_ranges,
+                        shard_stats,
+                        dir_names,
+                    ) = future.result()
+                    # Fragment boundaries and segments must be known before the data is written
+                    if boundaries is not None:
+                        boundaries.ends.extend(self.offset + end for end in fragment_ends)
+                    if segments is not None:
+                        segments.ranges.extend(
+                            (self.offset + start, self.offset + end)
+                            for start, end in segment_ranges
+                        )
+                    if stats is not None:
+                        stats._merge_shard(shard_stats)
+                    # Copy member by member, so that stats and verify errors are attributed
+                    member_stats = None if shard_stats is None else iter(shard_stats.members)
+                    with builtins.open(shard_path, "rb") as fp:
+                        for name, start, end in spans:
+                            if member_stats is not None:
+                                stats._resume_member(next(member_stats))  # type: ignore[union-attr]
+                            try:
+                                copyfileobj(
+                                    fp, self.fileobj, end - start, bufsize=_SHARD_COPY_BUFSIZE
+                                )
+                            except ArchiveMismatchError as e:
+                                if e.member is None:
+                                    e.member = name
+                                raise
+                            if member_stats is not None:
+                                stats._finish_member()  # type: ignore[union-attr]
+                    os.remove(shard_path)
+                    if self.member_index is None:
+                        self.members.extend(shard_members)  # type: ignore[attr-defined]
+                    else:
+                        self.member_index._extend(shard_members, self.offset)
+                    self.offset += size
+                    for inode, arcname in new_inodes.items():
+                        self.inodes.setdefault(inode, arcname)  # type: ignore[attr-defined]
+                    self._dir_names.update(dir_names)
+
+    def estimate_size(self, names, arcnames=None, *, filter=None) -> int:
+        """Returns the size in bytes that the uncompressed tar stream of this archive will have
+        after adding the given files with add_paths and closing it, from file metadata only
+        without reading any file contents. For uncompressed archives, this is the exact size of
+        the archive file, if the files don't change before they are added.
+
+        Args:
+            names: Sequence of paths of files to add.
+            arcnames: Optional sequence of alternative names in the archive, one per name.
+            filter: Optional function that takes a TarInfo and returns a changed TarInfo, or None
+                to exclude it, as for add_paths.
+        """
+        self._check("awx")  # type: ignore[attr-defined]
+        names = list(names)
+        arcnames = names if arcnames is None else list(arcnames)
+        if len(arcnames) != len(names):
+            raise ValueError("names and arcnames must have the same length")
+        fixed_mtime = mtime()
+        reg_mode = 0o100000 | file_mode()
+        directory_mode = 0o40000 | dir_mode()
+        offset = self.offset
+        # Hard links depend on the files added before, so track them without changing the archive
+        inodes = self.inodes  # type: ignore[has-type]
+        self.inodes = dict(inodes)
+        try:
+            for name, arcname in zip(names, arcnames):
+                if self.name is not None and os.path.abspath(name) == self.name:
+                    continue
+                tarinfo = self._gettarinfo(name, arcname, None)
+                if tarinfo is not None and filter is not None:
+                    tarinfo = filter(tarinfo)
+                if tarinfo is None:
+                    continue
+                # Header sizes can depend on the metadata that addfile overwrites
+                tarinfo.mtime = fixed_mtime
+                tarinfo.mode = directory_mode if tarinfo.isdir() else reg_mode
+                header = self._header_encoder.encode(
+                    tarinfo, self.format, self.encoding, self.errors
+                )
+                offset += len(header)
+                if tarinfo.isreg():
+                    offset += -(-tarinfo.size // BLOCKSIZE) * BLOCKSIZE
+        finally:
+            self.inodes = inodes
+        # End-of-archive marker, padded to a full record
+        offset += 2 * BLOCKSIZE
+        return -(-offset // RECORDSIZE) * RECORDSIZE
+
+    def preallocate(self, size: int) -> bool:
+        """Reserve disk space for the archive file with os.posix_fallocate up to `size` bytes,
+        such as from estimate_size. This reduces fragmentation and raises OSError before
+        anything is written if the disk doesn't have enough space. When the archive is closed, the
+        file is truncated to the bytes written, so the archive is the same if the size was too
+        large. Returns whether space was reserved, which is only done for uncompressed archives
+        written to regular files on platforms and file systems that support it.
+        """
+        import errno
+
+        self._check("awx")  # type: ignore[attr-defined]
+        raw = self._raw_fileobj
+        if raw is None or not hasattr(os, "posix_fallocate") or size <= self.offset:
+            return False
+        fd = raw.fileno()
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            return False
+        try:
+            os.posix_fallocate(fd, self.offset, size - self.offset)
+        except OSError as e:
+            if e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                return False
+            raise
+        self._preallocated = True
+        return True
+
+
+_SHARDS_PER_JOB = 4
+"""Number of shards per worker process used by ReproducibleTarFile.add_paths. Using more shards
+than workers balances load and lets the parent start writing earlier."""
+
+_SHARD_COPY_BUFSIZE = 1024 * 1024
+
+
+def _find_archive_end(read, skip) -> int:
+    """Returns the offset of the end-of-archive marker of a tar stream, relative to where reading
+    starts, by reading headers and skipping over member data with the given functions. Only the
+    fields needed to find the next header are parsed. Returns the end of the stream if it has no
+    end-of-archive marker."""
+    from tarfile import (  # type: ignore[attr-defined]
+        AREGTYPE,
+        CONTTYPE,
+        GNUTYPE_LONGLINK,
+        GNUTYPE_LONGNAME,
+        GNUTYPE_SPARSE,
+        SOLARIS_XHDTYPE,
+        SUPPORTED_TYPES,
+        XGLTYPE,
+        XHDTYPE,
+        HeaderError,
+        calc_chksums,
+        nti,
+    )
+
+    offset = 0
+    pax_size = None
+    while True:
+        buf = read(BLOCKSIZE)
+        if not buf or buf == NUL * BLOCKSIZE:
+            return offset
+        if len(buf) < BLOCKSIZE:
+            raise ReadError("unexpected end of data")
+        try:
+            if nti(buf[148:156]) not in calc_chksums(buf):
+                raise ReadError("bad checksum")
+            size = nti(buf[124:136])
+        except (HeaderError, ValueError):
+            raise ReadError("invalid header") from None
+        member_type = buf[156:157]
+        blocks = -(-size // BLOCKSIZE) * BLOCKSIZE
+        if member_type in (XHDTYPE, XGLTYPE, SOLARIS_XHDTYPE):
+            data = read(blocks)
+            if member_type != XGLTYPE:
+                # A pax header can override the size of the next member
+                pax_size = _pax_size(data[:size])
+        elif member_type == GNUTYPE_SPARSE:
+            raise ReadError("appending to archives with GNU sparse members is not supported")
+        elif member_type in SUPPORTED_TYPES and member_type not in (
+            REGTYPE,
+            AREGTYPE,
+            CONTTYPE,
+            GNUTYPE_LONGNAME,
+            GNUTYPE_LONGLINK,
+        ):
+            # Like TarFile, ignore the size of members that have no data
+            blocks = 0
+            pax_size = None
+        else:
+            if pax_size is not None and member_type not in (GNUTYPE_LONGNAME, GNUTYPE_LONGLINK):
+                blocks = -(-pax_size // BLOCKSIZE) * BLOCKSIZE
+                pax_size = None
+            if member_type == AREGTYPE and buf[:100].split(NUL, 1)[0].endswith(b"/"):
+                # Old-style directory
+                blocks = 0
+            skip(blocks)
+        offset += BLOCKSIZE + blocks
+
+
+def _pax_size(data: bytes):
+    """Returns the size from pax extended header records, or None if there is none."""
+    size = None
+    pos = 0
+    try:
+        while pos < len(data) and data[pos] != 0:
+            space = data.index(b" ", pos)
+            length = int(data[pos:space])
+            keyword, _, value = data[space + 1 : pos + length - 1].partition(b"=")
+            if keyword == b"size":
+                size = int(value)
+            pos += length
+    except ValueError:
+        raise ReadError("invalid pax header") from None
+    return size
+
+
+def _tar_arcname(arcname) -> str:
+    """Normalize an archive name the same way TarFile.gettarinfo does."""
+    arcname = os.fspath(arcname)
+    _, arcname = os.path.splitdrive(arcname)
+    arcname = arcname.replace(os.sep, "/")
+    return arcname.lstrip("/")
+
+
+def _build_shard(
+    members, filter, inodes, options, directory, fragment_size=None, segments=False, stats=False
+):
+    """Worker process function for ReproducibleTarFile.add_paths. Writes the given members as a
+    partial tar stream without an end-of-archive marker to a temporary file in `directory`.
+    Returns the file path, the number of bytes written, the member TarInfo objects (or the
+    MemberIndex if not keeping members), the name, start, and end offsets of each member, the
+    inodes recorded for hard link detection, the offsets where gzip fragments end if
+    `fragment_size` is given, the ranges of incompressible member data if `segments` is true,
+    the ArchiveStats of the shard if `stats` is true, and the names of directory members.
+    """
+    import tempfile
+
+    shard_stats = ArchiveStats() if stats else None
+    spans = []
+    fd, shard_path = tempfile.mkstemp(suffix=".tar", dir=directory)
+    with builtins.open(fd, "wb") as fileobj:
+        tar = ReproducibleTarFile(fileobj=fileobj, mode="w", stats=shard_stats, **options)
+        tar.inodes = dict(inodes)  # type: ignore[attr-defined]
+        if fragment_size is not None:
+            tar._fragment_boundaries = _FragmentBoundaries(fragment_size)
+        if segments:
+            tar._segment_ranges = _SegmentRanges()
+        for name, arcname in members:
+            start = tar.offset
+            tar.add(name, arcname, recursive=False, filter=filter)
+            if tar.offset != start:
+                if tar.member_index is None:
+                    member_name = tar.members[-1].name  # type: ignore[attr-defined]
                 else:
+                    member_name = tar.member_index[-1].name
+                spans.append((member_name, start, tar.offset))
+        # Don't close the TarFile, which would write the end-of-archive marker
+        if tar._write_buffer is not None:
+            tar._write_buffer.flush_buffer()
+    new_inodes = {
+        inode: arcname
+        for inode, arcname in tar.inodes.items()  # type: ignore[attr-defined]
+        if inode not in inodes
+    }
+    fragment_ends = [] if fragment_size is None else list(tar._fragment_boundaries.ends)
+    segment_ranges = [] if not segments else list(tar._segment_ranges.ranges)
+    if tar.member_index is None:
+        shard_members = tar.members  # type: ignore[attr-defined]
+    else:
+        shard_members = tar.member_index
+    return (
+        shard_path,
+        tar.offset,
+        shard_members,
+        spans,
+        new_inodes,
+        fragment_ends,
+        segment_ranges,
+        shard_stats,
+        tar._dir_names,
+    )
+
+
+_BATCH_SPEC_KEYS = {
+    "output",
+    "inputs",
+    "compression",
+    "recursion",
+    "exclude",
+    "include",
+    "rsyncable",
+}
+
+
+def build_archives(specs, *, jobs: int = 1):
+    """Build many archives from one list of specs, sharing work between archives whose inputs
+    overlap. Each input tree is walked once, paths used by more than one archive are checked with
+    one lstat, and members used by more than one archive are read and encoded once and copied
+    into each archive. Archives are built in parallel with `jobs` worker processes. Each archive
+    is byte-for-byte identical to adding its sorted, deduplicated paths one at a time without
+    recursion, like rptar does. Inputs are walked with PathMatcher.walk, like rptar, so symbolic
+    links to directories are added as links and not walked.
+
+    Args:
+        specs: Iterable of mappings, one per archive, with the keys:
+            - output: Path of the archive file to write.
+            - inputs: List of paths of files and directories to add.
+            - compression: Optional compression, one of "gz", "bz2", or "xz".
+            - recursion: Whether to add the contents of directories. Defaults to True.
+            - exclude, include: Optional lists of patterns for a PathMatcher.
+            - rsyncable: Whether to use rsyncable gzip compression.
+        jobs: Number of worker processes.
+
+    Returns:
+        List of dicts in the order of `specs`, with the output path, the SHA-256 hex digest and
+        size in bytes of the archive, the number of members, and the seconds spent writing it.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import repeat
+    import tempfile
+
+    specs = [dict(spec) for spec in specs]
+    for spec in specs:
+        unknown = set(spec) - _BATCH_SPEC_KEYS
+        if unknown:
+            raise ValueError(f"unknown archive spec keys: {', '.join(sorted(unknown))}")
+        if "output" not in spec or "inputs" not in spec:
+            raise ValueError("archive specs need an output and inputs")
+        if isinstance(spec["inputs"], (str, bytes, os.PathLike)):
+            raise TypeError("inputs must be a list of paths")
+
+    # Expand inputs, walking each distinct input once
+    walks: dict = {}
+    archive_paths = []
+    for spec in specs:
+        recursion = spec.get("recursion", True)
+        exclude = tuple(spec.get("exclude") or ())
+        include = tuple(spec.get("include") or ())
+        selected = set()
+        for top in spec["inputs"]:
+            key = (os.fspath(top), recursion, exclude, include)
+            if key not in walks:
+                matcher = PathMatcher(exclude=exclude, include=include)
+                walks[key] = list(matcher.walk(key[0], recursive=recursion))
+            selected.update(walks[key])
+        archive_paths.append(_sorted_paths(selected))
+
+    # Members used by more than one archive are encoded once. Hard links depend on what else is
+    # in the archive, so files with more than one link are always added per archive.
+    uses: dict = {}
+    for paths in archive_paths:
+        for path in paths:
+            uses[path] = uses.get(path, 0) + 1
+    outputs = {os.path.abspath(spec["output"]) for spec in specs}
+    shared = []
+    for path, count in uses.items():
+        if count < 2 or os.path.abspath(path) in outputs:
+            continue
+        statres = os.lstat(path)
+        if stat.S_ISDIR(statres.st_mode) or stat.S_ISLNK(statres.st_mode):
+            shared.append(path)
+        elif stat.S_ISREG(statres.st_mode) and statres.st_nlink <= 1:
+            shared.append(path)
+    shared = _sorted_paths(shared)
+
+    with tempfile.TemporaryDirectory() as tmpdir, contextlib.ExitStack() as stack:
+        mapper = map
+        if jobs > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+            mapper = executor.map  # type: ignore[assignment]
+        shared_members = {}
+        if shared:
+            shard_size = -(-len(shared) // (max(jobs, 1) * _SHARDS_PER_JOB))
+            shards = [
+                [(path, path) for path in shared[i : i + shard_size]]
+                for i in range(0, len(shared), shard_size)
+            ]
+            options = {"keep_members": False}
+            results = mapper(
+                _build_shard, shards, repeat(None), repeat({}), repeat(options), repeat(tmpdir)
+            )
+            for shard, (shard_path, size, index, *_) in zip(shards, results):
+                ends = [entry.offset for entry in index][1:] + [size]
+                for (path, _), entry, end in zip(shard, index, ends):
+                    shared_members[path] = (shard_path, end - entry.offset, entry)
+
+        builds = []
+        for spec, paths in zip(specs, archive_paths):
+            mode = "w"
+            if spec.get("compression"):
+                mode += ":" + spec["compression"]
+            kwargs = {"rsyncable": True} if spec.get("rsyncable") else {}
+            items = [(path, shared_members.get(path)) for path in paths]
+            builds.append((os.fspath(spec["output"]), mode, items, kwargs))
+        return list(mapper(_build_batch_archive, *zip(*builds)))
+
+
+def _sorted_paths(paths) -> list:
+    """Sort and deduplicate paths as Path objects, in the same order as rptar."""
+    from pathlib import Path
+
+    return [os.fspath(path) for path in sorted({Path(path) for path in paths})]
+
+
+class _HashingWriter:
+    """Proxy for a writable file object that hashes the bytes written."""
+
+    def __init__(self, fileobj, hash) -> None:
+        self._fileobj = fileobj
+        self._hash = hash
+
+    def write(self, data):
+        self._hash.update(data)
+        return self._fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+def _build_batch_archive(output, mode, items, kwargs):
+    """Worker process function for build_archives. Writes one archive from a list of paths, each
+    with the location of its encoded member if it was shared with other archives, and returns its
+    summary."""
+    import hashlib
+
+    start = perf_counter()
+    digest = hashlib.sha256()
+    with contextlib.ExitStack() as stack:
+        raw = stack.enter_context(builtins.open(output, "wb"))
+        fileobj = _HashingWriter(raw, digest)
+        with ReproducibleTarFile.open(
+            fileobj=fileobj, mode=mode, keep_members=False, **kwargs
+        ) as tar:
+            shard_files = {}
+            for path, shared in items:
+                if shared is None:
+                    tar.add(path, recursive=False)
+                    continue
+                shard_path, length, entry = shared
+                if shard_path not in shard_files:
+                    shard_files[shard_path] = stack.enter_context(builtins.open(shard_path, "rb"))
+                shard_file = shard_files[shard_path]
+                shard_file.seek(entry.offset)
+                tar._add_encoded(shard_file, length, entry)
+        size = raw.tell()
+    return {
+        "output": output,
+        "sha256": digest.hexdigest(),
+        "size": size,
+        "members": len(tar.member_index),  # type: ignore[arg-type]
+        "seconds": perf_counter() - start,
+    }
+
+
+def _open_tee_output(target, filemode, comptype, compresslevel, preset, level, rsyncable):
+    """Open an output for ReproducibleTarFile.teeopen, with the same compressor settings as the
+    corresponding TarFile open method."""
+    if isinstance(target, (str, bytes, os.PathLike)):
+        raw = builtins.open(target, filemode + "b")
+        close_raw = True
+    else:
+        raw = target
+        close_raw = False
+    try:
+        compressor = _open_compressor(
+            raw, filemode, comptype, compresslevel, preset, level, rsyncable
+        )
+    except BaseException:
+        if close_raw:
+            raw.close()
+        raise
+    return _TeeOutput(compressor, raw, close_raw)
+
+
+def _open_compressor(raw, filemode, comptype, compresslevel, preset, level, rsyncable):
+    """Returns a compressor that writes to `raw` with the same settings as the corresponding
+    TarFile open method, or `raw` itself for uncompressed archives."""
+    if comptype in ("", "tar"):
+        return raw
+    elif comptype == "gz":
+        from gzip import GzipFile
+
+        compressor = GzipFile("", filemode + "b", compresslevel, raw, mtime=mtime())
+        if rsyncable:
+            return _RsyncableGzipWriter(compressor)
+        return compressor
+    elif comptype == "bz2":
+        from bz2 import BZ2File
+
+        return BZ2File(raw, filemode, compresslevel=compresslevel)
+    elif comptype == "xz":
+        from lzma import LZMAFile
+
+        return LZMAFile(raw, filemode, preset=preset)
+    elif comptype == "zst":
+        try:
+            from compression.zstd import ZstdFile  # type: ignore[import-not-found]
+        except ImportError:
+            raise CompressionError("compression.zstd module is not available") from None
+        return ZstdFile(raw, filemode, level=level)
+    raise CompressionError(f"unknown compression type {comptype!r}")
+
+
+_LEVEL_COSTS = {
+    "gz": dict(zip(range(0, 10), (0.2, 1.0, 1.1, 1.3, 1.5, 2.1, 2.9, 3.6, 5.8, 7.5))),
+    "bz2": dict(zip(range(1, 10), (1.0, 1.0, 1.0, 1.1, 1.1, 1.1, 1.1, 1.2, 1.2))),
+    "xz": dict(zip(range(0, 10), (1.0, 1.3, 2.0, 3.0, 5.0, 7.0, 9.0, 9.5, 10.0, 10.5))),
+}
+"""Approximate CPU time of compressing at each level relative to the fastest level that compresses,
+which is level 1 for gzip and bzip2 and preset 0 for xz. Gzip level 0 only stores the data, so
+it's cheaper than that. These are fixed, rather than measured, so that the level chosen for a time
+target doesn't depend on the speed of the machine."""
+
+_SAMPLE_CHUNK_SIZE = 64 * 1024
+
+
+def _read_sample(paths, size: int) -> bytes:
+    """Returns up to `size` bytes read from the middle of regular files evenly spaced through
+    `paths`, which only depends on the list of paths and the file contents."""
+    files = [path for path in paths if stat.S_ISREG(os.lstat(path).st_mode)]
+    if not files or size <= 0:
+        return b""
+    count = min(len(files), max(1, size // _SAMPLE_CHUNK_SIZE))
+    per_file = size // count
+    chunks = []
+    for i in range(count):
+        with builtins.open(files[i * len(files) // count], "rb") as fp:
+            file_size = os.fstat(fp.fileno()).st_size
+            fp.seek(max(0, (file_size - per_file) // 2))
+            chunks.append(fp.read(per_file))
+    return b"".join(chunks)
+
+
+def _compress_sample(comptype: str, sample: bytes, level: int) -> int:
+    if comptype == "gz":
+        import gzip
+
+        return len(gzip.compress(sample, level, mtime=0))
+    elif comptype == "bz2":
+        import bz2
+
+        return len(bz2.compress(sample, level))
+    import lzma
+
+    return len(lzma.compress(sample, preset=level))
+
+
+def choose_compression_level(
+    comptype: str,
+    paths,
+    *,
+    size_tolerance=None,
+    max_cost=None,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+) -> int:
+    """Choose a compression level by compressing a sample of the input files at each level. The
+    sample is read from regular files evenly spaced through `paths`, so the chosen level, and so
+    the archive bytes, only depend on the paths and file contents and not on the machine.
+
+    Exactly one target must be given:
+
+    - With `size_tolerance`, returns the lowest level whose compressed sample is at most that
+      fraction larger than the smallest compressed sample, e.g., 0.01 for within 1%.
+    - With `max_cost`, returns the level with the smallest compressed sample among the levels
+      whose approximate CPU time is at most that multiple of the fastest compressing level's,
+      level 1 for gzip and bzip2 or preset 0 for xz, e.g., 3.0. The relative times are fixed
+      estimates rather than measurements.
+
+    Levels are 0-9 for gzip and xz and 1-9 for bzip2. Gzip level 0 stores the data without
+    compressing it, and is chosen when the sample is incompressible.
+
+    Args:
+        comptype: Compression, one of "gz", "bz2", or "xz".
+        paths: Sorted list of the paths that will be added to the archive.
+        size_tolerance: Allowed fraction of size increase over the smallest sample output.
+        max_cost: Allowed multiple of the fastest compressing level's CPU time.
+        sample_size: Maximum number of bytes of input to sample.
+
+    Returns:
+        The level to pass as `compresslevel` for gzip and bzip2, or `preset` for xz.
+    """
+    if comptype not in _LEVEL_COSTS:
+        raise CompressionError(f"unknown compression type {comptype!r}")
+    if (size_tolerance is None) == (max_cost is None):
+        raise ValueError("Exactly one of size_tolerance and max_cost must be given")
+    costs = _LEVEL_COSTS[comptype]
+    levels = list(costs)
+    if max_cost is not None:
+        levels = [level for level, cost in costs.items() if cost <= max_cost] or levels[:1]
+    sample = _read_sample(paths, sample_size)
+    sizes = {level: _compress_sample(comptype, sample, level) for level in levels}
+    if max_cost is not None:
+        # Lowest level among those with the smallest output
+        return min(levels, key=lambda level: (sizes[level], level))
+    limit = min(sizes.values()) * (1 + size_tolerance)
+    return min(level for level in levels if sizes[level] <= limit)
+
+
+class PartUploadSink:
+    """Writable file object that splits the bytes written to it into parts of exactly `part_size`
+    bytes, except for the last one, and uploads them concurrently with a pool of worker threads
+    while later parts are still being written. Pass it as the `fileobj` argument of
+    repro_tarfile.open. Part boundaries only depend on the archive bytes, so reproducible
+    archives give identical parts.
+
+    At most `max_pending` parts are queued or being uploaded at a time. Writes block when the
+    limit is reached, so memory use is bounded by about (max_pending + 1) * part_size bytes.
+
+    Subclasses implement upload_part, and may implement begin, complete, and abort. Closing the
+    sink uploads the last part and calls complete. If an upload fails, abort is called and the
+    error is raised from the next write or from close. When the sink is used as a context
+    manager, the upload is aborted instead of completed if the block raises an exception.
+
+    Args:
+        part_size: Size in bytes of each part.
+        max_workers: Number of worker threads uploading parts.
+        max_pending: Maximum number of parts queued or being uploaded. Defaults to twice
+            max_workers.
+    """
+
+    def __init__(self, part_size=DEFAULT_PART_SIZE, max_workers=4, max_pending=None) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+        import threading
+
+        if part_size < 1:
+            raise ValueError("part_size must be positive")
+        if max_workers < 1:
+            raise ValueError("max_workers must be positive")
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.max_pending = 2 * max_workers if max_pending is None else max_pending
+        self.parts: list = []
+        self.closed = False
+        self._buffer = bytearray()
+        self._offset = 0
+        self._part_count = 0
+        self._pending: list = []
+        self._aborted = False
+        # Threads are only started when parts are submitted
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="repro-tarfile-upload"
+        )
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def begin(self) -> None:
+        """Called before the first part is uploaded."""
+
+    def upload_part(self, part_number: int, data: bytes):
+        """Upload one part. Called from worker threads with part numbers starting at 1. The
+        return value, such as an ETag, is passed to complete."""
+        raise NotImplementedError
+
+    def complete(self, parts) -> None:
+        """Called when all parts have been uploaded, with a list of (part_number, result) tuples
+        in order."""
+
+    def abort(self) -> None:
+        """Called when the upload fails or is aborted."""
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self) -> None:
+        # Parts have a fixed size, so there is nothing to do until close
+        self._collect(wait=False)
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed sink")
+        self._collect(wait=False)
+        size = len(data)
+        buffer = self._buffer
+        buffer += data
+        self._offset += size
+        part_size = self.part_size
+        if len(buffer) >= part_size:
+            start = 0
+            while len(buffer) - start >= part_size:
+                self._submit(bytes(buffer[start : start + part_size]))
+                start += part_size
+            del buffer[:start]
+        return size
+
+    def _submit(self, data: bytes) -> None:
+        if self._part_count == 0:
+            self.begin()
+        # Block until a slot is free, so that memory for pending parts is bounded
+        while not self._slots.acquire(timeout=0.1):
+            self._collect(wait=False)
+        self._part_count += 1
+        try:
+            future = self._executor.submit(self.upload_part, self._part_count, data)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        self._pending.append((self._part_count, future))
+
+    def _collect(self, wait: bool) -> None:
+        """Move results of finished uploads to `parts` in order, waiting for all of them if
+        `wait` is true. Aborts and raises if an upload failed."""
+        pending = self._pending
+        try:
+            while pending:
+                part_number, future = pending[0]
+                if not wait and not future.done():
+                    break
+                self.parts.append((part_number, future.result()))
+                del pending[0]
+            # Raise failures early, even if earlier parts are still uploading
+            for _, future in pending:
+                if future.done() and future.exception() is not None:
+                    future.result()
+        except BaseException:
+            self._abort()
+            raise
+
+    def _abort(self) -> None:
+        if self._aborted:
+            return
+        self._aborted = True
+        self.closed = True
+        for _, future in self._pending:
+            future.cancel()
+        self._pending = []
+        self._executor.shutdown(wait=True)
+        self.abort()
+
+    def close(self) -> None:
+        """Upload the last part, wait for all uploads to finish, and complete the upload."""
+        if self.closed:
+            return
+        try:
+            if self._buffer or self._part_count == 0:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            self._collect(wait=True)
+            self.complete(self.parts)
+        except BaseException:
+            self._abort()
+            raise
+        finally:
+            self.closed = True
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        elif not self.closed:
+            self._abort()
+
+
+class HTTPMultipartSink(PartUploadSink):
+    """PartUploadSink that uploads to an S3-compatible object store with the multipart upload
+    API over HTTP or HTTPS. Each worker thread keeps its own persistent connection, so at most
+    max_workers connections are open.
+
+    Requests aren't signed. Pass authentication headers with `headers`, use an endpoint or
+    gateway that doesn't need request signing, or override `request` in a subclass to sign
+    requests.
+
+    Args:
+        url: URL of the object to create, e.g., 'https://bucket.example.com/archive.tar.gz'.
+        part_size: Size in bytes of each part. S3 requires at least 5 MiB for all parts but the
+            last.
+        max_workers: Number of worker threads and connections uploading parts.
+        max_pending: Maximum number of parts queued or being uploaded.
+        headers: Optional extra headers sent with every request.
+        timeout: Timeout in seconds for network operations.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        part_size=DEFAULT_PART_SIZE,
+        max_workers=4,
+        max_pending=None,
+        headers=None,
+        timeout: float = 60,
+    ) -> None:
+        import threading
+        from urllib.parse import urlsplit
+
+        super().__init__(part_size=part_size, max_workers=max_workers, max_pending=max_pending)
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"unsupported URL scheme: {url}")
+        self.url = url
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self.upload_id = ""
+        self._scheme = parts.scheme
+        self._netloc = parts.netloc
+        self._path = parts.path or "/"
+        self._local = threading.local()
+        # All connections, so that idle ones are closed when the upload is done
+        self._connections: list = []
+
+    def _connection(self, new: bool = False):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or new:
+            import http.client
+
+            if conn is not None:
+                conn.close()
+            cls = (
+                http.client.HTTPSConnection
+                if self._scheme == "https"
+                else http.client.HTTPConnection
+            )
+            conn = cls(self._netloc, timeout=self.timeout)
+            self._local.conn = conn
+            self._connections.append(conn)
+        return conn
+
+    def _close_connections(self) -> None:
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+
+    def _abort(self) -> None:
+        try:
+            super()._abort()
+        finally:
+            self._close_connections()
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self._close_connections()
+
+    def request(self, method: str, query: str, body: bytes = b"", headers=None):
+        """Send a request for the object URL with the given query string. Returns the response
+        status, headers, and body. Raises OSError if the response status is not successful.
+
+        PUT and DELETE requests are retried once on a new connection if the server closed an idle
+        one. Other requests are sent on a new connection and only retried if sending them failed,
+        since a POST that reached the server could start a second upload if it was sent again.
+        """
+        import http.client
+
+        headers = {**self.headers, **(headers or {})}
+        target = f"{self._path}?{query}"
+        idempotent = method in ("PUT", "DELETE")
+        for attempt in range(2):
+            conn = self._connection(new=attempt > 0 or not idempotent)
+            sent = False
+            try:
+                conn.request(method, target, body=body, headers=headers)
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                if attempt or (sent and not idempotent):
                     raise
-        return super().addfile(tarinfo=tarinfo_copy, fileobj=fileobj)
+        if not 200 <= response.status < 300:
+            raise OSError(
+                f"{method} {self.url}?{query} failed with HTTP {response.status}: {data[:200]!r}"
+            )
+        return response.status, response.headers, data
+
+    def begin(self) -> None:
+        _, _, data = self.request("POST", "uploads")
+        self.upload_id = _xml_find_text(data, "UploadId")
+
+    def upload_part(self, part_number: int, data: bytes):
+        from urllib.parse import quote
+
+        query = f"partNumber={part_number}&uploadId={quote(self.upload_id, safe='')}"
+        _, headers, _ = self.request("PUT", query, body=data)
+        etag = headers.get("ETag")
+        if etag is None:
+            raise OSError(f"PUT {self.url}?{query} returned no ETag")
+        return etag
+
+    def complete(self, parts) -> None:
+        from urllib.parse import quote
+        from xml.sax.saxutils import escape
+
+        body = "".join(
+            f"<Part><PartNumber>{part_number}</PartNumber><ETag>{escape(etag)}</ETag></Part>"
+            for part_number, etag in parts
+        )
+        body = f"<CompleteMultipartUpload>{body}</CompleteMultipartUpload>"
+        query = f"uploadId={quote(self.upload_id, safe='')}"
+        _, _, data = self.request("POST", query, body=body.encode())
+        # S3 can report errors with a successful status once the response has started
+        if b"<Error>" in data:
+            raise OSError(f"completing upload to {self.url} failed: {data[:200]!r}")
+
+    def abort(self) -> None:
+        from urllib.parse import quote
+
+        if not self.upload_id:
+            return
+        try:
+            self.request("DELETE", f"uploadId={quote(self.upload_id, safe='')}")
+        except OSError:
+            pass
+
+
+def _xml_find_text(data: bytes, tag: str) -> str:
+    """Returns the text of the first element with the tag in any namespace."""
+    from xml.etree import ElementTree
+
+    for element in ElementTree.fromstring(data).iter():
+        if element.tag == tag or element.tag.endswith("}" + tag):
+            return element.text or ""
+    raise OSError(f"no {tag} in response: {data[:200]!r}")
+
+
+class VolumeSink:
+    """Writable file object that writes the bytes written to it to numbered volume files of at
+    most `volume_size` bytes each, like the `split` utility but while the archive is being
+    written. Pass it as the `fileobj` argument of repro_tarfile.open. Volumes are named by
+    appending a zero-padded number starting at 0 to `name`, e.g., 'archive.tar.gz.000', so they
+    sort in order and can be joined with `cat archive.tar.gz.* > archive.tar.gz`. Every volume but
+    the last is exactly `volume_size` bytes, so volume boundaries only depend on the archive bytes
+    and reproducible archives give identical volumes.
+
+    If `on_volume` is given, it is called with the path of each volume once the volume is complete
+    and closed, from a pool of worker threads, so that volumes can be uploaded or checksummed while
+    later volumes are still being written. Results are collected in order in `volumes` as
+    (path, result) tuples. If a callback fails, the error is raised from the next write or from
+    close.
+
+    Args:
+        name: Path that volume numbers are appended to.
+        volume_size: Maximum size in bytes of each volume.
+        on_volume: Optional callable called with the path of each completed volume.
+        max_workers: Number of worker threads calling on_volume.
+        suffix_length: Number of digits in volume numbers. Writing more volumes than fit raises
+            OSError.
+    """
+
+    def __init__(
+        self, name, volume_size: int, on_volume=None, max_workers=1, suffix_length=3
+    ) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        if volume_size < 1:
+            raise ValueError("volume_size must be positive")
+        if max_workers < 1:
+            raise ValueError("max_workers must be positive")
+        self.name = os.fspath(name)
+        self.volume_size = volume_size
+        self.on_volume = on_volume
+        self.suffix_length = suffix_length
+        self.volumes: list = []
+        self.closed = False
+        self._offset = 0
+        self._volume_count = 0
+        self._volume_remaining = 0
+        self._pending: list = []
+        # Threads are only started when callbacks are submitted
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="repro-tarfile-volume"
+        )
+        self._fp = self._open_volume()
+
+    def volume_path(self, index: int) -> str:
+        """Returns the path of the volume with the given index, starting at 0."""
+        return f"{self.name}.{index:0{self.suffix_length}d}"
+
+    def _open_volume(self):
+        if self._volume_count >= 10**self.suffix_length:
+            raise OSError(f"more than {10**self.suffix_length} volumes for {self.name}")
+        path = self.volume_path(self._volume_count)
+        self._volume_count += 1
+        self._volume_remaining = self.volume_size
+        return builtins.open(path, "wb")
+
+    def _finish_volume(self) -> None:
+        self._fp.close()
+        path = self._fp.name
+        if self.on_volume is None:
+            self.volumes.append((path, None))
+        else:
+            self._pending.append((path, self._executor.submit(self.on_volume, path)))
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self) -> None:
+        self._fp.flush()
+        self._collect(wait=False)
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed sink")
+        self._collect(wait=False)
+        view = memoryview(data).cast("B")
+        size = len(view)
+        start = 0
+        while start < size:
+            if self._volume_remaining == 0:
+                # Only start a new volume when there is data for it, so there are no empty
+                # volumes at the end
+                self._finish_volume()
+                self._fp = self._open_volume()
+            end = min(size, start + self._volume_remaining)
+            self._fp.write(view[start:end])
+            self._volume_remaining -= end - start
+            start = end
+        self._offset += size
+        return size
+
+    def _collect(self, wait: bool) -> None:
+        """Move results of finished callbacks to `volumes` in order, waiting for all of them if
+        `wait` is true."""
+        pending = self._pending
+        while pending:
+            path, future = pending[0]
+            if not wait and not future.done():
+                break
+            del pending[0]
+            self.volumes.append((path, future.result()))
+        for _, future in pending:
+            if future.done() and future.exception() is not None:
+                future.result()
+
+    def close(self) -> None:
+        """Close the last volume and wait for all callbacks to finish."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._finish_volume()
+            self._collect(wait=True)
+        finally:
+            if not self._fp.closed:
+                self._fp.close()
+            for _, future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class VerifySink:
+    """Writable file object that compares the bytes written to it with an existing file instead
+    of writing them, to check that rebuilding an archive gives the same bytes without writing a
+    new file. Pass it as the `fileobj` argument of repro_tarfile.open with the same mode and
+    options as the existing archive. The first write that differs raises ArchiveMismatchError with
+    the offset of the first byte that differs, and later writes are ignored. close raises it if
+    the existing file is longer than what was written.
+
+    ReproducibleTarFile adds the name of the member being written to the error. Compressors and
+    the write buffer pass data on in batches, so the reported member can be a little after the
+    member whose data differs. Leave write_buffer_size at 0 to get the exact member for
+    uncompressed archives.
+
+    Args:
+        name: Path or readable binary file object of the existing archive. File objects are read
+            from their current position and are not closed.
+    """
+
+    def __init__(self, name) -> None:
+        if hasattr(name, "read"):
+            self.name = getattr(name, "name", None)
+            self._fp = name
+            self._close_fp = False
+        else:
+            self.name = os.fspath(name)
+            self._fp = builtins.open(name, "rb")
+            self._close_fp = True
+        self.mismatch: "ArchiveMismatchError | None" = None
+        self.closed = False
+        self._offset = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self) -> None:
+        pass
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed sink")
+        if not isinstance(data, (bytes, bytearray)):
+            # Comparing memoryviews is much slower than comparing bytes
+            data = bytes(data)
+        if self.mismatch is None:
+            expected = self._fp.read(len(data))
+            if expected != data:
+                index = next(
+                    (i for i, (a, b) in enumerate(zip(expected, data)) if a != b), len(expected)
+                )
+                self._fail(self._offset + index)
+        self._offset += len(data)
+        return len(data)
+
+    def _fail(self, offset: int):
+        self.mismatch = ArchiveMismatchError(self.name, offset)
+        raise self.mismatch
+
+    def close(self) -> None:
+        """Check that the existing file has no more bytes than were written, and close it."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.mismatch is None and self._fp.read(1):
+                self._fail(self._offset)
+        finally:
+            if self._close_fp:
+                self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class ConcurrentWriter:
+    """Writes members that are prepared by many threads to a ReproducibleTarFile in a fixed order.
+    Producers call submit from any thread with a sequence key for each member. Members are held in
+    a reorder buffer and written by a writer thread in key order as soon as all members with
+    earlier keys have been written, while producers read and prepare later members. The archive is
+    identical to calling addfile for each member in key order.
+
+    Keys are consecutive integers starting at `first_key`, so that the writer knows when the next
+    member is missing. When the data of members waiting in the buffer would exceed
+    `memory_budget` bytes, submit blocks until earlier members are written. The member with the
+    next key is always accepted, so producers should submit members roughly in key order, such as
+    from thread pool tasks created in key order. Otherwise, producers blocked on later members can
+    keep the next member from being submitted.
+
+    Don't use the archive from other threads until the writer is closed. TarInfo objects can be
+    created with TarInfo or with the archive's gettarinfo, but gettarinfo must not be called from
+    several threads at once.
+
+    Args:
+        tar: ReproducibleTarFile open for writing.
+        memory_budget: Maximum number of bytes of data held in the reorder buffer, except that a
+            member is always accepted when the buffer is empty.
+        first_key: Key of the first member.
+    """
+
+    def __init__(self, tar, memory_budget=DEFAULT_MEMORY_BUDGET, first_key: int = 0) -> None:
+        import threading
+
+        self.tar = tar
+        self.memory_budget = memory_budget
+        self._next_key = first_key
+        self._pending: dict = {}
+        self._buffered = 0
+        self._closed = False
+        self._error: "BaseException | None" = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="repro-tarfile-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, key: int, tarinfo: TarInfo, data=None) -> None:
+        """Add a member to the archive at position `key`. Blocks while the reorder buffer is
+        over the memory budget, unless this is the next member to be written.
+
+        Args:
+            key: Sequence key of the member.
+            tarinfo: TarInfo of the member, as for addfile.
+            data: Data of the member: a bytes-like object, a readable binary file object that
+                tarinfo.size bytes are read from in the calling thread, or None for members
+                without data.
+        """
+        if hasattr(data, "read"):
+            fileobj = data
+            data = fileobj.read(tarinfo.size)
+            if len(data) < tarinfo.size:
+                raise OSError("unexpected end of data")
+        elif data is not None and not isinstance(data, bytes):
+            data = bytes(data)
+        nbytes = 0 if data is None else len(data)
+        with self._condition:
+            while True:
+                self._check()
+                if key < self._next_key or key in self._pending:
+                    raise ValueError(f"member with key {key} was already submitted")
+                if (
+                    key == self._next_key
+                    or not self._pending
+                    or self._buffered + nbytes <= self.memory_budget
+                ):
+                    break
+                self._condition.wait()
+            self._pending[key] = (tarinfo, data, nbytes)
+            self._buffered += nbytes
+            self._condition.notify_all()
+
+    def _check(self) -> None:
+        if self._error is not None:
+            raise self._error
+        if self._closed:
+            raise ValueError("submit to closed writer")
+
+    def _run(self) -> None:
+        from io import BytesIO
+
+        condition = self._condition
+        while True:
+            with condition:
+                while self._next_key not in self._pending and not self._closed:
+                    condition.wait()
+                if self._next_key not in self._pending:
+                    return
+                tarinfo, data, nbytes = self._pending.pop(self._next_key)
+            try:
+                self.tar.addfile(tarinfo, None if data is None else BytesIO(data))
+            except BaseException as e:
+                with condition:
+                    self._error = e
+                    condition.notify_all()
+                return
+            with condition:
+                self._next_key += 1
+                self._buffered -= nbytes
+                condition.notify_all()
+
+    def close(self) -> None:
+        """Wait until all submitted members are written. Raises the error from writing a member if
+        there was one, or ValueError if a key is missing."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        if self._pending:
+            raise ValueError(
+                f"member with key {self._next_key} was never submitted, so "
+                f"{len(self._pending)} later members were not written"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+            return
+        # Stop writing without hiding the original error
+        with self._condition:
+            self._closed = True
+            self._pending.clear()
+            self._condition.notify_all()
+        self._thread.join()
 
 
 open = ReproducibleTarFile.open
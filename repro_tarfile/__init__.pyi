@@ -1,14 +1,231 @@
 from gzip import _ReadableFileobj as _GzipReadableFileobj
 from gzip import _WritableFileobj as _GzipWritableFileobj
-from tarfile import TarFile, _Fileobj
+from tarfile import TarError, TarFile, _Fileobj
 from tarfile import TarInfo as TarInfo
-from typing import Literal, Mapping, Self, overload
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Literal,
+    Mapping,
+    NamedTuple,
+    Self,
+    overload,
+)
 
-from _typeshed import ReadableBuffer, StrOrBytesPath, SupportsRead, WriteableBuffer
+from _typeshed import ReadableBuffer, StrOrBytesPath, StrPath, SupportsRead, WriteableBuffer
 
-__all__ = ["open", "ReproducibleTarFile", "TarInfo"]
+DEFAULT_WRITE_BUFFER_SIZE: int
+DEFAULT_PART_SIZE: int
+DEFAULT_SPOOL_SIZE: int
+DEFAULT_MEMORY_BUDGET: int
+DEFAULT_SAMPLE_SIZE: int
+IO_POLICIES: tuple[None, Literal["stream"]]
+
+__all__ = [
+    "open",
+    "ArchiveCache",
+    "ArchiveMismatchError",
+    "ArchiveStats",
+    "ConcurrentWriter",
+    "FragmentCache",
+    "HTTPMultipartSink",
+    "IndexEntry",
+    "MemberIndex",
+    "MemberStats",
+    "PartUploadSink",
+    "PathMatcher",
+    "ReproducibleTarFile",
+    "TarInfo",
+    "VerifySink",
+    "VolumeSink",
+    "build_archives",
+    "choose_compression_level",
+]
+
+class MemberStats:
+    name: str
+    seconds: dict[str, float]
+    nbytes: dict[str, int]
+    def __init__(self, name: str) -> None: ...
+    def to_dict(self) -> dict[str, Any]: ...
+
+class ArchiveStats:
+    callback: Callable[[MemberStats], object] | None
+    keep_members: bool
+    members: list[MemberStats]
+    member_count: int
+    seconds: dict[str, float]
+    nbytes: dict[str, int]
+    elapsed: float
+    settings: dict[str, Any]
+    def __init__(
+        self, callback: Callable[[MemberStats], object] | None = None, keep_members: bool = True
+    ) -> None: ...
+    def to_dict(self) -> dict[str, Any]: ...
+    def format_table(self) -> str: ...
+
+class IndexEntry(NamedTuple):
+    name: str
+    offset: int
+    offset_data: int
+    size: int
+
+class MemberIndex:
+    def __init__(self) -> None: ...
+    def __len__(self) -> int: ...
+    def __getitem__(self, index: int) -> IndexEntry: ...
+    def __iter__(self) -> Iterator[IndexEntry]: ...
+    def names(self) -> list[str]: ...
+
+class PathMatcher:
+    exclude: list[str]
+    include: list[str]
+    def __init__(self, exclude: Iterable[str] = (), include: Iterable[str] = ()) -> None: ...
+    def match(self, path: str, is_dir: bool = False) -> bool: ...
+    def walk(
+        self, top: StrPath, recursive: bool = True, follow_symlinks: bool = False
+    ) -> Iterator[str]: ...
+
+class PartUploadSink:
+    part_size: int
+    max_workers: int
+    max_pending: int
+    parts: list[tuple[int, Any]]
+    closed: bool
+    def __init__(
+        self, part_size: int = 8388608, max_workers: int = 4, max_pending: int | None = None
+    ) -> None: ...
+    def begin(self) -> None: ...
+    def upload_part(self, part_number: int, data: bytes) -> Any: ...
+    def complete(self, parts: list[tuple[int, Any]]) -> None: ...
+    def abort(self) -> None: ...
+    def writable(self) -> bool: ...
+    def tell(self) -> int: ...
+    def flush(self) -> None: ...
+    def write(self, data: ReadableBuffer) -> int: ...
+    def close(self) -> None: ...
+    def __enter__(self) -> Self: ...
+    def __exit__(self, exc_type: object, exc_value: object, traceback: object) -> None: ...
+
+class HTTPMultipartSink(PartUploadSink):
+    url: str
+    headers: dict[str, str]
+    timeout: float
+    upload_id: str
+    def __init__(
+        self,
+        url: str,
+        part_size: int = 8388608,
+        max_workers: int = 4,
+        max_pending: int | None = None,
+        headers: Mapping[str, str] | None = None,
+        timeout: float = 60,
+    ) -> None: ...
+    def request(
+        self, method: str, query: str, body: bytes = b"", headers: Mapping[str, str] | None = None
+    ) -> tuple[int, Any, bytes]: ...
+    def upload_part(self, part_number: int, data: bytes) -> str: ...
+
+class VolumeSink:
+    name: str
+    volume_size: int
+    on_volume: Callable[[str], Any] | None
+    suffix_length: int
+    volumes: list[tuple[str, Any]]
+    closed: bool
+    def __init__(
+        self,
+        name: StrPath,
+        volume_size: int,
+        on_volume: Callable[[str], Any] | None = None,
+        max_workers: int = 1,
+        suffix_length: int = 3,
+    ) -> None: ...
+    def volume_path(self, index: int) -> str: ...
+    def writable(self) -> bool: ...
+    def tell(self) -> int: ...
+    def flush(self) -> None: ...
+    def write(self, data: ReadableBuffer) -> int: ...
+    def close(self) -> None: ...
+    def __enter__(self) -> Self: ...
+    def __exit__(self, exc_type: object, exc_value: object, traceback: object) -> None: ...
+
+class VerifySink:
+    name: str | None
+    mismatch: ArchiveMismatchError | None
+    closed: bool
+    def __init__(self, name: StrPath | IO[bytes]) -> None: ...
+    def writable(self) -> bool: ...
+    def tell(self) -> int: ...
+    def flush(self) -> None: ...
+    def write(self, data: ReadableBuffer) -> int: ...
+    def close(self) -> None: ...
+    def __enter__(self) -> Self: ...
+    def __exit__(self, exc_type: object, exc_value: object, traceback: object) -> None: ...
+
+class ArchiveMismatchError(TarError):
+    name: str | None
+    offset: int
+    member: str | None
+    def __init__(self, name: str | None, offset: int, member: str | None = None) -> None: ...
+
+class FragmentCache:
+    directory: str
+    hits: int
+    misses: int
+    def __init__(self, directory: StrPath) -> None: ...
+    def path(self, key: str) -> str: ...
+
+class ArchiveCache:
+    directory: str
+    max_size: int | None
+    hits: int
+    misses: int
+    def __init__(self, directory: StrPath, max_size: int | None = None) -> None: ...
+    def path(self, key: str) -> str: ...
+    def evict(self) -> None: ...
+
+class ConcurrentWriter:
+    tar: ReproducibleTarFile
+    memory_budget: int
+    def __init__(
+        self, tar: ReproducibleTarFile, memory_budget: int = ..., first_key: int = 0
+    ) -> None: ...
+    def submit(
+        self, key: int, tarinfo: TarInfo, data: ReadableBuffer | SupportsRead[bytes] | None = None
+    ) -> None: ...
+    def close(self) -> None: ...
+    def __enter__(self) -> Self: ...
+    def __exit__(self, exc_type: object, exc_value: object, traceback: object) -> None: ...
 
 class ReproducibleTarFile(TarFile):
+    stats: ArchiveStats | None
+    member_index: MemberIndex | None
+    io_policy: Literal["stream"] | None
+    def __init__(
+        self,
+        name: StrOrBytesPath | None = None,
+        mode: Literal["r", "a", "w", "x"] = "r",
+        fileobj: _Fileobj | None = None,
+        format: int | None = None,
+        tarinfo: type[TarInfo] | None = None,
+        dereference: bool | None = None,
+        ignore_zeros: bool | None = None,
+        encoding: str | None = None,
+        errors: str = "surrogateescape",
+        pax_headers: Mapping[str, str] | None = None,
+        debug: Literal[0, 1, 2, 3] | None = None,
+        errorlevel: Literal[0, 1, 2] | None = None,
+        copybufsize: int | None = None,
+        *,
+        stats: ArchiveStats | None = None,
+        write_buffer_size: int = 0,
+        keep_members: bool = True,
+        io_policy: Literal["stream"] | None = None,
+    ) -> None: ...
     # Following type stubs for 'gzopen' copied from Typeshed
     # https://github.com/python/typeshed/blob/494a5d1b98b3522173dd7e0f00f14a32be00456b/stdlib/tarfile.pyi#L380-L415
     # Copyright Python Software Foundation, licensed under Apache License Version 2
@@ -21,6 +238,7 @@ class ReproducibleTarFile(TarFile):
         mode: Literal["r"] = "r",
         fileobj: _GzipReadableFileobj | None = None,
         compresslevel: int = 9,
+        rsyncable: bool = False,
         *,
         format: int | None = ...,
         tarinfo: type[TarInfo] | None = ...,
@@ -30,15 +248,68 @@ class ReproducibleTarFile(TarFile):
         pax_headers: Mapping[str, str] | None = ...,
         debug: int | None = ...,
         errorlevel: int | None = ...,
+        stats: ArchiveStats | None = ...,
+        write_buffer_size: int = ...,
+        keep_members: bool = ...,
+        io_policy: Literal["stream"] | None = ...,
     ) -> Self: ...
     @overload
     @classmethod
     def gzopen(
         cls,
         name: StrOrBytesPath | None,
-        mode: Literal["w", "x"],
+        mode: Literal["a", "w", "x"],
         fileobj: _GzipWritableFileobj | None = None,
         compresslevel: int = 9,
+        rsyncable: bool = False,
+        fragment_size: int | None = None,
+        fragment_cache: FragmentCache | StrPath | None = None,
+        segment_incompressible: bool = False,
+        fast_append: bool = False,
+        *,
+        format: int | None = ...,
+        tarinfo: type[TarInfo] | None = ...,
+        dereference: bool | None = ...,
+        ignore_zeros: bool | None = ...,
+        encoding: str | None = ...,
+        pax_headers: Mapping[str, str] | None = ...,
+        debug: int | None = ...,
+        errorlevel: int | None = ...,
+        stats: ArchiveStats | None = ...,
+        write_buffer_size: int = ...,
+        keep_members: bool = ...,
+        io_policy: Literal["stream"] | None = ...,
+    ) -> Self: ...
+    @classmethod
+    def xzopen(
+        cls,
+        name: StrOrBytesPath | None,
+        mode: Literal["r", "w", "x"] = "r",
+        fileobj: IO[bytes] | None = None,
+        preset: int | None = None,
+        segment_incompressible: bool = False,
+        *,
+        format: int | None = ...,
+        tarinfo: type[TarInfo] | None = ...,
+        dereference: bool | None = ...,
+        ignore_zeros: bool | None = ...,
+        encoding: str | None = ...,
+        pax_headers: Mapping[str, str] | None = ...,
+        debug: int | None = ...,
+        errorlevel: int | None = ...,
+        stats: ArchiveStats | None = ...,
+        write_buffer_size: int = ...,
+        keep_members: bool = ...,
+        io_policy: Literal["stream"] | None = ...,
+    ) -> Self: ...
+    @classmethod
+    def teeopen(
+        cls,
+        targets: Iterable[tuple[StrOrBytesPath | IO[bytes], str]],
+        compresslevel: int = 9,
+        preset: int | None = None,
+        level: int | None = None,
+        rsyncable: bool = False,
         *,
         format: int | None = ...,
         tarinfo: type[TarInfo] | None = ...,
@@ -48,8 +319,55 @@ class ReproducibleTarFile(TarFile):
         pax_headers: Mapping[str, str] | None = ...,
         debug: int | None = ...,
         errorlevel: int | None = ...,
+        stats: ArchiveStats | None = ...,
+        write_buffer_size: int = ...,
+        keep_members: bool = ...,
+        io_policy: Literal["stream"] | None = ...,
     ) -> Self: ...
+    def gettarinfo(
+        self,
+        name: StrOrBytesPath | None = None,
+        arcname: str | None = None,
+        fileobj: IO[bytes] | None = None,
+    ) -> TarInfo: ...
+    def add(
+        self,
+        name: StrOrBytesPath,
+        arcname: StrOrBytesPath | None = None,
+        recursive: bool = True,
+        *,
+        filter: Callable[[TarInfo], TarInfo | None] | None = None,
+        matcher: PathMatcher | None = None,
+    ) -> None: ...
     def addfile(self, tarinfo: TarInfo, fileobj: SupportsRead[bytes] | None = None) -> None: ...
+    def close(self) -> None: ...
+    def add_paths(
+        self,
+        names: Iterable[StrOrBytesPath],
+        arcnames: Iterable[StrOrBytesPath] | None = None,
+        *,
+        filter: Callable[[TarInfo], TarInfo | None] | None = None,
+        jobs: int = 1,
+    ) -> None: ...
+    def estimate_size(
+        self,
+        names: Iterable[StrOrBytesPath],
+        arcnames: Iterable[StrOrBytesPath] | None = None,
+        *,
+        filter: Callable[[TarInfo], TarInfo | None] | None = None,
+    ) -> int: ...
+    def preallocate(self, size: int) -> bool: ...
+    def add_bytes(
+        self, name: str, data: ReadableBuffer | SupportsRead[bytes] | Iterable[ReadableBuffer]
+    ) -> None: ...
+    def add_many_bytes(
+        self,
+        members: Mapping[str, ReadableBuffer | SupportsRead[bytes] | Iterable[ReadableBuffer]]
+        | Iterable[tuple[str, ReadableBuffer | SupportsRead[bytes] | Iterable[ReadableBuffer]]],
+        *,
+        dirs: bool = False,
+        spool_size: int = ...,
+    ) -> None: ...
 
 # Following type stubs for 'open' modified from Typeshed
 # https://github.com/python/typeshed/blob/494a5d1b98b3522173dd7e0f00f14a32be00456b/stdlib/tarfile.pyi#L168-L362
@@ -71,6 +389,11 @@ def open(
     pax_headers: Mapping[str, str] | None = ...,
     debug: int | None = ...,
     errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
+    readahead: bool = ...,
 ) -> TarFile: ...
 @overload
 def open(
@@ -88,6 +411,12 @@ def open(
     pax_headers: Mapping[str, str] | None = ...,
     debug: int | None = ...,
     errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
+    archive_cache: ArchiveCache | StrPath | None = ...,
+    fast_append: bool = ...,
 ) -> TarFile: ...
 @overload
 def open(
@@ -105,11 +434,73 @@ def open(
     pax_headers: Mapping[str, str] | None = ...,
     debug: int | None = ...,
     errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
+    archive_cache: ArchiveCache | StrPath | None = ...,
+    fast_append: bool = ...,
+) -> TarFile: ...
+@overload
+def open(
+    name: StrOrBytesPath | None,
+    mode: Literal["a:gz", "x:gz", "w:gz"],
+    fileobj: _Fileobj | None = None,
+    bufsize: int = 10240,
+    *,
+    format: int | None = ...,
+    tarinfo: type[TarInfo] | None = ...,
+    dereference: bool | None = ...,
+    ignore_zeros: bool | None = ...,
+    encoding: str | None = ...,
+    errors: str = ...,
+    pax_headers: Mapping[str, str] | None = ...,
+    debug: int | None = ...,
+    errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
+    archive_cache: ArchiveCache | StrPath | None = ...,
+    fast_append: bool = ...,
+    compresslevel: int = 9,
+    rsyncable: bool = ...,
+    fragment_size: int | None = ...,
+    fragment_cache: FragmentCache | StrPath | None = ...,
+    segment_incompressible: bool = ...,
+) -> TarFile: ...
+@overload
+def open(
+    name: StrOrBytesPath | None = None,
+    *,
+    mode: Literal["a:gz", "x:gz", "w:gz"],
+    fileobj: _Fileobj | None = None,
+    bufsize: int = 10240,
+    format: int | None = ...,
+    tarinfo: type[TarInfo] | None = ...,
+    dereference: bool | None = ...,
+    ignore_zeros: bool | None = ...,
+    encoding: str | None = ...,
+    errors: str = ...,
+    pax_headers: Mapping[str, str] | None = ...,
+    debug: int | None = ...,
+    errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
+    archive_cache: ArchiveCache | StrPath | None = ...,
+    fast_append: bool = ...,
+    compresslevel: int = 9,
+    rsyncable: bool = ...,
+    fragment_size: int | None = ...,
+    fragment_cache: FragmentCache | StrPath | None = ...,
+    segment_incompressible: bool = ...,
 ) -> TarFile: ...
 @overload
 def open(
     name: StrOrBytesPath | None,
-    mode: Literal["x:gz", "x:bz2", "w:gz", "w:bz2"],
+    mode: Literal["a:gz", "x:gz", "x:bz2", "w:gz", "w:bz2"],
     fileobj: _Fileobj | None = None,
     bufsize: int = 10240,
     *,
@@ -122,13 +513,18 @@ def open(
     pax_headers: Mapping[str, str] | None = ...,
     debug: int | None = ...,
     errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
+    archive_cache: ArchiveCache | StrPath | None = ...,
     compresslevel: int = 9,
 ) -> TarFile: ...
 @overload
 def open(
     name: StrOrBytesPath | None = None,
     *,
-    mode: Literal["x:gz", "x:bz2", "w:gz", "w:bz2"],
+    mode: Literal["a:gz", "x:gz", "x:bz2", "w:gz", "w:bz2"],
     fileobj: _Fileobj | None = None,
     bufsize: int = 10240,
     format: int | None = ...,
@@ -140,6 +536,11 @@ def open(
     pax_headers: Mapping[str, str] | None = ...,
     debug: int | None = ...,
     errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
+    archive_cache: ArchiveCache | StrPath | None = ...,
     compresslevel: int = 9,
 ) -> TarFile: ...
 @overload
@@ -158,7 +559,13 @@ def open(
     pax_headers: Mapping[str, str] | None = ...,
     debug: int | None = ...,
     errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
+    archive_cache: ArchiveCache | StrPath | None = ...,
     preset: Literal[0, 1, 2, 3, 4, 5, 6, 7, 8, 9] | None = ...,
+    segment_incompressible: bool = ...,
 ) -> TarFile: ...
 @overload
 def open(
@@ -176,7 +583,13 @@ def open(
     pax_headers: Mapping[str, str] | None = ...,
     debug: int | None = ...,
     errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
+    archive_cache: ArchiveCache | StrPath | None = ...,
     preset: Literal[0, 1, 2, 3, 4, 5, 6, 7, 8, 9] | None = ...,
+    segment_incompressible: bool = ...,
 ) -> TarFile: ...
 @overload
 def open(
@@ -194,6 +607,10 @@ def open(
     pax_headers: Mapping[str, str] | None = ...,
     debug: int | None = ...,
     errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
 ) -> TarFile: ...
 @overload
 def open(
@@ -211,6 +628,10 @@ def open(
     pax_headers: Mapping[str, str] | None = ...,
     debug: int | None = ...,
     errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
 ) -> TarFile: ...
 @overload
 def open(
@@ -228,5 +649,20 @@ def open(
     pax_headers: Mapping[str, str] | None = ...,
     debug: int | None = ...,
     errorlevel: int | None = ...,
+    stats: ArchiveStats | None = ...,
+    write_buffer_size: int = ...,
+    keep_members: bool = ...,
+    io_policy: Literal["stream"] | None = ...,
     compresslevel: int = 9,
 ) -> TarFile: ...
+def build_archives(
+    specs: Iterable[Mapping[str, Any]], *, jobs: int = 1
+) -> list[dict[str, Any]]: ...
+def choose_compression_level(
+    comptype: Literal["gz", "bz2", "xz"],
+    paths: Iterable[StrPath],
+    *,
+    size_tolerance: float | None = None,
+    max_cost: float | None = None,
+    sample_size: int = ...,
+) -> int: ...
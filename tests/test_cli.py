@@ -1,14 +1,21 @@
+import gzip
+import json
+import os
+from pathlib import Path
 import platform
 import subprocess
 import sys
+from tarfile import TarFile
 
 import pytest
 from typer.testing import CliRunner
 
+import repro_tarfile
 from repro_tarfile import __version__ as repro_tarfile_version  # type: ignore[attr-defined]
 from rptar import __version__ as rptar_version
-from rptar import app
+from rptar import _parse_fast_path, _sorted_unique, app, main
 from tests.utils import (
+    MultipartUploadServer,
     assert_archive_contents_equals,
     dir_tree_factory,
     file_factory,
@@ -189,3 +196,530 @@ def test_python_dash_m_invocation():
     )
     assert result.returncode == 0
     assert "Usage: python -m rptar" in remove_ansi_escape(result.stdout)
+
+
+def test_stats(base_path):
+    """With --stats and --stats-json flags."""
+    dir_tree = dir_tree_factory(base_path)
+
+    rptar_out = base_path / "rptar.tar.gz"
+    stats_out = base_path / "stats.json"
+    rptar_args = ["-czf", str(rptar_out), "--stats", "--stats-json", str(stats_out), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    for phase in ("stat", "header", "read", "compress", "write"):
+        assert phase in rptar_result.output
+
+    stats = json.loads(stats_out.read_text())
+    assert stats["members"] == len(list(dir_tree.glob("**/*"))) + 1
+    # Gzip header is written on open and not counted
+    assert stats["phases"]["write"]["bytes"] + 10 == rptar_out.stat().st_size
+    assert [member["name"] for member in stats["per_member"]][0] == str(dir_tree).lstrip("/")
+
+
+def test_jobs(base_path):
+    """With --jobs for building with worker processes."""
+    dir_tree = dir_tree_factory(base_path)
+
+    rptar_serial = base_path / "serial.tar.gz"
+    rptar_args = ["-czf", str(rptar_serial), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+
+    rptar_jobs = base_path / "jobs.tar.gz"
+    rptar_args = ["-czf", str(rptar_jobs), "--jobs", "2", str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+
+    assert rptar_serial.read_bytes() == rptar_jobs.read_bytes()
+
+
+def test_fast_path(base_path):
+    """Common short-flag invocations bypass typer and produce the same archive."""
+    dir_tree = dir_tree_factory(base_path)
+
+    assert _parse_fast_path(["-czvf", "out.tar.gz", "a", "b"]) == {
+        "in_list": ["a", "b"],
+        "create": True,
+        "gzip": True,
+        "file": ["out.tar.gz"],
+        "verbose": 1,
+    }
+    assert _parse_fast_path(["-c", "-J", "-fout.tar.xz", "a"])["file"] == ["out.tar.xz"]
+    # Anything else falls back to the full parser
+    for args in (
+        ["-czf", "out.tar.gz", "--jobs", "2", "a"],
+        ["-czf", "out.tar.gz", "--", "a"],
+        ["-cxf", "out.tar", "a"],
+        ["-cf", "out.tar", "-f", "other.tar", "a"],
+        ["-cf", "-v", "a"],
+        ["-zf", "out.tar.gz", "a"],
+        ["-czf", "out.tar.gz"],
+        ["--help"],
+    ):
+        assert _parse_fast_path(args) is None, args
+
+    rptar_typer = base_path / "typer.tar.gz"
+    rptar_args = ["-czf", str(rptar_typer), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+
+    rptar_fast = base_path / "fast.tar.gz"
+    with pytest.raises(SystemExit) as exc_info:
+        main(["-czf", str(rptar_fast), str(dir_tree)])
+    assert exc_info.value.code == 0
+
+    assert rptar_typer.read_bytes() == rptar_fast.read_bytes()
+
+
+def test_import_time():
+    """Importing rptar doesn't import typer, importlib.metadata, or modules that repro_tarfile
+    only needs for some features. Wall-clock time is measured by benchmarks/import_time.py."""
+    deferred = [
+        "typer",
+        "click",
+        "importlib.metadata",
+        "json",
+        "gzip",
+        "hashlib",
+        "tempfile",
+        "queue",
+        "concurrent.futures",
+        "http.client",
+        "xml.etree.ElementTree",
+    ]
+    code = f"import sys, rptar; print([m for m in {deferred!r} if m in sys.modules])"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[]"
+
+
+def test_exclude_include(base_path):
+    """With --exclude, --exclude-from, and --include patterns."""
+    dir_tree = dir_tree_factory(base_path)
+    (dir_tree / ".git").mkdir()
+    file_factory(dir_tree / ".git")
+    (dir_tree / "sub_dir" / "notes.log").write_text("log")
+    (dir_tree / "sub_dir" / "keep.log").write_text("log")
+    exclude_file = base_path / "exclude.txt"
+    exclude_file.write_text("# Logs\n*.log\n")
+
+    rptar_out = base_path / "rptar.tar"
+    rptar_args = [
+        "-cf",
+        str(rptar_out),
+        "--exclude",
+        ".git/",
+        "--exclude-from",
+        str(exclude_file),
+        "--exclude",
+        "!keep.log",
+        str(dir_tree),
+    ]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    with TarFile.open(rptar_out) as tp:
+        names = tp.getnames()
+    assert not any(".git" in name.split("/") for name in names)
+    assert not any(name.endswith("sub_dir/notes.log") for name in names)
+    assert any(name.endswith("sub_dir/keep.log") for name in names)
+    assert len(names) == len(list(dir_tree.glob("**/*"))) + 1 - 3
+
+    rptar_args = ["-cf", str(rptar_out), "--include", "*.log", str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    with TarFile.open(rptar_out) as tp:
+        assert [Path(name).name for name in tp.getnames()] == ["keep.log", "notes.log"]
+
+
+@pytest.mark.skipif(
+    platform.system() == "Windows", reason="symlinks need extra privileges on Windows"
+)
+def test_exclude_symlinked_dir(base_path):
+    """Symbolic links to directories are added as links and not walked, with or without
+    patterns."""
+    dir_tree = dir_tree_factory(base_path)
+    (dir_tree / "linked_dir").symlink_to(dir_tree / "sub_dir", target_is_directory=True)
+    linked_top = base_path / "linked_top"
+    linked_top.symlink_to(dir_tree / "sub_dir", target_is_directory=True)
+
+    outputs = []
+    for extra_args in ([], ["--exclude", "no-such-file"]):
+        rptar_out = base_path / f"rptar{len(outputs)}.tar"
+        rptar_args = ["-cf", str(rptar_out), *extra_args, str(dir_tree), str(linked_top)]
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 0, rptar_args
+        outputs.append(rptar_out.read_bytes())
+    assert outputs[0] == outputs[1]
+
+    with TarFile.open(base_path / "rptar0.tar") as tp:
+        for link in (dir_tree / "linked_dir", linked_top):
+            prefix = link.as_posix().lstrip("/")
+            linked = [member for member in tp.getmembers() if member.name.startswith(prefix)]
+            assert len(linked) == 1
+            assert linked[0].issym()
+
+
+def test_files_from(base_path):
+    """With -T/--files-from, reading newline- or NUL-separated names from a file or stdin."""
+    dir_tree = dir_tree_factory(base_path)
+    paths = [str(path) for path in sorted(dir_tree.glob("**/*"), reverse=True)]
+
+    rptar_args_out = base_path / "args.tar"
+    rptar_args = ["-cf", str(rptar_args_out), "--no-recursion", *paths]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+
+    names_file = base_path / "names.txt"
+    names_file.write_text("\n".join(paths) + "\n")
+    rptar_out = base_path / "files_from.tar"
+    rptar_args = ["-cf", str(rptar_out), "--no-recursion", "-T", str(names_file)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    assert rptar_out.read_bytes() == rptar_args_out.read_bytes()
+
+    rptar_args = ["-cf", str(rptar_out), "--no-recursion", "--null", "--files-from", "-"]
+    rptar_result = runner.invoke(app, rptar_args, input="\0".join(paths + paths[:2]))
+    assert rptar_result.exit_code == 0, rptar_args
+    assert rptar_out.read_bytes() == rptar_args_out.read_bytes()
+
+    # No inputs
+    rptar_args = ["-cf", str(rptar_out)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 1, rptar_args
+
+
+def test_sorted_unique_spills_runs(tmp_path):
+    """External merge sort gives the same order as sorted(set(paths))."""
+    names = ["b/c", "a", "a.txt", "a/b", "/x/y", "a-b", "b", "a/b", "./a", "a b", "/x", "b/c"]
+    paths = [Path(name) for name in names * 3]
+    assert list(_sorted_unique(paths, run_size=4)) == sorted(set(paths))
+    assert list(_sorted_unique(paths)) == sorted(set(paths))
+
+
+def test_upload(base_path):
+    """With --upload to stream the archive to an object store."""
+    dir_tree = dir_tree_factory(base_path)
+
+    rptar_out = base_path / "rptar.tar.gz"
+    rptar_args = ["-czf", str(rptar_out), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+
+    with MultipartUploadServer() as server:
+        url = server.url + "/bucket/rptar.tar.gz"
+        rptar_args = ["-cz", "--upload", url, "--part-size", "100", str(dir_tree)]
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 0, rptar_args
+        assert server.objects["/bucket/rptar.tar.gz"] == rptar_out.read_bytes()
+        assert len(server.parts["/bucket/rptar.tar.gz"]) > 1
+
+    with MultipartUploadServer(fail_part=1) as server:
+        rptar_result = runner.invoke(app, rptar_args[:2] + [server.url] + rptar_args[3:])
+        assert rptar_result.exit_code == 1
+        assert "Upload failed" in rptar_result.output
+
+
+def test_multiple_files(base_path):
+    """With more than one --file, write each archive from one read of the inputs."""
+    dir_tree = dir_tree_factory(base_path)
+
+    separate = []
+    for flags, name in (("-cf", "separate.tar"), ("-czf", "separate.tar.gz")):
+        rptar_out = base_path / name
+        rptar_args = [flags, str(rptar_out), str(dir_tree)]
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 0, rptar_args
+        separate.append(rptar_out.read_bytes())
+
+    tee_tar = base_path / "tee.tar"
+    tee_gz = base_path / "tee.tgz"
+    rptar_args = ["-c", "-f", str(tee_tar), "-f", str(tee_gz), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    assert [tee_tar.read_bytes(), tee_gz.read_bytes()] == separate
+
+    for rptar_args in (
+        ["-cz", "-f", str(tee_tar), "-f", str(tee_gz), str(dir_tree)],
+        ["-c", "-f", str(tee_tar), "-f", str(base_path / "tee.zip"), str(dir_tree)],
+    ):
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 1, rptar_args
+
+
+def test_volume_size(base_path):
+    """With --volume-size to split output files into volumes."""
+    dir_tree = dir_tree_factory(base_path)
+
+    rptar_out = base_path / "rptar.tar.gz"
+    rptar_args = ["-czf", str(rptar_out), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    expected = rptar_out.read_bytes()
+
+    for rptar_args in (
+        ["-czf", str(base_path / "split.tar.gz"), "--volume-size", "100", str(dir_tree)],
+        ["-cf", str(base_path / "split.tar"), "-f", str(base_path / "split.tgz")]
+        + ["--volume-size", "100", str(dir_tree)],
+    ):
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 0, rptar_args
+    volumes = sorted(base_path.glob("split.tar.gz.*"))
+    assert len(volumes) > 1
+    assert all(path.stat().st_size == 100 for path in volumes[:-1])
+    assert b"".join(path.read_bytes() for path in volumes) == expected
+    tee_volumes = sorted(base_path.glob("split.tgz.*"))
+    assert b"".join(path.read_bytes() for path in tee_volumes) == expected
+
+    rptar_result = runner.invoke(app, ["-cz", "--volume-size", "100", str(dir_tree)])
+    assert rptar_result.exit_code == 1
+
+
+def test_rsyncable(base_path):
+    """With --rsyncable for rsync-friendly gzip output."""
+    dir_tree = dir_tree_factory(base_path)
+
+    rptar_plain = base_path / "plain.tar.gz"
+    rptar_args = ["-czf", str(rptar_plain), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+
+    rptar_rsyncable = base_path / "rsyncable.tar.gz"
+    rptar_args = ["-czf", str(rptar_rsyncable), "--rsyncable", str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    assert gzip.decompress(rptar_rsyncable.read_bytes()) == gzip.decompress(
+        rptar_plain.read_bytes()
+    )
+
+    rptar_args = ["-cJf", str(base_path / "rsyncable.tar.xz"), "--rsyncable", str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 1, rptar_args
+
+
+def test_verify(base_path):
+    """With --verify to check an existing archive without writing a new one."""
+    dir_tree = dir_tree_factory(base_path)
+
+    rptar_out = base_path / "rptar.tar.gz"
+    rptar_args = ["-czf", str(rptar_out), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+
+    # Compression is taken from the suffix unless given
+    for rptar_args in (
+        ["--verify", str(rptar_out), str(dir_tree)],
+        ["-cz", "--verify", str(rptar_out), str(dir_tree)],
+    ):
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 0, rptar_args
+    assert sorted(os.listdir(base_path)) == sorted([dir_tree.name, rptar_out.name])
+
+    rptar_args = ["-cJ", "--verify", str(rptar_out), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 1, rptar_args
+
+    rptar_args = ["-cf", str(base_path / "other.tar"), "--verify", str(rptar_out), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 1, rptar_args
+
+    changed = sorted(path for path in dir_tree.glob("**/*") if path.is_file())[-1]
+    changed.write_text("changed")
+    rptar_args = ["--verify", str(rptar_out), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 1, rptar_args
+    assert "differs" in rptar_result.output
+
+
+def test_batch(base_path):
+    """With --batch for building several archives from a JSON file of specs."""
+    dir_tree = dir_tree_factory(base_path)
+
+    rptar_single = base_path / "single.tar.gz"
+    rptar_args = ["-czf", str(rptar_single), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+
+    # Compression is taken from the suffix unless given
+    specs = [
+        {"output": str(base_path / "batch.tar.gz"), "inputs": [str(dir_tree)]},
+        {"output": str(base_path / "batch.tar"), "inputs": [str(dir_tree)]},
+        {"output": str(base_path / "batch.out"), "inputs": [str(dir_tree)], "compression": "xz"},
+    ]
+    batch_file = base_path / "jobs.json"
+    batch_file.write_text(json.dumps(specs))
+    stats_json = base_path / "stats.json"
+    rptar_args = ["--batch", str(batch_file), "--jobs", "2", "--stats-json", str(stats_json)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+
+    assert (base_path / "batch.tar.gz").read_bytes() == rptar_single.read_bytes()
+    with TarFile.open(base_path / "batch.out", "r:xz") as tp:
+        assert len(tp.getmembers()) > 1
+    summaries = json.loads(stats_json.read_text())
+    assert rptar_result.stdout.splitlines() == [
+        f"{summary['sha256']}  {spec['output']}" for spec, summary in zip(specs, summaries)
+    ]
+
+    rptar_args = ["--batch", str(batch_file), "-z"]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 1, rptar_args
+
+    batch_file.write_text(json.dumps([{"output": "x.unknown", "inputs": [str(dir_tree)]}]))
+    rptar_result = runner.invoke(app, ["--batch", str(batch_file)])
+    assert rptar_result.exit_code == 1
+
+
+@pytest.mark.skipif(
+    platform.system() == "Windows", reason="symlinks need extra privileges on Windows"
+)
+def test_batch_symlinked_dir(base_path):
+    """--batch builds the same archive as rptar for trees with symbolic links to directories."""
+    dir_tree = dir_tree_factory(base_path)
+    (dir_tree / "linked_dir").symlink_to(dir_tree / "sub_dir", target_is_directory=True)
+    linked_top = base_path / "linked_top"
+    linked_top.symlink_to(dir_tree, target_is_directory=True)
+
+    for i, extra_args in enumerate([[], ["--exclude", "no-such-file"]]):
+        rptar_single = base_path / f"single{i}.tar"
+        rptar_args = ["-cf", str(rptar_single), *extra_args, str(dir_tree), str(linked_top)]
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 0, rptar_args
+
+        spec = {"output": str(base_path / f"batch{i}.tar"), "inputs": [str(dir_tree)]}
+        spec["inputs"].append(str(linked_top))
+        if extra_args:
+            spec["exclude"] = extra_args[1:]
+        # A second archive with the same inputs makes their members shared
+        specs = [spec, dict(spec, output=str(base_path / f"other{i}.tar"))]
+        batch_file = base_path / "jobs.json"
+        batch_file.write_text(json.dumps(specs))
+        rptar_result = runner.invoke(app, ["--batch", str(batch_file)])
+        assert rptar_result.exit_code == 0
+
+        assert (base_path / f"batch{i}.tar").read_bytes() == rptar_single.read_bytes()
+        assert (base_path / f"other{i}.tar").read_bytes() == rptar_single.read_bytes()
+
+
+def test_estimate_preallocate(base_path):
+    """With --estimate for the size of the archive, and --preallocate for reserving it."""
+    dir_tree = dir_tree_factory(base_path)
+
+    rptar_args = ["--estimate", str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    assert sorted(os.listdir(base_path)) == [dir_tree.name]
+    estimate = int(rptar_result.stdout)
+
+    rptar_reference = base_path / "reference.tar"
+    rptar_args = ["-cf", str(rptar_reference), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    assert rptar_reference.stat().st_size == estimate
+
+    rptar_preallocated = base_path / "preallocated.tar"
+    rptar_args = ["-cf", str(rptar_preallocated), "--preallocate", str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    assert rptar_preallocated.read_bytes() == rptar_reference.read_bytes()
+
+    for rptar_args in (
+        ["--estimate", "-z", str(dir_tree)],
+        ["-czf", str(base_path / "archive.tar.gz"), "--preallocate", str(dir_tree)],
+    ):
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 1, rptar_args
+
+
+def test_cache_dir(base_path):
+    """With --cache-dir for copying unchanged archives from a cache."""
+    dir_tree = dir_tree_factory(base_path)
+    cache_dir = base_path / "cache"
+
+    rptar_reference = base_path / "reference.tar.gz"
+    rptar_args = ["-czf", str(rptar_reference), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+
+    for name, jobs in (("miss.tar.gz", 1), ("hit.tar.gz", 1), ("jobs.tar.gz", 2)):
+        rptar_cached = base_path / name
+        rptar_args = ["-czf", str(rptar_cached), "--cache-dir", str(cache_dir), str(dir_tree)]
+        rptar_args += ["--jobs", str(jobs)]
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 0, rptar_args
+        assert rptar_cached.read_bytes() == rptar_reference.read_bytes()
+    assert len([path for path in cache_dir.rglob("*") if path.is_file()]) == 1
+
+    rptar_args = ["-cz", "--cache-dir", str(cache_dir), str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    assert rptar_result.stdout_bytes == rptar_reference.read_bytes()
+
+    for rptar_args in (
+        ["-czf", str(base_path / "a.tar.gz"), "--cache-size", "100", str(dir_tree)],
+        ["--estimate", "--cache-dir", str(cache_dir), str(dir_tree)],
+        ["-cf", "a.tar", "-f", "a.tar.gz", "--cache-dir", str(cache_dir), str(dir_tree)],
+    ):
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 1, rptar_args
+
+
+def test_level(base_path):
+    """With --level and --auto-level for the compression level, recorded in --stats-json."""
+    dir_tree = dir_tree_factory(base_path)
+
+    rptar_out = base_path / "level.tar.gz"
+    stats_out = base_path / "stats.json"
+    for level in (0, 1):
+        rptar_args = [
+            "-czf",
+            str(rptar_out),
+            "--level",
+            str(level),
+            "--stats-json",
+            str(stats_out),
+        ]
+        rptar_result = runner.invoke(app, rptar_args + [str(dir_tree)])
+        assert rptar_result.exit_code == 0, rptar_args
+        with repro_tarfile.open(base_path / "lib.tar.gz", "w:gz", compresslevel=level) as tp:
+            tp.add(dir_tree)
+        assert rptar_out.read_bytes() == (base_path / "lib.tar.gz").read_bytes()
+        assert json.loads(stats_out.read_text())["settings"] == {"level": level}
+
+    # The chosen level only depends on the inputs
+    rptar_args = ["-cJf", str(rptar_out), "--auto-level", "size:5", "--stats-json", str(stats_out)]
+    rptar_result = runner.invoke(app, rptar_args + [str(dir_tree)])
+    assert rptar_result.exit_code == 0, rptar_args
+    paths = sorted([dir_tree, *dir_tree.rglob("*")])
+    level = repro_tarfile.choose_compression_level("xz", paths, size_tolerance=0.05)
+    assert json.loads(stats_out.read_text())["settings"] == {"level": level}
+
+    for rptar_args in (
+        ["-cf", str(rptar_out), "--level", "1"],
+        ["-cjf", str(rptar_out), "--level", "0"],
+        ["-czf", str(rptar_out), "--level", "1", "--auto-level", "time:2"],
+        ["-czf", str(rptar_out), "--auto-level", "fast"],
+    ):
+        rptar_result = runner.invoke(app, rptar_args + [str(dir_tree)])
+        assert rptar_result.exit_code == 1, rptar_args
+
+
+def test_segment_incompressible(base_path):
+    """With --segment-incompressible for storing compressed files without compressing again."""
+    dir_tree = dir_tree_factory(base_path)
+    (dir_tree / "random.bin").write_bytes(os.urandom(100_000))
+
+    rptar_out = base_path / "segmented.tar.gz"
+    rptar_args = ["-czf", str(rptar_out), "--segment-incompressible", str(dir_tree)]
+    rptar_result = runner.invoke(app, rptar_args)
+    assert rptar_result.exit_code == 0, rptar_args
+    with repro_tarfile.open(base_path / "lib.tar.gz", "w:gz", segment_incompressible=True) as tp:
+        tp.add(dir_tree)
+    assert rptar_out.read_bytes() == (base_path / "lib.tar.gz").read_bytes()
+
+    for rptar_args in (
+        ["-cjf", str(base_path / "a.tar.bz2"), "--segment-incompressible", str(dir_tree)],
+        ["-czf", str(rptar_out), "--segment-incompressible", "--rsyncable", str(dir_tree)],
+    ):
+        rptar_result = runner.invoke(app, rptar_args)
+        assert rptar_result.exit_code == 1, rptar_args
@@ -1,6 +1,15 @@
-from io import StringIO
+import bz2
+import gzip
+from hashlib import sha256
+from io import BytesIO, StringIO
+import lzma
+import os
+from pathlib import Path
 import platform
-from tarfile import TarFile, TarInfo
+import random
+import tarfile
+from tarfile import DIRTYPE, TarFile, TarInfo
+import threading
 from time import sleep
 
 try:
@@ -10,8 +19,26 @@ except ImportError:
 
 import pytest
 
-from repro_tarfile import ReproducibleTarFile, mtime  # type: ignore[attr-defined]
+from repro_tarfile import (  # type: ignore[attr-defined]
+    ArchiveCache,
+    ArchiveMismatchError,
+    ArchiveStats,
+    ConcurrentWriter,
+    FragmentCache,
+    HTTPMultipartSink,
+    IndexEntry,
+    PartUploadSink,
+    PathMatcher,
+    ReproducibleTarFile,
+    VerifySink,
+    VolumeSink,
+    _HeaderEncoder,
+    build_archives,
+    choose_compression_level,
+    mtime,
+)
 from tests.utils import (
+    MultipartUploadServer,
     assert_archive_contents_equals,
     data_factory,
     dir_tree_factory,
@@ -554,3 +581,1235 @@ def test_addfile(tmp_path):
 
     # ReproducibleTarFile hashes should match
     assert hash_file(rptf_arc1) == hash_file(rptf_arc2)
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz", "w:bz2", "w:xz", "w|"])
+def test_stats(base_path, mode):
+    """Instrumentation records per-member timings and byte counts without changing the archive."""
+    dir_tree = dir_tree_factory(base_path)
+    paths = sorted(dir_tree.glob("**/*"))
+
+    # Stream modes need string names
+    arc_plain = base_path / "plain.tar"
+    with ReproducibleTarFile.open(str(arc_plain), mode) as tp:
+        for path in paths:
+            tp.add(path, recursive=False)
+
+    callback_names = []
+    stats = ArchiveStats(callback=lambda member: callback_names.append(member.name))
+    arc_stats = base_path / "stats.tar"
+    with ReproducibleTarFile.open(str(arc_stats), mode, stats=stats) as tp:
+        for path in paths:
+            tp.add(path, recursive=False)
+
+    assert hash_file(arc_plain) == hash_file(arc_stats)
+
+    assert stats.member_count == len(paths)
+    assert [member.name for member in stats.members] == callback_names
+    assert stats.nbytes["header"] == 512 * len(paths)
+    assert stats.nbytes["read"] == sum(path.stat().st_size for path in paths if path.is_file())
+    # Everything written to the output file after opening is counted
+    gzip_header_size = 10 if mode == "w:gz" else 0
+    assert stats.nbytes["write"] + gzip_header_size == arc_stats.stat().st_size
+    if mode in ("w:gz", "w:bz2", "w:xz"):
+        assert stats.nbytes["compress"] > 0
+    assert all(seconds >= 0 for seconds in stats.seconds.values())
+    assert stats.elapsed > 0
+    assert stats.to_dict()["members"] == len(paths)
+    assert "compress" in stats.format_table()
+
+
+class _CountingBytesIO(BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.write_count = 0
+
+    def write(self, data):
+        self.write_count += 1
+        return super().write(data)
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz", "w:xz"])
+def test_write_buffer(tmp_path, mode):
+    """Buffered writes produce identical bytes with fewer writes to the output."""
+    paths = [file_factory(tmp_path) for _ in range(50)]
+
+    outputs = {}
+    write_counts = {}
+    for write_buffer_size in (0, 1000, 64 * 1024):
+        fileobj = _CountingBytesIO()
+        with ReproducibleTarFile.open(
+            fileobj=fileobj, mode=mode, write_buffer_size=write_buffer_size
+        ) as tp:
+            for path in paths:
+                tp.add(path, arcname=path.name)
+        outputs[write_buffer_size] = fileobj.getvalue()
+        write_counts[write_buffer_size] = fileobj.write_count
+
+    assert outputs[0] == outputs[1000] == outputs[64 * 1024]
+    if mode == "w":
+        assert write_counts[64 * 1024] < write_counts[1000] < write_counts[0]
+
+        # Without a buffer by default, the output receives each member as it is added
+        fileobj = _CountingBytesIO()
+        with ReproducibleTarFile.open(fileobj=fileobj, mode=mode) as tp:
+            tp.add(paths[0], arcname=paths[0].name)
+            assert fileobj.tell() == tp.offset
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz"])
+def test_add_paths_jobs(base_path, mode):
+    """Building with worker processes produces the same bytes as adding files one at a time."""
+    dir_tree = dir_tree_factory(base_path)
+    for _ in range(20):
+        file_factory(dir_tree)
+    if hasattr(os, "link"):
+        # Hard link sorts after its target, so it will usually be in a different shard
+        os.link(next(dir_tree.glob("*.txt")), dir_tree / "zz_hardlink.txt")
+    paths = sorted(dir_tree.glob("**/*"))
+
+    arc_serial = base_path / "serial.tar"
+    with ReproducibleTarFile.open(arc_serial, mode) as tp:
+        for path in paths:
+            tp.add(path, recursive=False)
+
+    arc_jobs = base_path / "jobs.tar"
+    with ReproducibleTarFile.open(arc_jobs, mode) as tp:
+        tp.add_paths(paths, jobs=3)
+        assert [member.name for member in tp.getmembers()] == [
+            str(path).lstrip("/").replace(os.sep, "/") for path in paths
+        ]
+
+    assert hash_file(arc_serial) == hash_file(arc_jobs)
+
+
+def test_add_paths_jobs_attribution(base_path):
+    """Building with worker processes records stats per member and names the member that differs
+    in verify errors."""
+    dir_tree = dir_tree_factory(base_path)
+    for _ in range(20):
+        file_factory(dir_tree)
+    paths = sorted(dir_tree.glob("**/*"))
+    names = [str(path).lstrip("/").replace(os.sep, "/") for path in paths]
+
+    arc_path = base_path / "arc.tar"
+    stats = ArchiveStats()
+    with ReproducibleTarFile.open(arc_path, "w", stats=stats) as tp:
+        tp.add_paths(paths, jobs=3)
+    assert [member.name for member in stats.members] == names
+    for path, member in zip(paths, stats.members):
+        assert member.nbytes["read"] == (path.stat().st_size if path.is_file() else 0)
+        assert member.nbytes["header"] > 0
+        assert member.nbytes["write"] >= member.nbytes["header"] + member.nbytes["read"]
+    assert stats.nbytes["read"] == sum(path.stat().st_size for path in paths if path.is_file())
+
+    changed = next(i for i, path in enumerate(paths) if path.is_file() and i > len(paths) // 2)
+    paths[changed].write_bytes(paths[changed].read_bytes()[::-1] + b"!")
+    with pytest.raises(ArchiveMismatchError) as exc_info:
+        with VerifySink(arc_path) as sink:
+            with ReproducibleTarFile.open(fileobj=sink, mode="w") as tp:
+                tp.add_paths(paths, jobs=3)
+    assert exc_info.value.member == names[changed]
+
+
+@pytest.mark.parametrize(
+    "patterns, path, is_dir, expected",
+    [
+        (["*.pyc"], "a.pyc", False, False),
+        (["*.pyc"], "sub/a.pyc", False, False),
+        (["*.pyc", "!keep.pyc"], "sub/keep.pyc", False, True),
+        (["__pycache__"], "sub/__pycache__/a.pyc", False, False),
+        (["__pycache__", "!a.pyc"], "__pycache__/a.pyc", False, False),
+        ([".git/"], ".git", True, False),
+        ([".git/"], ".git", False, True),
+        (["/build"], "build", True, False),
+        (["/build"], "sub/build", True, True),
+        (["docs/*.tmp"], "docs/a.tmp", False, False),
+        (["docs/*.tmp"], "docs/sub/a.tmp", False, True),
+        (["docs/**/*.tmp"], "docs/sub/a.tmp", False, False),
+        (["**/logs"], "a/b/logs", True, False),
+        (["data/**"], "data/x/y", False, False),
+        (["file?.[ch]"], "file1.c", False, False),
+        (["file?.[!ch]"], "file1.c", False, True),
+        (["# comment", "", "\\#hash"], "#hash", False, False),
+    ],
+)
+def test_path_matcher(patterns, path, is_dir, expected):
+    assert PathMatcher(exclude=patterns).match(path, is_dir) is expected
+
+
+def test_path_matcher_include():
+    matcher = PathMatcher(exclude=["skip_*"], include=["*.py", "docs/"])
+    assert matcher.match("a/b.py")
+    assert not matcher.match("a/b.txt")
+    assert not matcher.match("a/skip_b.py")
+    assert matcher.match("docs", is_dir=True)
+    assert not matcher.match("a", is_dir=True)
+
+
+def test_add_matcher(base_path, monkeypatch):
+    """Adding with a PathMatcher leaves out matching paths and does not read excluded
+    directories."""
+    dir_tree = dir_tree_factory(base_path)
+    (dir_tree / ".git").mkdir()
+    file_factory(dir_tree / ".git")
+    (dir_tree / "sub_dir" / "skip.log").write_text("skip")
+
+    # Without patterns, the result is the same as TarFile.add
+    arc_add = base_path / "add.tar"
+    with ReproducibleTarFile.open(arc_add, "w") as tp:
+        tp.add(dir_tree)
+    arc_matcher = base_path / "matcher.tar"
+    with ReproducibleTarFile.open(arc_matcher, "w") as tp:
+        tp.add(dir_tree, matcher=PathMatcher())
+    assert hash_file(arc_add) == hash_file(arc_matcher)
+
+    scanned = []
+    scandir = os.scandir
+
+    def scandir_spy(path):
+        scanned.append(os.path.basename(path))
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", scandir_spy)
+    matcher = PathMatcher(exclude=[".git/", "*.log"])
+    arc_exclude = base_path / "exclude.tar"
+    with ReproducibleTarFile.open(arc_exclude, "w") as tp:
+        tp.add(dir_tree, arcname="root", matcher=matcher)
+        names = tp.getnames()
+    assert ".git" not in scanned
+    assert names == ["root"] + [
+        "root/" + path.relative_to(dir_tree).as_posix()
+        for path in sorted(dir_tree.glob("**/*"), key=lambda path: path.parts)
+        if ".git" not in path.parts and path.suffix != ".log"
+    ]
+    assert list(matcher.walk(dir_tree)) == [
+        str(dir_tree / name[len("root/") :]) if name != "root" else str(dir_tree) for name in names
+    ]
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_keep_members_false(base_path, jobs):
+    """Without keeping members, a compact index is recorded instead and the bytes are the same."""
+    dir_tree = dir_tree_factory(base_path)
+    for _ in range(10):
+        file_factory(dir_tree)
+    paths = sorted(dir_tree.glob("**/*"))
+
+    arc_members = base_path / "members.tar"
+    with ReproducibleTarFile.open(arc_members, "w") as tp:
+        tp.add_paths(paths, jobs=jobs)
+        assert tp.member_index is None
+
+    arc_index = base_path / "index.tar"
+    with ReproducibleTarFile.open(arc_index, "w", keep_members=False) as tp:
+        tp.add_paths(paths, jobs=jobs)
+        assert tp.getmembers() == []
+        member_index = tp.member_index
+    assert hash_file(arc_members) == hash_file(arc_index)
+
+    with TarFile.open(arc_index) as tp:
+        expected = [
+            IndexEntry(member.name, member.offset, member.offset_data, member.size)
+            for member in tp.getmembers()
+        ]
+    assert list(member_index) == expected
+    assert member_index[-1] == expected[-1]
+    assert member_index.names() == [entry.name for entry in expected]
+    with pytest.raises(IndexError):
+        member_index[len(expected)]
+
+
+def test_gettarinfo_no_name_lookups(base_path, monkeypatch):
+    """gettarinfo uses the fixed owner values without user and group database lookups."""
+    import tarfile
+
+    class NoLookups:
+        def __getattr__(self, name):
+            raise AssertionError(f"unexpected lookup with {name}")
+
+    monkeypatch.setattr(tarfile, "pwd", NoLookups())
+    monkeypatch.setattr(tarfile, "grp", NoLookups())
+    monkeypatch.setenv("REPRO_TARFILE_UNAME", "repro")
+    data_file = file_factory(base_path)
+
+    with ReproducibleTarFile.open(base_path / "archive.tar", "w") as tp:
+        tarinfo = tp.gettarinfo(data_file)
+        tp.add(data_file)
+    assert (tarinfo.uid, tarinfo.gid, tarinfo.uname, tarinfo.gname) == (0, 0, "repro", "")
+    assert tarinfo.size == data_file.stat().st_size
+
+
+@pytest.mark.skipif(not hasattr(os, "link"), reason="needs os.link")
+def test_gettarinfo_hard_links(base_path):
+    """Hard links are detected like TarFile does, including links made after their target was
+    added."""
+    data_file = file_factory(base_path)
+
+    def build(cls):
+        link = base_path / "link.txt"
+        with cls.open(base_path / "archive.tar", "w") as tp:
+            tp.add(data_file, arcname="data.txt")
+            os.link(data_file, link)
+            tp.add(link, arcname="link.txt")
+        link.unlink()
+        with TarFile.open(base_path / "archive.tar") as tp:
+            return [(member.name, member.type, member.linkname) for member in tp.getmembers()]
+
+    expected = [("data.txt", tarfile.REGTYPE, ""), ("link.txt", tarfile.LNKTYPE, "data.txt")]
+    assert build(TarFile) == build(ReproducibleTarFile) == expected
+
+
+def test_gettarinfo_no_deprecation_warning(base_path):
+    """gettarinfo doesn't set the TarInfo.tarfile attribute that Python 3.13+ deprecates."""
+    import warnings
+
+    data_file = file_factory(base_path)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        with ReproducibleTarFile.open(base_path / "archive.tar", "w") as tp:
+            tp.add(data_file)
+
+
+class _ListSink(PartUploadSink):
+    def upload_part(self, part_number, data):
+        return data
+
+
+def test_part_upload_sink_boundaries():
+    """Part boundaries depend only on the bytes written, not on the sizes of writes."""
+    data = os.urandom(10_000)
+    results = []
+    for chunk_size in (1, 7, 1000, 10_000):
+        with _ListSink(part_size=1024, max_workers=3, max_pending=2) as sink:
+            for i in range(0, len(data), chunk_size):
+                sink.write(data[i : i + chunk_size])
+            assert sink.tell() == len(data)
+        results.append([part for _, part in sink.parts])
+        assert [part_number for part_number, _ in sink.parts] == list(range(1, 11))
+    assert all(parts == results[0] for parts in results)
+    assert [len(part) for part in results[0]] == [1024] * 9 + [10_000 - 9 * 1024]
+    assert b"".join(results[0]) == data
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz"])
+def test_http_multipart_sink(base_path, mode):
+    """Archives streamed to an object store are identical to archives written locally."""
+    dir_tree = dir_tree_factory(base_path)
+    for i in range(5):
+        (dir_tree / f"random{i}.bin").write_bytes(os.urandom(5000))
+
+    local = BytesIO()
+    with ReproducibleTarFile.open(fileobj=local, mode=mode) as tp:
+        tp.add(dir_tree)
+
+    etags = []
+    with MultipartUploadServer() as server:
+        for _ in range(2):
+            url = server.url + "/bucket/archive.tar"
+            with HTTPMultipartSink(url, part_size=4096, max_workers=2, max_pending=2) as sink:
+                with ReproducibleTarFile.open(fileobj=sink, mode=mode) as tp:
+                    tp.add(dir_tree)
+            assert server.objects["/bucket/archive.tar"] == local.getvalue()
+            etags.append([etag for _, etag in sink.parts])
+        assert server.max_active <= 2
+        part_sizes = [len(part) for part in server.parts["/bucket/archive.tar"]]
+    assert len(part_sizes) > 2
+    assert set(part_sizes[:-1]) == {4096}
+    assert etags[0] == etags[1]
+
+
+def test_http_multipart_sink_failure():
+    """A failed part aborts the upload and raises."""
+    with MultipartUploadServer(fail_part=2) as server:
+        sink = HTTPMultipartSink(server.url + "/bucket/archive.tar", part_size=1024)
+        with pytest.raises(OSError, match="HTTP 500"):
+            with sink:
+                for _ in range(10):
+                    sink.write(os.urandom(1024))
+        assert server.aborted == [sink.upload_id]
+        assert server.objects == {}
+
+
+def test_http_multipart_sink_retry():
+    """Parts are uploaded again when the connection is closed before the reply, but starting and
+    completing the upload aren't, since that could start a second upload."""
+    data = os.urandom(5000)
+    url_path = "/bucket/archive.tar"
+    with MultipartUploadServer(drop_method="PUT") as server:
+        with HTTPMultipartSink(server.url + url_path, part_size=1024) as sink:
+            sink.write(data)
+        assert server.objects[url_path] == data
+
+    with MultipartUploadServer(drop_method="POST") as server:
+        with pytest.raises(OSError):
+            with HTTPMultipartSink(server.url + url_path, part_size=1024) as sink:
+                sink.write(data)
+        assert list(server.uploads) == ["upload-0"]
+        assert server.objects == {}
+
+    with MultipartUploadServer(etag=False) as server:
+        sink = HTTPMultipartSink(server.url + url_path, part_size=1024)
+        with pytest.raises(OSError, match=r"partNumber=\d+&.* returned no ETag"):
+            with sink:
+                sink.write(data)
+        assert server.aborted == [sink.upload_id]
+
+
+def test_teeopen(base_path):
+    """Tee mode writes several archives from one read of the inputs, each identical to a separate
+    build."""
+    dir_tree = dir_tree_factory(base_path)
+    modes = ["w", "w:gz", "w:bz2", "w:xz"]
+
+    expected = {}
+    for mode in modes:
+        arc_path = base_path / f"separate.{mode.replace(':', '.')}"
+        with ReproducibleTarFile.open(arc_path, mode) as tp:
+            tp.add(dir_tree)
+        expected[mode] = arc_path.read_bytes()
+
+    stats = ArchiveStats()
+    buffer = BytesIO()
+    targets = [(base_path / f"tee.{mode.replace(':', '.')}", mode) for mode in modes[:-1]]
+    with ReproducibleTarFile.teeopen(targets + [(buffer, "w:xz")], stats=stats) as tp:
+        tp.add(dir_tree)
+    for arc_path, mode in targets:
+        assert arc_path.read_bytes() == expected[mode], mode
+    assert buffer.getvalue() == expected["w:xz"]
+    # External file objects are left open
+    assert not buffer.closed
+    # Each input file was read once
+    input_size = sum(path.stat().st_size for path in dir_tree.glob("**/*") if path.is_file())
+    assert stats.nbytes["read"] == input_size
+
+    with pytest.raises(ValueError):
+        ReproducibleTarFile.teeopen([(base_path / "bad.tar", "r")])
+
+
+def test_volume_sink(base_path):
+    """Archives are split into volumes of a fixed size that join to the same archive."""
+    dir_tree = dir_tree_factory(base_path)
+    for _ in range(5):
+        file_factory(dir_tree)
+
+    arc_path = base_path / "archive.tar.gz"
+    with ReproducibleTarFile.open(arc_path, "w:gz") as tp:
+        tp.add(dir_tree)
+    expected = arc_path.read_bytes()
+
+    volume_size = len(expected) // 3 + 1
+
+    def on_volume(path):
+        return hash_file(Path(path))
+
+    with VolumeSink(base_path / "volumes.tar.gz", volume_size, on_volume=on_volume) as sink:
+        with ReproducibleTarFile.open(fileobj=sink, mode="w:gz") as tp:
+            tp.add(dir_tree)
+    volume_paths = [path for path, _ in sink.volumes]
+    assert volume_paths == [sink.volume_path(i) for i in range(3)]
+    assert volume_paths[0].endswith("volumes.tar.gz.000")
+    volumes = [Path(path).read_bytes() for path in volume_paths]
+    assert [len(volume) for volume in volumes[:-1]] == [volume_size] * 2
+    assert b"".join(volumes) == expected
+    assert [result for _, result in sink.volumes] == [on_volume(path) for path in volume_paths]
+
+    def fail(path):
+        raise RuntimeError(f"failed on {path}")
+
+    with pytest.raises(RuntimeError, match="failed on"):
+        with VolumeSink(base_path / "fail.tar", 1024, on_volume=fail) as sink:
+            for _ in range(10):
+                sink.write(os.urandom(1024))
+                sleep(0.01)
+
+
+def test_gzip_rsyncable(base_path):
+    """Rsyncable gzip archives have the same contents, don't depend on how writes are split, and
+    share most compressed bytes with the archive before a change."""
+    dir_tree = base_path / "dir"
+    dir_tree.mkdir()
+    rng = random.Random(0)
+    for i in range(100):
+        (dir_tree / f"{i:02d}.txt").write_bytes(
+            b"%04d" % i * 50 + rng.getrandbits(16000).to_bytes(2000, "big")
+        )
+
+    def build(arc_path, **kwargs):
+        with ReproducibleTarFile.open(arc_path, "w:gz", **kwargs) as tp:
+            tp.add(dir_tree)
+        return arc_path.read_bytes()
+
+    plain = build(base_path / "plain.tar.gz")
+    rsyncable = build(base_path / "rsyncable.tar.gz", rsyncable=True)
+    assert rsyncable != plain
+    assert gzip.decompress(rsyncable) == gzip.decompress(plain)
+    assert build(base_path / "unbuffered.tar.gz", rsyncable=True, write_buffer_size=0) == rsyncable
+
+    with (dir_tree / "05.txt").open("ab") as fp:
+        fp.write(b"change")
+    changed = build(base_path / "changed.tar.gz", rsyncable=True)
+    assert changed != rsyncable
+    # Compressed bytes after the change are the same once compression resynchronizes, up to the
+    # gzip trailer with the checksum of all data
+    body, changed_body = rsyncable[:-8], changed[:-8]
+    common_suffix = next(i for i in range(1, len(body)) if changed_body[-i - 1] != body[-i - 1])
+    assert common_suffix > len(body) // 2
+
+
+@pytest.mark.parametrize("mode", ["", ":gz"])
+def test_append(base_path, mode):
+    """Appending with fast_append gives the same tar stream as a fresh build of all members."""
+    dir_tree = dir_tree_factory(base_path)
+    paths = sorted(str(path) for path in dir_tree.glob("**/*") if path.is_file())
+    # An archive as the last member must not be mistaken for the end of the archive
+    inner_path = base_path / "inner.tar"
+    with ReproducibleTarFile.open(inner_path, "w") as tp:
+        tp.add(paths[0])
+    paths.insert(1, str(inner_path))
+
+    def build(arc_path, *parts):
+        for i, part in enumerate(parts):
+            with ReproducibleTarFile.open(
+                arc_path, ("a" if i else "w") + mode, fast_append=True
+            ) as tp:
+                for path in part:
+                    tp.add(path, recursive=False)
+        data = arc_path.read_bytes()
+        return gzip.decompress(data) if mode else data
+
+    expected = build(base_path / "fresh.tar", paths)
+    assert build(base_path / "appended.tar", paths[:2], paths[2:3], paths[3:]) == expected
+    # A missing file is created
+    assert build(base_path / "missing.tar", [], paths) == expected
+    assert build(base_path / "new.tar", paths) == build(base_path / "new.tar", [], [], paths)
+    with ReproducibleTarFile.open(base_path / "appended.tar", "r" + mode) as tp:
+        assert tp.getnames() == [path.lstrip("/") for path in paths]
+
+
+def test_append_gzip_members(tmp_path):
+    """Appending to a gzip archive only recompresses the gzip member holding the end of the
+    archive."""
+    arc_path = tmp_path / "arc.tar.gz"
+    for i in range(3):
+        with ReproducibleTarFile.open(arc_path, "a:gz", fast_append=True) as tp:
+            tarinfo = TarInfo(f"{i}.txt")
+            tarinfo.size = 4
+            tp.addfile(tarinfo, BytesIO(b"data"))
+        if i == 1:
+            first_append = arc_path.read_bytes()
+    data = arc_path.read_bytes()
+    assert data.startswith(first_append[: first_append.rindex(b"\x1f\x8b")])
+    assert data.count(b"\x1f\x8b\x08") == 3
+    with TarFile.open(arc_path) as tp:
+        assert tp.getnames() == ["0.txt", "1.txt", "2.txt"]
+
+
+def test_append_default(base_path):
+    """Without fast_append, appending loads the existing members like TarFile does."""
+    paths = [file_factory(base_path) for _ in range(3)]
+    with ReproducibleTarFile.open(base_path / "fresh.tar", "w") as tp:
+        for path in paths:
+            tp.add(path, recursive=False)
+
+    arc_path = base_path / "appended.tar"
+    with ReproducibleTarFile.open(arc_path, "w") as tp:
+        tp.add(paths[0], recursive=False)
+    with ReproducibleTarFile.open(arc_path, "a") as tp:
+        assert tp.getnames() == [str(paths[0]).lstrip("/")]
+        for path in paths[1:]:
+            tp.add(path, recursive=False)
+        assert tp.getnames() == [str(path).lstrip("/") for path in paths]
+    assert hash_file(arc_path) == hash_file(base_path / "fresh.tar")
+
+    # Appending to gzip archives isn't possible without it, like with TarFile
+    with pytest.raises(ValueError, match="fast_append"):
+        ReproducibleTarFile.open(base_path / "appended.tar.gz", "a:gz")
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz"])
+def test_verify_sink(base_path, mode):
+    """VerifySink checks a rebuild against an existing archive without writing it, and reports
+    where it first differs."""
+    dir_tree = dir_tree_factory(base_path)
+    paths = sorted(path for path in dir_tree.glob("**/*") if path.is_file())
+    arc_path = base_path / "arc.tar"
+    with ReproducibleTarFile.open(arc_path, mode) as tp:
+        tp.add(dir_tree)
+    expected = arc_path.read_bytes()
+
+    def verify(existing):
+        with VerifySink(existing) as sink:
+            with ReproducibleTarFile.open(fileobj=sink, mode=mode, write_buffer_size=0) as tp:
+                tp.add(dir_tree)
+        assert sink.tell() == len(expected)
+
+    verify(arc_path)
+    verify(BytesIO(expected))
+
+    with pytest.raises(ArchiveMismatchError) as exc_info:
+        verify(BytesIO(expected + b"extra"))
+    assert exc_info.value.offset == len(expected)
+    assert exc_info.value.member is None
+    with pytest.raises(ArchiveMismatchError) as exc_info:
+        verify(BytesIO(expected[: len(expected) // 2]))
+    assert exc_info.value.offset == len(expected) // 2
+
+    paths[0].write_text("changed")
+    rebuilt = BytesIO()
+    with ReproducibleTarFile.open(fileobj=rebuilt, mode=mode) as tp:
+        tp.add(dir_tree)
+    offset = next(i for i, (a, b) in enumerate(zip(expected, rebuilt.getvalue())) if a != b)
+    with pytest.raises(ArchiveMismatchError) as exc_info:
+        verify(arc_path)
+    assert exc_info.value.offset == offset
+    if mode == "w":
+        assert exc_info.value.member == paths[0].as_posix().lstrip("/")
+    assert arc_path.read_bytes() == expected
+
+
+def test_add_many_bytes():
+    """add_many_bytes writes the same archive as addfile with a TarInfo and BytesIO per member,
+    for bytes-like data, file objects, and iterables of chunks."""
+    contents = {
+        "a.txt": b"hello",
+        "dir/b.txt": bytearray(b"x" * 1000),
+        "dir/sub/c.txt": b"",
+        "d.txt": b"y" * 3000,
+    }
+
+    def build(add):
+        buffer = BytesIO()
+        with ReproducibleTarFile.open(fileobj=buffer, mode="w") as tp:
+            add(tp)
+        return buffer.getvalue()
+
+    def add_with_addfile(tp, dirs=False):
+        added = set()
+        for name, data in contents.items():
+            parts = name.split("/")[:-1]
+            for i in range(1, len(parts) + 1):
+                dirname = "/".join(parts[:i])
+                if dirs and dirname not in added:
+                    added.add(dirname)
+                    tarinfo = TarInfo(dirname)
+                    tarinfo.type = DIRTYPE
+                    tp.addfile(tarinfo)
+            tarinfo = TarInfo(name)
+            tarinfo.size = len(data)
+            tp.addfile(tarinfo, BytesIO(data))
+
+    expected = build(add_with_addfile)
+    assert build(lambda tp: tp.add_many_bytes(contents)) == expected
+    assert build(lambda tp: tp.add_many_bytes(list(contents.items()))) == expected
+    assert (
+        build(
+            lambda tp: tp.add_many_bytes(
+                (name, BytesIO(data) if i % 2 else iter([data[:10], memoryview(data)[10:]]))
+                for i, (name, data) in enumerate(contents.items())
+            )
+        )
+        == expected
+    )
+
+    def add_bytes(tp):
+        for name, data in contents.items():
+            tp.add_bytes(name, memoryview(data))
+
+    assert build(add_bytes) == expected
+
+    with_dirs = build(lambda tp: add_with_addfile(tp, dirs=True))
+
+    def add_in_two_calls(tp):
+        items = list(contents.items())
+        tp.add_many_bytes(items[:2], dirs=True)
+        tp.add_many_bytes(items[2:], dirs=True, spool_size=100)
+
+    assert build(add_in_two_calls) == with_dirs
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_add_many_bytes_existing_dirs(base_path, jobs):
+    """add_many_bytes doesn't add directories again that were added with add or addfile, or
+    that were in the archive before appending."""
+    (base_path / "tree" / "sub").mkdir(parents=True)
+    paths = [base_path / "tree", base_path / "tree" / "sub"]
+    arcnames = ["tree", "tree/sub"]
+    arc_path = base_path / "arc.tar"
+    with ReproducibleTarFile.open(arc_path, "w") as tp:
+        tp.add_paths(paths, arcnames, jobs=jobs)
+        tarinfo = TarInfo("other/")
+        tarinfo.type = DIRTYPE
+        tp.addfile(tarinfo)
+        tp.add_many_bytes({"tree/sub/a.txt": b"a", "other/b.txt": b"b"}, dirs=True)
+    with ReproducibleTarFile.open(arc_path, "a") as tp:
+        tp.add_many_bytes({"tree/c.txt": b"c", "new/d.txt": b"d"}, dirs=True)
+    with TarFile.open(arc_path) as tp:
+        assert tp.getnames() == [
+            "tree",
+            "tree/sub",
+            "other",
+            "tree/sub/a.txt",
+            "other/b.txt",
+            "tree/c.txt",
+            "new",
+            "new/d.txt",
+        ]
+
+
+@pytest.mark.parametrize("format", [tarfile.USTAR_FORMAT, tarfile.GNU_FORMAT, tarfile.PAX_FORMAT])
+def test_header_encoder(format):
+    """The template header encoder gives the same bytes as TarInfo.tobuf, including for members
+    that need extended headers or can't be encoded."""
+    encoder = _HeaderEncoder()
+    cases = []
+    for name in ["a.txt", "dir/", "x" * 100, "x" * 101, "dir/" * 40, "ünïcode.txt", "\udcff"]:
+        for member_type in [tarfile.REGTYPE, tarfile.DIRTYPE, tarfile.SYMTYPE, tarfile.CHRTYPE]:
+            for size in [0, 1000, 8**11]:
+                tarinfo = TarInfo(name)
+                tarinfo.type = member_type
+                tarinfo.size = size
+                tarinfo.mtime = mtime()
+                tarinfo.mode = 0o100644
+                if member_type == tarfile.SYMTYPE:
+                    tarinfo.linkname = name[::-1]
+                cases.append(tarinfo)
+    tarinfo = TarInfo("float-mtime.txt")
+    tarinfo.mtime = 1.5
+    cases.append(tarinfo)
+    tarinfo = TarInfo("long-uname.txt")
+    tarinfo.uname = "u" * 40
+    cases.append(tarinfo)
+    tarinfo = TarInfo("pax.txt")
+    tarinfo.pax_headers = {"comment": "hello"}
+    cases.append(tarinfo)
+
+    for tarinfo in cases:
+        try:
+            expected = tarinfo.tobuf(format, "utf-8", "surrogateescape")
+        except ValueError:
+            with pytest.raises(ValueError):
+                encoder.encode(tarinfo, format, "utf-8", "surrogateescape")
+        else:
+            assert encoder.encode(tarinfo, format, "utf-8", "surrogateescape") == expected
+
+
+def test_gzip_fragments(base_path):
+    """Fragment mode gives the same tar stream, reuses cached fragments for unchanged members,
+    and its output doesn't depend on the cache or on jobs."""
+    dir_tree = base_path / "dir"
+    dir_tree.mkdir()
+    rng = random.Random(0)
+    for i in range(100):
+        (dir_tree / f"{i:02d}.txt").write_bytes(b"%04d" % i * rng.randrange(10, 2000))
+    paths = sorted(dir_tree.iterdir())
+
+    def build(arc_path, jobs=1, **kwargs):
+        with ReproducibleTarFile.open(arc_path, "w:gz", **kwargs) as tp:
+            tp.add_paths(paths, jobs=jobs)
+        return arc_path.read_bytes()
+
+    plain = build(base_path / "plain.tar.gz")
+    cache_dir = base_path / "cache"
+    cache = FragmentCache(cache_dir)
+    fragments = build(base_path / "fragments.tar.gz", fragment_size=8192, fragment_cache=cache)
+    assert gzip.decompress(fragments) == gzip.decompress(plain)
+    assert cache.hits == 0
+    assert cache.misses > 10
+    assert fragments.count(b"\x1f\x8b\x08") >= cache.misses
+
+    cache = FragmentCache(cache_dir)
+    assert (
+        build(base_path / "cached.tar.gz", fragment_size=8192, fragment_cache=cache) == fragments
+    )
+    assert cache.misses == 0
+
+    with (dir_tree / "50.txt").open("ab") as fp:
+        fp.write(b"change")
+    cache = FragmentCache(cache_dir)
+    changed = build(base_path / "changed.tar.gz", fragment_size=8192, fragment_cache=cache)
+    assert 0 < cache.misses <= 3
+    assert build(base_path / "uncached.tar.gz", fragment_size=8192) == changed
+    assert build(base_path / "jobs.tar.gz", jobs=2, fragment_size=8192) == changed
+
+    with pytest.raises(ValueError):
+        ReproducibleTarFile.open(
+            base_path / "bad.tar.gz", "w:gz", fragment_size=8192, rsyncable=True
+        )
+
+
+def test_build_archives(base_path):
+    """Archives built in a batch with shared members are the same as archives built one at a
+    time."""
+    (base_path / "inputs").mkdir()
+    dir_tree = dir_tree_factory(base_path / "inputs")
+    other = file_factory(base_path / "inputs")
+    if hasattr(os, "link"):
+        # Files with other links are added per archive, since hard links depend on the archive
+        os.link(next(dir_tree.glob("*.txt")), dir_tree / "zz_hardlink.txt")
+    specs = [
+        {"output": base_path / "a.tar", "inputs": [dir_tree]},
+        {"output": base_path / "b.tar.gz", "inputs": [dir_tree, other], "compression": "gz"},
+        {"output": base_path / "c.tar", "inputs": [dir_tree], "exclude": ["*.txt"]},
+        {"output": base_path / "d.tar", "inputs": [other], "recursion": False},
+    ]
+
+    def build_one(spec, out):
+        matcher = PathMatcher(exclude=spec.get("exclude", ()))
+        paths = set()
+        for top in spec["inputs"]:
+            paths.update(Path(p) for p in matcher.walk(top, spec.get("recursion", True)))
+        mode = "w:" + spec["compression"] if "compression" in spec else "w"
+        with ReproducibleTarFile.open(out, mode) as tp:
+            for path in sorted(paths):
+                tp.add(path, recursive=False)
+
+    for jobs in (1, 2):
+        summaries = build_archives(specs, jobs=jobs)
+        assert [summary["output"] for summary in summaries] == [
+            str(spec["output"]) for spec in specs
+        ]
+        for spec, summary in zip(specs, summaries):
+            build_one(spec, base_path / "one")
+            assert hash_file(spec["output"]) == hash_file(base_path / "one")
+            assert summary["sha256"] == sha256(Path(spec["output"]).read_bytes()).hexdigest()
+            assert summary["size"] == os.path.getsize(spec["output"])
+            with tarfile.open(spec["output"]) as tp:
+                assert summary["members"] == len(tp.getmembers())
+
+    with pytest.raises(ValueError):
+        build_archives([{"output": base_path / "e.tar", "inputs": [other], "level": 1}])
+
+
+def test_add_encoded_keep_members():
+    """Adding an encoded member to an archive that keeps TarInfo objects fails without writing
+    anything."""
+    source = BytesIO()
+    with ReproducibleTarFile.open(fileobj=source, mode="w", keep_members=False) as tp:
+        tp.add_bytes("a.txt", b"data")
+        entry = tp.member_index[0]
+        length = tp.offset
+    fileobj = BytesIO()
+    tp = ReproducibleTarFile.open(fileobj=fileobj, mode="w")
+    source.seek(0)
+    with pytest.raises(ValueError):
+        tp._add_encoded(source, length, entry)
+    assert tp.offset == 0
+    assert fileobj.getvalue() == b""
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_fadvise"), reason="needs os.posix_fadvise")
+@pytest.mark.parametrize("mode", ["w", "w:gz"])
+def test_io_policy_stream(base_path, mode, monkeypatch):
+    """The stream I/O policy advises the kernel about input and output pages without changing the
+    archive bytes."""
+    import repro_tarfile
+
+    monkeypatch.setattr(repro_tarfile, "_READAHEAD_SIZE", 4096)
+    monkeypatch.setattr(repro_tarfile, "_SYNC_SIZE", 16384)
+    dir_tree = dir_tree_factory(base_path)
+    (dir_tree / "large.bin").write_bytes(os.urandom(500_000))
+
+    # Without a write buffer, so that the output file grows while members are written
+    arc_default = base_path / "default.tar"
+    with ReproducibleTarFile.open(arc_default, mode, write_buffer_size=0) as tp:
+        tp.add(dir_tree)
+
+    advice = []
+    syncs = []
+    posix_fadvise = os.posix_fadvise
+    fdatasync = os.fdatasync
+
+    def record_fadvise(fd, offset, length, value):
+        advice.append(value)
+        posix_fadvise(fd, offset, length, value)
+
+    def record_fdatasync(fd):
+        syncs.append(fd)
+        fdatasync(fd)
+
+    monkeypatch.setattr(os, "posix_fadvise", record_fadvise)
+    monkeypatch.setattr(os, "fdatasync", record_fdatasync)
+    arc_stream = base_path / "stream.tar"
+    with ReproducibleTarFile.open(arc_stream, mode, write_buffer_size=0, io_policy="stream") as tp:
+        tp.add(dir_tree)
+
+    assert hash_file(arc_default) == hash_file(arc_stream)
+    n_files = sum(1 for path in dir_tree.glob("**/*") if path.is_file())
+    assert advice.count(os.POSIX_FADV_SEQUENTIAL) == n_files
+    assert advice.count(os.POSIX_FADV_WILLNEED) > n_files
+    # Pages of inputs are dropped while reading and after each file, and output pages after syncs
+    assert advice.count(os.POSIX_FADV_DONTNEED) > n_files + len(syncs)
+    # Output is synced while large members are written
+    assert len(syncs) >= 2
+
+    with pytest.raises(ValueError):
+        ReproducibleTarFile.open(base_path / "other.tar", "w", io_policy="random")
+
+
+def test_concurrent_writer():
+    """Members submitted from many threads are written in key order, identical to adding them
+    sequentially."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    rng = random.Random(0)
+    members = []
+    for key in range(200):
+        if key % 10 == 0:
+            tarinfo = TarInfo(f"dir{key}")
+            tarinfo.type = DIRTYPE
+            members.append((tarinfo, None))
+        else:
+            data = bytes(rng.getrandbits(8) for _ in range(rng.randrange(3000)))
+            tarinfo = TarInfo(f"dir{key - key % 10}/file{key}.bin")
+            tarinfo.size = len(data)
+            members.append((tarinfo, data))
+    delays = [rng.random() / 1000 for _ in members]
+
+    sequential = BytesIO()
+    with ReproducibleTarFile.open(fileobj=sequential, mode="w") as tp:
+        for tarinfo, data in members:
+            tp.addfile(tarinfo, None if data is None else BytesIO(data))
+
+    def produce(writer, key):
+        # Finish out of order, with half of the data given as file objects
+        sleep(delays[key])
+        tarinfo, data = members[key]
+        if data is not None and key % 2:
+            data = BytesIO(data)
+        writer.submit(key, tarinfo, data)
+
+    concurrent = BytesIO()
+    with ReproducibleTarFile.open(fileobj=concurrent, mode="w") as tp:
+        with ConcurrentWriter(tp, memory_budget=10_000) as writer:
+            with ThreadPoolExecutor(8) as executor:
+                for future in [executor.submit(produce, writer, key) for key in range(200)]:
+                    future.result()
+    assert concurrent.getvalue() == sequential.getvalue()
+
+    # Later members wait for earlier ones when over the memory budget
+    with ReproducibleTarFile.open(fileobj=BytesIO(), mode="w") as tp:
+        writer = ConcurrentWriter(tp, memory_budget=150)
+        data = b"x" * 100
+        writer.submit(1, TarInfo("1"), b"")
+        writer.submit(2, TarInfo("2"), data)
+        blocked = threading.Thread(target=writer.submit, args=(3, TarInfo("3"), data))
+        blocked.start()
+        blocked.join(0.1)
+        assert blocked.is_alive()
+        writer.submit(0, TarInfo("0"), b"")
+        blocked.join()
+        with pytest.raises(ValueError):
+            writer.submit(2, TarInfo("2"), b"")
+        writer.close()
+        assert tp.getnames() == ["0", "1", "2", "3"]
+
+    with ReproducibleTarFile.open(fileobj=BytesIO(), mode="w") as tp:
+        writer = ConcurrentWriter(tp)
+        writer.submit(1, TarInfo("1"))
+        with pytest.raises(ValueError, match="key 0 was never submitted"):
+            writer.close()
+
+
+@pytest.mark.parametrize("format", [tarfile.GNU_FORMAT, tarfile.PAX_FORMAT])
+def test_estimate_size(base_path, format):
+    """estimate_size gives the exact size of uncompressed archives, and preallocated archives are
+    the same as archives that aren't."""
+    dir_tree = dir_tree_factory(base_path)
+    (dir_tree / ("long_name" * 20)).write_text("long name")
+    (dir_tree / "large.bin").write_bytes(os.urandom(30_000))
+    if hasattr(os, "link"):
+        os.link(next(dir_tree.glob("*.txt")), dir_tree / "zz_hardlink.txt")
+    if platform.system() != "Windows":
+        (dir_tree / "symlink").symlink_to("large.bin")
+    paths = sorted(dir_tree.glob("**/*"))
+
+    arc_reference = base_path / "reference.tar"
+    with ReproducibleTarFile.open(arc_reference, "w", format=format) as tp:
+        tp.add(paths[0])
+        size = tp.estimate_size(paths[1:])
+        tp.add_paths(paths[1:])
+    assert size == os.path.getsize(arc_reference)
+
+    # Estimating doesn't change the hard link state, and too much preallocated space is cut off
+    arc_preallocated = base_path / "preallocated.tar"
+    with ReproducibleTarFile.open(arc_preallocated, "w", format=format) as tp:
+        tp.add(paths[0])
+        assert tp.estimate_size(paths[1:]) == size
+        preallocated = tp.preallocate(size + 100_000)
+        if preallocated:
+            assert os.path.getsize(arc_preallocated) == size + 100_000
+        tp.add_paths(paths[1:])
+    assert hash_file(arc_preallocated) == hash_file(arc_reference)
+
+    with ReproducibleTarFile.open(base_path / "compressed.tar.gz", "w:gz", format=format) as tp:
+        assert not tp.preallocate(size)
+
+
+def test_preallocate_close_error(base_path):
+    """Preallocated space is cut off and the file is closed even if writing the end of the
+    archive fails."""
+
+    class FailingWriter:
+        def __init__(self, fileobj):
+            self._fileobj = fileobj
+
+        def write(self, data):
+            raise OSError("disk full")
+
+        def __getattr__(self, name):
+            return getattr(self._fileobj, name)
+
+    arc_path = base_path / "preallocated.tar"
+    tp = ReproducibleTarFile.open(arc_path, "w")
+    tp.add_bytes("a.txt", b"data")
+    written = tp.offset
+    if not tp.preallocate(1_000_000):
+        pytest.skip("preallocation not supported")
+    raw = tp.fileobj
+    tp.fileobj = FailingWriter(raw)
+    with pytest.raises(OSError, match="disk full"):
+        tp.close()
+    assert raw.closed
+    assert os.path.getsize(arc_path) == written
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz", "w:xz"])
+def test_archive_cache(base_path, mode, monkeypatch):
+    """Cached archives are identical to uncached ones, and are reused only when the tar stream
+    and the settings are unchanged."""
+    (base_path / "inputs").mkdir()
+    dir_tree = dir_tree_factory(base_path / "inputs")
+    cache = ArchiveCache(base_path / "cache")
+
+    def build(arc_path, **kwargs):
+        with ReproducibleTarFile.open(arc_path, mode, **kwargs) as tp:
+            tp.add(dir_tree)
+        return arc_path.read_bytes()
+
+    uncached = build(base_path / "uncached.tar")
+    assert build(base_path / "miss.tar", archive_cache=cache) == uncached
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert build(base_path / "hit.tar", archive_cache=cache) == uncached
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # A file object output, and a cache given by its directory
+    fileobj = BytesIO()
+    with ReproducibleTarFile.open(
+        fileobj=fileobj, mode=mode, archive_cache=base_path / "cache"
+    ) as tp:
+        tp.add(dir_tree)
+    assert fileobj.getvalue() == uncached
+
+    # Metadata settings and contents are part of the key
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    assert build(base_path / "epoch.tar", archive_cache=cache) != uncached
+    assert (cache.hits, cache.misses) == (1, 2)
+    monkeypatch.delenv("SOURCE_DATE_EPOCH")
+    (dir_tree / "new.txt").write_text("new")
+    build(base_path / "changed.tar", archive_cache=cache)
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    # Archives that aren't closed normally aren't cached, and leave the output unchanged
+    with pytest.raises(RuntimeError):
+        with ReproducibleTarFile.open(base_path / "hit.tar", mode, archive_cache=cache) as tp:
+            tp.add(dir_tree / "new.txt", arcname="other.txt")
+            raise RuntimeError
+    assert (base_path / "hit.tar").read_bytes() == uncached
+    with ReproducibleTarFile.open(base_path / "other.tar", mode, archive_cache=cache) as tp:
+        tp.add(dir_tree / "new.txt", arcname="other.txt")
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    # Least recently used archives are evicted
+    cached = sorted(p for p in (base_path / "cache").rglob("*") if p.is_file())
+    assert len(cached) == 4
+    os.utime(cached[0], (0, 0))
+    cache.max_size = sum(p.stat().st_size for p in cached) - 1
+    cache.evict()
+    assert [p for p in cached if p.exists()] == cached[1:]
+
+    with pytest.raises(ValueError):
+        ReproducibleTarFile.open(base_path / "append.tar", "a", archive_cache=cache)
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz", "w:xz"])
+def test_archive_cache_shared_start(base_path, mode):
+    """Archives whose tar streams only differ after the start are cached side by side, and the
+    part that matched a cached archive is recompressed when the rest doesn't."""
+    (base_path / "inputs").mkdir()
+    size = 3 * 1024 * 1024 // 2
+    (base_path / "inputs" / "a.bin").write_bytes(
+        random.Random(0).getrandbits(8 * size).to_bytes(size, "little")
+    )
+    cache = ArchiveCache(base_path / "cache")
+
+    def build(arc_path, **kwargs):
+        with ReproducibleTarFile.open(arc_path, mode, **kwargs) as tp:
+            tp.add(base_path / "inputs", arcname="inputs")
+        return arc_path.read_bytes()
+
+    outputs = []
+    for content in ("first", "second"):
+        (base_path / "inputs" / "b.txt").write_text(content)
+        uncached = build(base_path / f"{content}.tar")
+        assert build(base_path / f"{content}-miss.tar", archive_cache=cache) == uncached
+        outputs.append(uncached)
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert outputs[0] != outputs[1]
+
+    (base_path / "inputs" / "b.txt").write_text("first")
+    assert build(base_path / "first-hit.tar", archive_cache=cache) == outputs[0]
+    (base_path / "inputs" / "b.txt").write_text("second")
+    assert build(base_path / "second-hit.tar", archive_cache=cache) == outputs[1]
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    cached = [p for p in (base_path / "cache").rglob("*") if p.is_file()]
+    assert len(cached) == 2
+    assert len({(p.parent, p.name.partition("-")[0]) for p in cached}) == 1
+    assert not [p for p in base_path.rglob(".tmp-*")] + [p for p in base_path.glob("*.tmp-*")]
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz"])
+def test_archive_cache_write_sizes(base_path, mode):
+    """The same tar stream hits the cache however it's split into writes."""
+    (base_path / "inputs").mkdir()
+    rng = random.Random(0)
+    paths = []
+    for i in range(8):
+        path = base_path / "inputs" / f"{i}.bin"
+        size = rng.randrange(100_000, 400_000)
+        path.write_bytes(rng.getrandbits(8 * size).to_bytes(size, "little"))
+        paths.append(path)
+    cache = ArchiveCache(base_path / "cache")
+
+    def build(arc_path, jobs=1, **kwargs):
+        with ReproducibleTarFile.open(arc_path, mode, **kwargs) as tp:
+            tp.add_paths(paths, [path.name for path in paths], jobs=jobs)
+        return arc_path.read_bytes()
+
+    uncached = build(base_path / "uncached.tar")
+    assert build(base_path / "miss.tar", archive_cache=cache) == uncached
+    assert (
+        build(base_path / "buffered.tar", archive_cache=cache, write_buffer_size=2**20) == uncached
+    )
+    assert build(base_path / "jobs.tar", jobs=2, archive_cache=cache) == uncached
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert len([p for p in (base_path / "cache").rglob("*") if p.is_file()]) == 1
+
+
+@pytest.mark.parametrize("comptype", ["gz", "bz2", "xz"])
+def test_choose_compression_level(tmp_path, comptype):
+    """The chosen level meets the target for the sample, which only depends on the inputs."""
+    rng = random.Random(0)
+    words = [bytes(rng.choices(range(97, 123), k=rng.randrange(2, 9))) for _ in range(500)]
+    paths = []
+    # Small enough files that the default sample size reads them all
+    for i in range(16):
+        path = tmp_path / f"{i:02d}.txt"
+        path.write_bytes(b" ".join(rng.choices(words, k=2000)))
+        paths.append(path)
+    sample = b"".join(path.read_bytes() for path in paths)
+
+    def compressed_size(level):
+        if comptype == "gz":
+            return len(gzip.compress(sample, level, mtime=0))
+        elif comptype == "bz2":
+            return len(bz2.compress(sample, level))
+        return len(lzma.compress(sample, preset=level))
+
+    levels = range(1 if comptype == "bz2" else 0, 10)
+    sizes = {level: compressed_size(level) for level in levels}
+    level = choose_compression_level(comptype, paths, size_tolerance=0.02)
+    assert sizes[level] <= min(sizes.values()) * 1.02
+    assert all(sizes[lower] > min(sizes.values()) * 1.02 for lower in levels if lower < level)
+    fastest = choose_compression_level(comptype, paths, max_cost=1)
+    assert sizes[fastest] <= sizes[min(levels)]
+
+    # Incompressible inputs are stored with gzip level 0
+    random_path = tmp_path / "random.bin"
+    random_path.write_bytes(rng.getrandbits(8 * 100_000).to_bytes(100_000, "little"))
+    level = choose_compression_level(comptype, [random_path], size_tolerance=0.01)
+    assert level == (0 if comptype == "gz" else min(levels))
+
+    with pytest.raises(ValueError):
+        choose_compression_level(comptype, paths)
+
+
+@pytest.mark.parametrize("mode", ["w:gz", "w:xz"])
+def test_segment_incompressible(tmp_path, mode):
+    """Incompressible member data is written in separate segments, giving the same tar stream,
+    and the segments only depend on the members."""
+    dir_tree = tmp_path / "dir"
+    dir_tree.mkdir()
+    (dir_tree / "a.txt").write_bytes(b"compressible text " * 20000)
+    random_data = os.urandom(300_000)
+    (dir_tree / "b.bin").write_bytes(random_data)
+    (dir_tree / "c.jpg").write_bytes(b"\xff" * 100_000)
+    (dir_tree / "d.bin").write_bytes(os.urandom(1000))
+    paths = sorted([dir_tree, *dir_tree.iterdir()])
+
+    def build(arc_path, jobs=1, **kwargs):
+        with ReproducibleTarFile.open(arc_path, mode, **kwargs) as tp:
+            tp.add_paths(paths, jobs=jobs)
+            tp.add_many_bytes({"e.bin": random_data, "f.txt": b"more text " * 10000})
+        return arc_path.read_bytes()
+
+    decompress = gzip.decompress if mode == "w:gz" else lzma.decompress
+    plain = build(tmp_path / "plain.tar")
+    segmented = build(tmp_path / "segmented.tar", segment_incompressible=True)
+    assert decompress(segmented) == decompress(plain)
+    assert build(tmp_path / "jobs.tar", jobs=2, segment_incompressible=True) == segmented
+    if mode == "w:gz":
+        # Stored blocks hold the data as is
+        assert segmented.count(b"\x1f\x8b\x08") >= 5
+        assert random_data[:60000] in segmented
+        assert b"\xff" * 60000 in segmented
+
+    with pytest.raises(ValueError):
+        ReproducibleTarFile.open(
+            tmp_path / "append.tar", mode.replace("w", "a"), segment_incompressible=True
+        )
+
+
+@pytest.mark.parametrize("mode", ["", "gz", "bz2", "xz"])
+def test_readahead(tmp_path, mode, monkeypatch):
+    """Reading ahead in a background thread gives the same members and data, including after
+    seeking back, and stops when the archive is closed."""
+    import repro_tarfile
+
+    monkeypatch.setattr(repro_tarfile, "_READAHEAD_CHUNK_SIZE", 1000)
+    monkeypatch.setattr(repro_tarfile, "_READAHEAD_CHUNKS", 2)
+    rng = random.Random(0)
+    members = {f"{i:02d}.txt": b"%04d" % i * rng.randrange(0, 2000) for i in range(50)}
+    arc_path = tmp_path / "archive.tar"
+    with ReproducibleTarFile.open(arc_path, "w:" + mode) as tp:
+        tp.add_many_bytes(members)
+
+    with ReproducibleTarFile.open(arc_path, "r:*", readahead=True) as tp:
+        reader = tp.fileobj
+        assert {m.name: tp.extractfile(m).read() for m in tp} == members
+        # Seeking back restarts reading ahead
+        assert tp.extractfile("03.txt").read() == members["03.txt"]
+        assert tp.extractfile("40.txt").read() == members["40.txt"]
+    assert not reader._thread.is_alive()
+
+    with arc_path.open("rb") as fp:
+        with ReproducibleTarFile.open(fileobj=fp, mode="r:" + mode, readahead=True) as tp:
+            assert tp.getnames() == list(members)
+            reader = tp.fileobj
+        assert not reader._thread.is_alive()
+        assert not fp.closed
+
+    # A caller's file object is left where the archive was read up to
+    if not mode:
+        positions = []
+        for readahead in (False, True):
+            with arc_path.open("rb") as fp:
+                with ReproducibleTarFile.open(fileobj=fp, readahead=readahead) as tp:
+                    assert tp.next().name == "00.txt"  # type: ignore[union-attr]
+                positions.append(fp.tell())
+        assert positions[0] == positions[1] < arc_path.stat().st_size
+
+    for bad_mode in ("w", "r|" + (mode or "*")):
+        with pytest.raises(ValueError):
+            ReproducibleTarFile.open(tmp_path / "other.tar", bad_mode, readahead=True)
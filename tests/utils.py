@@ -1,10 +1,13 @@
 from contextlib import contextmanager
 import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os
 from pathlib import Path
 import re
 from tarfile import TarFile
 from tempfile import TemporaryDirectory
+import threading
+from urllib.parse import parse_qs, urlsplit
 
 
 class _DataFactory:
@@ -90,3 +93,105 @@ ANSI_ESCAPE_REGEX = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
 
 def remove_ansi_escape(s: str) -> str:
     return ANSI_ESCAPE_REGEX.sub("", s)
+
+
+class MultipartUploadServer(ThreadingHTTPServer):
+    """Local stand-in for an S3-compatible object store that supports multipart uploads. Completed
+    objects are stored in `objects` keyed by path, and the uploaded parts in `parts`. With
+    `drop_method`, the first request with that method is handled but the connection is closed
+    instead of replying. With `etag=False`, parts are stored but replied to without an ETag."""
+
+    def __init__(self, fail_part=None, drop_method=None, etag=True):
+        super().__init__(("127.0.0.1", 0), _MultipartUploadHandler)
+        self.fail_part = fail_part
+        self.drop_method = drop_method
+        self.etag = etag
+        self.objects = {}
+        self.uploads = {}
+        self.parts = {}
+        self.aborted = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class _MultipartUploadHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MultipartUploadServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b"", headers=None):
+        if self.command == self.server.drop_method:
+            self.server.drop_method = None
+            self.close_connection = True
+            return
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _parse(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        return url.path, parse_qs(url.query, keep_blank_values=True), body
+
+    def do_POST(self):
+        path, query, body = self._parse()
+        server = self.server
+        if "uploads" in query:
+            upload_id = f"upload-{len(server.uploads)}"
+            server.uploads[upload_id] = {}
+            body = f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId>"
+            self._reply(200, (body + "</InitiateMultipartUploadResult>").encode())
+            return
+        upload_id = query["uploadId"][0]
+        parts = server.uploads.pop(upload_id)
+        numbers = [int(n) for n in re.findall(r"<PartNumber>(\d+)</PartNumber>", body.decode())]
+        etags = re.findall(r"<ETag>([^<]*)</ETag>", body.decode())
+        assert numbers == list(range(1, len(parts) + 1))
+        assert etags == [parts[n][0] for n in numbers]
+        server.parts[path] = [parts[n][1] for n in numbers]
+        server.objects[path] = b"".join(server.parts[path])
+        self._reply(200, b"<CompleteMultipartUploadResult></CompleteMultipartUploadResult>")
+
+    def do_PUT(self):
+        path, query, body = self._parse()
+        server = self.server
+        part_number = int(query["partNumber"][0])
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            if part_number == server.fail_part:
+                self._reply(500, b"<Error>InternalError</Error>")
+                return
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            server.uploads[query["uploadId"][0]][part_number] = (etag, body)
+            self._reply(200, headers={"ETag": etag} if server.etag else {})
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def do_DELETE(self):
+        _, query, _ = self._parse()
+        upload_id = query["uploadId"][0]
+        self.server.uploads.pop(upload_id, None)
+        self.server.aborted.append(upload_id)
+        self._reply(204)